@@ -1,6 +1,7 @@
 import numpy as np
 from osgeo.osr import SpatialReference
 from typing import Optional, Union
+from edef.eobject.utils.srs_utils import SrsLike, same_srs, to_srs, transform_bounds
 
 
 class Bbox:
@@ -20,7 +21,7 @@ class Bbox:
         xmax: Union[float, int],
         ymin: Union[float, int],
         ymax: Union[float, int],
-        srs: Optional[SpatialReference],
+        srs: Optional[SpatialReference] = None,
     ):
         if xmin > xmax:
             raise ValueError(
@@ -43,7 +44,7 @@ class Bbox:
             and self.xmax == value.xmax
             and self.ymin == value.ymin
             and self.ymax == value.ymax
-            and self.srs == value.srs
+            and same_srs(self.srs, value.srs)
         )
 
     @staticmethod
@@ -64,6 +65,18 @@ class Bbox:
     def to_xia_yia(self):
         return self.xmin, self.xmax, self.ymin, self.ymax
 
+    def reproject(self, srs: SrsLike, densify: int = 21) -> "Bbox":
+        """Box containing this box in another spatial reference system
+
+        Arguments:
+            srs: target system
+            densify: number of points along each edge
+        """
+        if self.srs is None:
+            raise ValueError("The bbox has no spatial reference system")
+        bounds = transform_bounds([self.to_xia_yia()], self.srs, srs, densify)[0]
+        return Bbox(*bounds.tolist(), to_srs(srs))
+
     def x_amp(self):
         return self.xmax - self.xmin
 
@@ -71,51 +84,43 @@ class Bbox:
         return self.ymax - self.ymin
 
     def pad_value(self, value):
-        if value is float or value is int:
+        if isinstance(value, (float, int)):
             value = [value, value]
         x_pad = value[0]
         y_pad = value[1]
         return Bbox(
-            self.xmin - x_pad, self.xmax + x_pad, self.ymin - y_pad, self.y_max + y_pad
+            self.xmin - x_pad,
+            self.xmax + x_pad,
+            self.ymin - y_pad,
+            self.ymax + y_pad,
+            self.srs,
         )
 
     def pad_ratio(self, value):
-        if value is float or value is int:
+        if isinstance(value, (float, int)):
             value = [value, value]
         x_pad = value[0] * self.x_amp()
         y_pad = value[1] * self.y_amp()
         return self.pad_value([x_pad, y_pad])
 
     def pad_percent(self, value):
-        if value is float or value is int:
+        if isinstance(value, (float, int)):
             value = [value, value]
         x_pad = value[0] / 100
         y_pad = value[1] / 100
         return self.pad_ratio([x_pad, y_pad])
 
     @staticmethod
-    def from_min_bbox(bboxs: list):
-        bboxs = np.asarray([list(b.to_xia_lia()) for b in bboxs])
-        try:
-            bbox = Bbox(
-                np.max(bboxs[:, 0]),
-                np.min(bboxs[:, 1]),
-                np.max(bboxs[:, 2]),
-                np.min(bboxs[:, 3]),
-            )
-        except ValueError:
-            return None  # No overlapping between all bboxs
-        return bbox
+    def from_min_bbox(bboxs: Union[list, "BboxArray"]):
+        if not isinstance(bboxs, BboxArray):
+            bboxs = BboxArray.from_bboxs(bboxs)
+        return bboxs.total_intersection()  # None if no overlapping between all bboxs
 
     @staticmethod
-    def from_max_bbox(bboxs: list):
-        bboxs = np.asarray([list(b.to_xia_lia()) for b in bboxs])
-        return Bbox(
-            np.min(bboxs[:, 0]),
-            np.max(bboxs[:, 1]),
-            np.min(bboxs[:, 2]),
-            np.max(bboxs[:, 3]),
-        )
+    def from_max_bbox(bboxs: Union[list, "BboxArray"]):
+        if not isinstance(bboxs, BboxArray):
+            bboxs = BboxArray.from_bboxs(bboxs)
+        return bboxs.total_union()
 
     @staticmethod
     def from_points(points: list):
@@ -124,6 +129,214 @@ class Bbox:
         return Bbox(min[0], max[0], min[1], max[1])
 
 
+class BboxArray:
+    """Many bounding boxes sharing a spatial reference system
+
+    The boxes are stored as a single (N, 4) float64 array with the columns
+    xmin, xmax, ymin, ymax (as `Bbox.to_xia_yia`) so that bulk operations
+    are vectorized. Operations between two arrays are element wise and
+    broadcast a single box, `*_matrix` methods compare all pairs.
+    Empty intersections are rows of NaN.
+
+    Attributes:
+        bounds: (N, 4) array of xmin, xmax, ymin, ymax
+        srs: spatial reference system
+    """
+
+    def __init__(self, bounds, srs: Optional[SpatialReference] = None):
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        with np.errstate(invalid="ignore"):
+            if np.any(bounds[:, 0] > bounds[:, 1]) or np.any(bounds[:, 2] > bounds[:, 3]):
+                raise ValueError("Some minimum values are higher than the maximum values")
+        self.bounds = bounds
+        self.srs = srs
+
+    @staticmethod
+    def from_bboxs(bboxs: list):
+        if len(bboxs) == 0:
+            return BboxArray(np.empty((0, 4)))
+        bounds = np.array([b.to_xia_yia() for b in bboxs], dtype=np.float64)
+        return BboxArray(bounds, bboxs[0].srs)
+
+    @staticmethod
+    def from_points(points) -> "BboxArray":
+        """Boxes of groups of points, from a (N, P, 2) array"""
+        points = np.asarray(points, dtype=np.float64)
+        mins, maxs = points.min(axis=1), points.max(axis=1)
+        return BboxArray(np.stack([mins[:, 0], maxs[:, 0], mins[:, 1], maxs[:, 1]], axis=1))
+
+    @staticmethod
+    def concatenate(arrays: list) -> "BboxArray":
+        return BboxArray(np.concatenate([a.bounds for a in arrays]), arrays[0].srs)
+
+    def reproject(self, srs: SrsLike, densify: int = 21) -> "BboxArray":
+        """Reproject all the boxes, see `Bbox.reproject`"""
+        if self.srs is None:
+            raise ValueError("The boxes have no spatial reference system")
+        return BboxArray(transform_bounds(self.bounds, self.srs, srs, densify), to_srs(srs))
+
+    def to_bboxs(self) -> list:
+        return [Bbox(*row, self.srs) for row in self.bounds.tolist()]
+
+    def __len__(self):
+        return self.bounds.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return Bbox(*self.bounds[index].tolist(), self.srs)
+        return BboxArray(self.bounds[index], self.srs)
+
+    def __iter__(self):
+        return iter(self.to_bboxs())
+
+    @property
+    def xmin(self):
+        return self.bounds[:, 0]
+
+    @property
+    def xmax(self):
+        return self.bounds[:, 1]
+
+    @property
+    def ymin(self):
+        return self.bounds[:, 2]
+
+    @property
+    def ymax(self):
+        return self.bounds[:, 3]
+
+    def x_amp(self) -> np.ndarray:
+        return self.xmax - self.xmin
+
+    def y_amp(self) -> np.ndarray:
+        return self.ymax - self.ymin
+
+    def area(self) -> np.ndarray:
+        return self.x_amp() * self.y_amp()
+
+    def centers(self) -> np.ndarray:
+        """(N, 2) centers of the boxes"""
+        return np.stack([self.xmin + self.xmax, self.ymin + self.ymax], axis=1) / 2
+
+    def is_empty(self) -> np.ndarray:
+        """Boxes coming from empty intersections"""
+        return np.isnan(self.bounds).any(axis=1)
+
+    def _other(self, other) -> np.ndarray:
+        if isinstance(other, Bbox):
+            other = BboxArray([other.to_xia_yia()], other.srs)
+        if (
+            self.srs is not None
+            and other.srs is not None
+            and not same_srs(self.srs, other.srs)
+        ):
+            raise ValueError("The boxes have different spatial reference systems")
+        return other.bounds
+
+    def pad(self, value, per_box: bool = False) -> "BboxArray":
+        """Pad by a value or (x, y) values, or by (N,) / (N, 2) values with `per_box`"""
+        value = np.asarray(value, dtype=np.float64)
+        expected = 2 if per_box else 1
+        if value.ndim > expected or (per_box and value.shape[:1] != (len(self),)):
+            raise ValueError(
+                f"Pad of shape {value.shape} does not match {len(self)} boxes"
+                + ("" if per_box else ", use per_box for values per box")
+            )
+        if value.ndim == expected - 1:
+            value = np.stack([value, value], axis=-1)
+        elif value.shape[-1] != 2:
+            raise ValueError(f"Pad of shape {value.shape} is not (x, y) values")
+        value = np.broadcast_to(value, (len(self), 2))
+        pad = np.stack([-value[:, 0], value[:, 0], -value[:, 1], value[:, 1]], axis=1)
+        return BboxArray(self.bounds + pad, self.srs)
+
+    def intersection(self, other) -> "BboxArray":
+        o = self._other(other)
+        b = np.empty(np.broadcast_shapes(self.bounds.shape, o.shape))
+        np.maximum(self.bounds[:, 0::2], o[:, 0::2], out=b[:, 0::2])
+        np.minimum(self.bounds[:, 1::2], o[:, 1::2], out=b[:, 1::2])
+        b[(b[:, 0] > b[:, 1]) | (b[:, 2] > b[:, 3])] = np.nan
+        return BboxArray(b, self.srs)
+
+    def union(self, other) -> "BboxArray":
+        o = self._other(other)
+        b = np.empty(np.broadcast_shapes(self.bounds.shape, o.shape))
+        np.minimum(self.bounds[:, 0::2], o[:, 0::2], out=b[:, 0::2])
+        np.maximum(self.bounds[:, 1::2], o[:, 1::2], out=b[:, 1::2])
+        return BboxArray(b, self.srs)
+
+    def intersects(self, other) -> np.ndarray:
+        o = self._other(other)
+        a = self.bounds
+        return (
+            (a[:, 0] <= o[:, 1])
+            & (o[:, 0] <= a[:, 1])
+            & (a[:, 2] <= o[:, 3])
+            & (o[:, 2] <= a[:, 3])
+        )
+
+    def contains(self, other) -> np.ndarray:
+        """Whether each box contains the other box"""
+        o = self._other(other)
+        a = self.bounds
+        return (
+            (a[:, 0] <= o[:, 0])
+            & (o[:, 1] <= a[:, 1])
+            & (a[:, 2] <= o[:, 2])
+            & (o[:, 3] <= a[:, 3])
+        )
+
+    def contains_points(self, points) -> np.ndarray:
+        """(N, P) whether each box contains each of the (P, 2) points"""
+        p = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        a = self.bounds
+        return (
+            (a[:, 0, None] <= p[None, :, 0])
+            & (p[None, :, 0] <= a[:, 1, None])
+            & (a[:, 2, None] <= p[None, :, 1])
+            & (p[None, :, 1] <= a[:, 3, None])
+        )
+
+    def overlap_matrix(self, other: "BboxArray") -> np.ndarray:
+        """(N, M) whether each box of self intersects each box of other"""
+        o = self._other(other)
+        a = self.bounds
+        return (
+            (a[:, None, 0] <= o[None, :, 1])
+            & (o[None, :, 0] <= a[:, None, 1])
+            & (a[:, None, 2] <= o[None, :, 3])
+            & (o[None, :, 2] <= a[:, None, 3])
+        )
+
+    def intersection_area_matrix(self, other: "BboxArray") -> np.ndarray:
+        """(N, M) area of the intersection of each pair of boxes"""
+        o = self._other(other)
+        a = self.bounds
+        dx = np.minimum(a[:, None, 1], o[None, :, 1]) - np.maximum(a[:, None, 0], o[None, :, 0])
+        dy = np.minimum(a[:, None, 3], o[None, :, 3]) - np.maximum(a[:, None, 2], o[None, :, 2])
+        return np.clip(dx, 0, None) * np.clip(dy, 0, None)
+
+    def total_intersection(self) -> Optional[Bbox]:
+        """Box common to all the boxes, None if they do not all overlap"""
+        b = self.bounds
+        xmin, xmax = b[:, 0].max(), b[:, 1].min()
+        ymin, ymax = b[:, 2].max(), b[:, 3].min()
+        if xmin > xmax or ymin > ymax:
+            return None
+        return Bbox(float(xmin), float(xmax), float(ymin), float(ymax), self.srs)
+
+    def total_union(self) -> Bbox:
+        """Box containing all the boxes"""
+        b = self.bounds
+        return Bbox(
+            float(b[:, 0].min()),
+            float(b[:, 1].max()),
+            float(b[:, 2].min()),
+            float(b[:, 3].max()),
+            self.srs,
+        )
+
+
 class Sbox:
     """Shaping Box -"""
 
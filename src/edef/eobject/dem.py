@@ -1,30 +1,281 @@
-import gdal
-import os
-from os.path import join, dirname, basename, splitext
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os import makedirs, replace
+from os.path import exists, join, dirname, basename, splitext
+from typing import List, Optional, Union
+import json
+import numpy as np
+import dask.array as da
+from edef.eobject.georaster import GeoRaster
+from edef.eobject.utils.gdal_utils import BlockReader, TiledWriter, Window
 from edef.eobject.sats.satellites import SATELLITES
 
-DEM_SOURCE = SATELLITES.keys + ["MIX", "EXT"]
+DEM_SOURCE = list(SATELLITES.keys()) + ["MIX", "EXT"]
 
 DEM_FORMAT = {"GeoTiff": [".tif", ".tiff"]}
 
+# Length of a year in seconds, for trends in meters per year
+YEAR = 365.25 * 86400
+
 
 class Dem:
     def __init__(self):
         self.folder_path = ""
         self.file_name = ""
         self.format = ""
+        self.path = ""
 
     def from_source(self, path):
         self.folder_path = dirname(path)
         self.file_name, ext = splitext(basename(path))
+        self.path = path
 
-        for format in DEM_FORMAT:
-            for e in format:
-                if e == ext:
-                    self.format = format
-                    break
-        if len(format) == 0:
+        for format, extensions in DEM_FORMAT.items():
+            if ext.lower() in extensions:
+                self.format = format
+                break
+        if not self.format:
             raise TypeError(f"File format with extension {ext} is not supported!")
+        return self
+
+    def raster(self) -> GeoRaster:
+        return GeoRaster.from_file(self.path)
+
+
+class DemStack:
+    """DEMs of a site at several epochs, co-gridded once, with per-pixel trends
+
+    Each DEM appended is resampled on the grid of the stack and stored as a
+    tiled GeoTiff, so the stack reads as a chunked (time, y, x) array. The
+    running sums of the linear regression of the heights against time are
+    kept for every pixel, so appending an epoch updates the trend, residual
+    standard deviation and count of valid epochs without reading the other
+    epochs.
+
+    Folder layout:
+        stack.json: grid and epochs of the stack
+        epochs/<time>.tif: DEMs resampled on the grid
+        sums.tif: running sums of the valid epochs of each pixel (`SUMS`),
+            times in years from the first epoch. Its `STACK` metadata lists
+            the epochs counted, so that a stack interrupted between the
+            update of the sums and of stack.json is recovered on opening
+
+    Arguments:
+        folder: folder of an existing stack, see `create`
+    """
+
+    SUMS = ["n", "t", "tt", "z", "tz", "zz"]
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        with open(join(folder, "stack.json")) as f:
+            self.meta = json.load(f)
+        counted = self._counted()
+        if counted is not None and len(counted["epochs"]) > len(self.meta["epochs"]):
+            self.meta.update(counted)
+            self._save()
+        self.grid = GeoRaster.from_grid(
+            self.meta["geotransform"],
+            self.meta["width"],
+            self.meta["height"],
+            self.meta["projection"] or None,
+        )
+
+    @staticmethod
+    def create(folder: str, like: Union[str, GeoRaster, Dem]) -> "DemStack":
+        """New empty stack on the grid of a raster
+
+        Arguments:
+            folder: folder of the stack, created if needed
+            like: DEM or raster giving the grid
+        """
+        like = _raster(like)
+        if exists(join(folder, "stack.json")):
+            raise FileExistsError(f"A stack already exists in {folder}")
+        makedirs(join(folder, "epochs"), exist_ok=True)
+        meta = {
+            "geotransform": list(like.geotransform),
+            "width": like.dim[0],
+            "height": like.dim[1],
+            "projection": like.projection or "",
+            "t0": None,
+            "epochs": [],
+        }
+        with open(join(folder, "stack.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        return DemStack(folder)
+
+    def __len__(self):
+        return len(self.meta["epochs"])
+
+    @property
+    def times(self) -> List[datetime]:
+        return [datetime.fromisoformat(e["time"]) for e in self.meta["epochs"]]
+
+    def years(self, time: datetime) -> float:
+        """Time in years from the first epoch"""
+        return (time - datetime.fromisoformat(self.meta["t0"])).total_seconds() / YEAR
+
+    def _counted(self) -> Optional[dict]:
+        """First time and epochs counted in the sums, None without sums"""
+        path = join(self.folder, "sums.tif")
+        if not exists(path):
+            return None
+        with BlockReader(path) as reader:
+            value = reader.dataset.GetMetadataItem("STACK")
+        return json.loads(value) if value else None
+
+    def _save(self):
+        tmp = join(self.folder, "stack.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f, indent=2)
+        replace(tmp, join(self.folder, "stack.json"))
+
+    def append(
+        self,
+        dem: Union[str, GeoRaster, Dem],
+        time: datetime,
+        tile: int = 1024,
+        workers: int = 4,
+        **writer_opts,
+    ):
+        """Add an epoch: co-grid the DEM and update the running sums
+
+        Arguments:
+            dem: DEM of the epoch
+            time: acquisition time
+            tile: tile size in pixels
+            workers: number of threads
+            writer_opts: options of `TiledWriter` (compress, block_size...)
+        """
+        if any(t == time for t in self.times):
+            raise ValueError(f"The stack already has an epoch at {time.isoformat()}")
+        dem = _raster(dem)
+        if self.meta["t0"] is None:
+            self.meta["t0"] = time.isoformat()
+        t = self.years(time)
+        width, height = self.grid.dim
+        name = join("epochs", time.strftime("%Y%m%dT%H%M%S%f") + ".tif")
+        sums_path = join(self.folder, "sums.tif")
+        old = BlockReader(sums_path) if exists(sums_path) else None
+
+        writer_opts.setdefault("nodata", np.nan)
+        epoch = TiledWriter(
+            join(self.folder, name),
+            width,
+            height,
+            geotransform=self.grid.geotransform,
+            projection=self.grid.projection or "",
+            **writer_opts,
+        )
+        sums = TiledWriter(
+            sums_path + ".tmp.tif",
+            width,
+            height,
+            count=len(self.SUMS),
+            dtype=np.float64,
+            geotransform=self.grid.geotransform,
+            projection=self.grid.projection or "",
+            **(writer_opts | {"nodata": None}),
+        )
+        epochs = self.meta["epochs"] + [
+            {"time": time.isoformat(), "path": name, "source": dem.path}
+        ]
+        epochs.sort(key=lambda e: e["time"])
+        sums.dataset.SetMetadataItem(
+            "STACK", json.dumps({"t0": self.meta["t0"], "epochs": epochs})
+        )
+        tile = -(-tile // epoch.block_size) * epoch.block_size
+
+        def process(window: Window):
+            z = dem.read_on_grid(self.grid, window)
+            epoch.write(window, z.astype(epoch.dtype))
+            if old is not None:
+                s = np.stack([old.read(window, b + 1) for b in range(len(self.SUMS))])
+            else:
+                s = np.zeros((len(self.SUMS),) + window.shape)
+            n = np.isfinite(z).astype(np.float64)
+            zv = np.where(n > 0, z, 0.0)
+            s += np.stack([n, n * t, n * t * t, zv, zv * t, zv * zv])
+            sums.write(window, s)
+
+        windows = [
+            Window(x, y, tile, tile).clip(width, height)
+            for y in range(0, height, tile)
+            for x in range(0, width, tile)
+        ]
+        with epoch, sums, ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(process, windows))
+        if old is not None:
+            old.close()
+        replace(sums_path + ".tmp.tif", sums_path)
+
+        self.meta["epochs"] = epochs
+        self._save()
+
+    def epoch(self, index: int) -> GeoRaster:
+        """Co-gridded DEM of an epoch, in time order"""
+        return GeoRaster.from_file(join(self.folder, self.meta["epochs"][index]["path"]))
+
+    def difference(self, a: int, b: int) -> GeoRaster:
+        """Lazy difference of the epochs a - b, on the grid of the stack"""
+        return GeoRaster.from_array(self.epoch(a).data - self.epoch(b).data, self.grid)
+
+    def to_dask(self, chunks: Optional[tuple] = None) -> da.Array:
+        """Lazy (time, y, x) array of the co-gridded DEMs"""
+        return da.stack([self.epoch(i).to_dask(1, chunks) for i in range(len(self))])
+
+    def _sums(self, chunks: Optional[tuple] = None) -> dict:
+        sums = GeoRaster.from_file(join(self.folder, "sums.tif"))
+        return {name: sums.to_dask(b + 1, chunks) for b, name in enumerate(self.SUMS)}
+
+    def _fit(self, chunks: Optional[tuple] = None):
+        s = self._sums(chunks)
+        n = s["n"]
+        det = n * s["tt"] - s["t"] ** 2
+        fitted = (n >= 2) & (det > 1e-12)
+        det = da.where(fitted, det, 1.0)
+        slope = da.where(fitted, (n * s["tz"] - s["t"] * s["z"]) / det, np.nan)
+        intercept = (s["z"] - slope * s["t"]) / da.where(n > 0, n, 1)
+        return s, slope, intercept
+
+    def count(self) -> GeoRaster:
+        """Number of valid epochs of each pixel"""
+        return GeoRaster.from_array(self._sums()["n"], self.grid)
+
+    def trend(self) -> GeoRaster:
+        """Lazy linear elevation trend, in meters per year, NaN with less than 2 epochs"""
+        return GeoRaster.from_array(self._fit()[1], self.grid)
+
+    def intercept(self) -> GeoRaster:
+        """Lazy height of the linear fit at the first epoch"""
+        return GeoRaster.from_array(self._fit()[2], self.grid)
+
+    def residual_std(self) -> GeoRaster:
+        """Lazy standard deviation of the residuals of the linear fit
+
+        NaN with less than 3 epochs.
+        """
+        s, b, a = self._fit()
+        sse = (
+            s["zz"]
+            - 2 * a * s["z"]
+            - 2 * b * s["tz"]
+            + s["n"] * a**2
+            + 2 * a * b * s["t"]
+            + b**2 * s["tt"]
+        )
+        dof = s["n"] - 2
+        std = da.sqrt(da.maximum(sse, 0) / da.where(dof > 0, dof, 1))
+        return GeoRaster.from_array(da.where(dof > 0, std, np.nan), self.grid)
+
+
+def _raster(dem: Union[str, GeoRaster, Dem]) -> GeoRaster:
+    if isinstance(dem, GeoRaster):
+        return dem
+    if isinstance(dem, Dem):
+        return dem.raster()
+    return GeoRaster.from_file(dem)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,26 @@
 from osgeo import gdal, osr
+from functools import partial
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+import os
 import numpy as np
-from boundary import Bbox
+import dask.array as da
+from dask.base import tokenize
+from scipy import ndimage
+from edef.eobject.boundary import Bbox
+from edef.eobject.utils.gdal_utils import (
+    BlockCache,
+    BlockReader,
+    LazyBand,
+    Window,
+    block_chunks,
+    memmap_band,
+    write_dask,
+)
+from edef.eobject.utils import filters
+from edef.eobject.utils.chunk_store import ChunkStore
+from edef.eobject.utils.pyramid import Pyramid, decimate
+from edef.eobject.utils.srs_utils import SrsLike, same_srs, to_srs, transform_points
+from edef.eobject.utils.terrain import HALO, TerrainEngine, pad_edges, stack_block
 
 # class GeoMask ?
 # could handle transition between raster and vector masks
@@ -20,32 +40,454 @@ class GeoRaster:
         self.bbox = None
         self.dim = None
         self.path = ""
+        self.reader = None
+        self.data = None
+        self.mmap = False
+        self.pyramid = None
+        self._memmaps = {}
 
     @staticmethod
-    def from_file(path):
-        """open with gdal
-        read metadata only ?
-        open in readonly ?"""
-        pass
+    def from_file(
+        path: str,
+        cache: Optional[BlockCache] = None,
+        chunks: Optional[Tuple[int, int]] = None,
+        mmap: bool = False,
+    ):
+        """Open a GeoTiff in read only mode
+
+        Only the metadata is read. `data` is a lazy dask array of the first
+        band whose chunks are made of whole GTiff blocks, pixels are read on
+        demand when it is computed.
+
+        With `mmap`, uncompressed files stored as contiguous strips (ASP
+        intermediate products) are memory mapped: views and chunks are
+        slices of the file mapping, without copy. Other files fall back to
+        the block reader.
+
+        Arguments:
+            path: path to the GeoTiff
+            cache: optional block cache shared by the reads
+            chunks: chunk shape (lines, columns), default to ~2048 pixels
+                aligned on the file blocks
+            mmap: memory map the file when its layout allows it
+        """
+        reader = BlockReader(path, cache=cache)
+        raster = GeoRaster(reader.dataset)
+        raster.reader = reader
+        raster.path = path
+        raster.mmap = mmap and raster.memmap(1) is not None
+        raster.dim = (reader.width, reader.height)
+        raster.geotransform = reader.dataset.GetGeoTransform()
+        raster.projection = reader.dataset.GetProjection()
+        if raster.projection:
+            raster.srs.ImportFromWkt(raster.projection)
+        raster.metadata = reader.dataset.GetMetadata()
+        raster.bbox = raster.window_to_bbox(reader.full_window())
+        raster.data = raster.to_dask(1, chunks)
+        raster.pyramid = Pyramid.open(path)
+        return raster
+
+    @staticmethod
+    def from_array(data, like: "GeoRaster"):
+        """New raster holding `data` with the georeferencing of `like`
+
+        Arguments:
+            data: numpy or dask array, with the same shape as `like`
+            like: raster giving the grid
+        """
+        if tuple(data.shape[-2:]) != (like.dim[1], like.dim[0]):
+            raise ValueError(
+                f"Data shape {data.shape} does not match the raster grid {like.dim}"
+            )
+        raster = GeoRaster(None)
+        raster.srs = like.srs
+        raster.geotransform = like.geotransform
+        raster.projection = like.projection
+        raster.bbox = like.bbox
+        raster.dim = like.dim
+        raster.data = data
+        return raster
+
+    @staticmethod
+    def from_grid(
+        geotransform: Tuple[float, ...],
+        width: int,
+        height: int,
+        srs: Optional[SrsLike] = None,
+        data=None,
+    ):
+        """Raster of a pixel grid, without data unless given
+
+        Arguments:
+            geotransform: GDAL geotransform
+            width: number of columns
+            height: number of lines
+            srs: spatial reference system
+            data: array of shape (height, width)
+        """
+        raster = GeoRaster(None)
+        if srs is not None:
+            raster.srs = to_srs(srs)
+            raster.projection = raster.srs.ExportToWkt()
+        raster.geotransform = tuple(geotransform)
+        raster.dim = (width, height)
+        raster.bbox = raster.window_to_bbox(Window(0, 0, width, height))
+        raster.data = data
+        return raster
+
+    def to_dask(self, band: int = 1, chunks: Optional[Tuple[int, int]] = None):
+        """Lazy dask array of a band, chunked on the file blocks"""
+        if self.reader is None:
+            if band != 1:
+                raise ValueError("In memory rasters hold a single band")
+            return da.asarray(self.data)
+        source = LazyBand(self.path, band, self.reader.cache)
+        if chunks is None:
+            chunks = block_chunks(source.block_shape)
+        if self.mmap:
+            return da.from_array(self.memmap(band), chunks=chunks)
+        name = "georaster-" + tokenize(self.path, os.path.getmtime(self.path), band)
+        return da.from_array(source, chunks=chunks, name=name, asarray=False, lock=False)
 
-    def array_full():
+    def memmap(self, band: int = 1) -> Optional[np.ndarray]:
+        """Memory mapped view of a band, None if the file can not be mapped"""
+        if band not in self._memmaps:
+            self._memmaps[band] = memmap_band(self.path, band)
+        return self._memmaps[band]
+
+    def compute(self, **kwargs) -> np.ndarray:
+        """Evaluate the lazy data, `kwargs` are given to dask"""
+        if isinstance(self.data, da.Array):
+            return self.data.compute(**kwargs)
+        return np.asarray(self.data)
+
+    def map_overlap(self, func: Callable, depth: int, dtype=None, **kwargs):
+        """Lazily apply a neighbourhood function chunk by chunk
+
+        Each chunk is given with `depth` pixels of its neighbours so that the
+        result equals the whole array computation. No padding is added on the
+        raster edges, `func` handles them as on a whole array.
+
+        Arguments:
+            func: function taking and returning a 2D numpy array
+            depth: halo size in pixels
+            dtype: output dtype, default to the input dtype
+            kwargs: given to `func`
+        """
+        data = da.asarray(self.data)
+        out = data.map_overlap(
+            partial(func, **kwargs),
+            depth=depth,
+            boundary="none",
+            dtype=dtype or data.dtype,
+        )
+        return GeoRaster.from_array(out, self)
+
+    def window_to_bbox(self, window: Window) -> Bbox:
+        """Map coordinates covered by a pixel window"""
+        x0, dx, _, y0, _, dy = self.geotransform
+        xa, xb = x0 + window.xoff * dx, x0 + (window.xoff + window.xsize) * dx
+        ya, yb = y0 + window.yoff * dy, y0 + (window.yoff + window.ysize) * dy
+        return Bbox(min(xa, xb), max(xa, xb), min(ya, yb), max(ya, yb), self.srs)
+
+    def footprint(self, srs: Optional[SrsLike] = None) -> Bbox:
+        """Bbox of the raster, reprojected to `srs` if given"""
+        return self.bbox if srs is None else self.bbox.reproject(srs)
+
+    def xy_to_pixel(self, points, srs: Optional[SrsLike] = None) -> np.ndarray:
+        """(N, 2) fractional (col, row) of (N, 2) points, given in `srs` or the raster srs"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if srs is not None:
+            points = transform_points(points, srs, self.srs)
+        x0, dx, _, y0, _, dy = self.geotransform
+        return np.stack([(points[:, 0] - x0) / dx, (points[:, 1] - y0) / dy], axis=1)
+
+    def bbox_to_window(self, bbox: Bbox) -> Optional[Window]:
+        """Smallest pixel window covering a bbox, clipped to the raster
+
+        Return None if the bbox does not overlap the raster.
+        """
+        x0, dx, rx, y0, ry, dy = self.geotransform
+        if rx != 0 or ry != 0:
+            raise ValueError("Rotated geotransforms are not supported")
+        cols = sorted([(bbox.xmin - x0) / dx, (bbox.xmax - x0) / dx])
+        rows = sorted([(bbox.ymin - y0) / dy, (bbox.ymax - y0) / dy])
+        xoff, yoff = int(np.floor(cols[0])), int(np.floor(rows[0]))
+        window = Window(
+            xoff, yoff, int(np.ceil(cols[1])) - xoff, int(np.ceil(rows[1])) - yoff
+        )
+        return window.clip(*self.dim)
+
+    def array_full(self, band: int = 1) -> np.ndarray:
         "Load all the tiff"
-        pass
+        if self.reader is None:
+            return self.compute()
+        if self.mmap:
+            return self.memmap(band)
+        return self.reader.read(None, band)
 
-    def array_view():
-        """Load a portion of the tiff based on offset and size"""
-        pass
+    def array_view(
+        self,
+        window: Union[Window, Bbox, tuple],
+        band: int = 1,
+        resolution: Optional[float] = None,
+    ):
+        """Load a portion of the tiff based on offset and size
 
-    def save():
-        pass
+        With a `resolution` and a pyramid, the window is read from the
+        coarsest level whose pixels are not larger than the resolution, the
+        array has then the shape of the window in this level.
 
-    def gradient():
-        """First derivative"""
-        pass
+        Arguments:
+            window: pixel window (`Window` or (xoff, yoff, xsize, ysize)) or
+                `Bbox` in map coordinates
+            band: band number, starting at 1
+            resolution: largest pixel size wanted, in map units
+        """
+        if isinstance(window, Bbox):
+            bbox = window
+            window = self.bbox_to_window(bbox)
+            if window is None:
+                raise ValueError(f"Bbox {bbox.to_xia_yia()} is outside of the raster")
+        else:
+            window = Window(*window)
+        if resolution is not None and self.pyramid is not None:
+            factor = self.pyramid.factor_for(resolution / self._pixel_size())
+            if factor > 1:
+                return self.pyramid.read(factor, window, band)
+        if self.reader is None:
+            view = self.data[window.slices()]
+            return view.compute() if isinstance(view, da.Array) else np.asarray(view)
+        if self.mmap:
+            if window.clip(*self.dim) != window:
+                raise ValueError(f"Window {window} is outside of the raster")
+            return self.memmap(band)[window.slices()]
+        return self.reader.read(window, band)
+
+    def nodata(self) -> Optional[float]:
+        return self.reader.nodata if self.reader is not None else None
+
+    def array_float(self, window: Union[Window, tuple], band: int = 1) -> np.ndarray:
+        """Window of a band as float64, with NaN on nodata pixels"""
+        raw = self.array_view(window, band)
+        array = np.array(raw, dtype=np.float64)
+        if self.nodata() is not None:
+            array[self._is_nodata(raw)] = np.nan
+        return array
+
+    def _is_nodata(self, array):
+        """Nodata mask, compared in the data type of the raster (float32 -3.4e38...)"""
+        nodata = self.nodata()
+        if np.issubdtype(array.dtype, np.floating):
+            nodata = array.dtype.type(nodata)
+        return array == nodata
+
+    def grid_pixels(self, like: "GeoRaster", window: Window) -> Tuple[np.ndarray, np.ndarray]:
+        """Fractional (col, row) in this raster of the pixel centers of a window of `like`
+
+        Integer coordinates are pixel centers. Points which can not be
+        transformed are NaN.
+        """
+        window = Window(*window)
+        lx0, ldx, _, ly0, _, ldy = like.geotransform
+        xs = lx0 + (window.xoff + np.arange(window.xsize) + 0.5) * ldx
+        ys = ly0 + (window.yoff + np.arange(window.ysize) + 0.5) * ldy
+        x0, dx, _, y0, _, dy = self.geotransform
+        if self._same_srs(like):
+            # Same system: the mapping between the grids is separable
+            cols = np.broadcast_to((xs - x0) / dx - 0.5, window.shape)
+            rows = np.broadcast_to(((ys - y0) / dy - 0.5)[:, None], window.shape)
+            return cols, rows
+        x, y = np.meshgrid(xs, ys)
+        points = transform_points(np.stack([x.ravel(), y.ravel()], axis=1), like.srs, self.srs)
+        points[~np.isfinite(points)] = np.nan
+        cols = ((points[:, 0] - x0) / dx - 0.5).reshape(window.shape)
+        rows = ((points[:, 1] - y0) / dy - 0.5).reshape(window.shape)
+        return cols, rows
+
+    def _same_srs(self, other: "GeoRaster") -> bool:
+        """Same system, a raster without system is assumed in the system of the other"""
+        if not self.srs.ExportToWkt() or not other.srs.ExportToWkt():
+            return True
+        return same_srs(self.srs, other.srs)
+
+    def read_on_grid(
+        self, like: "GeoRaster", window: Optional[Window] = None, band: int = 1, order: int = 1
+    ) -> np.ndarray:
+        """Resample a window of the grid of another raster from this raster
+
+        Pixel centers of `like` are projected into this raster and
+        interpolated, only the part of this raster under the window is read.
+        Pixels outside of this raster or next to nodata are NaN.
+
+        Arguments:
+            like: raster giving the grid
+            window: pixel window of `like`, all of it if None
+            band: band of this raster
+            order: 0 for nearest neighbour, 1 for bilinear
+        """
+        if window is None:
+            window = Window(0, 0, *like.dim)
+        window = Window(*window)
+        same = self._same_srs(like)
+        if same and tuple(self.geotransform) == tuple(like.geotransform) and self.dim == like.dim:
+            return self.array_float(window, band)
+
+        cols, rows = self.grid_pixels(like, window)
+        if same:
+            col0, row0 = cols[0, 0], rows[0, 0]
+            if (
+                np.isclose(like.geotransform[1], self.geotransform[1])
+                and np.isclose(like.geotransform[5], self.geotransform[5])
+                and np.isclose(col0, np.round(col0), atol=1e-6)
+                and np.isclose(row0, np.round(row0), atol=1e-6)
+            ):
+                # Same pixels, shifted by whole pixels: plain window read
+                shifted = Window(int(np.round(col0)), int(np.round(row0)), *window[2:])
+                source = shifted.clip(*self.dim)
+                out = np.full(window.shape, np.nan)
+                if source is not None:
+                    out[source.slices(shifted)] = self.array_float(source, band)
+                return out
+
+        out = np.full(window.shape, np.nan)
+        finite = np.isfinite(cols) & np.isfinite(rows)
+        if not finite.any():
+            return out
+        source = Window(
+            int(np.floor(cols[finite].min())) - 1,
+            int(np.floor(rows[finite].min())) - 1,
+            int(np.ceil(cols[finite].max())) - int(np.floor(cols[finite].min())) + 3,
+            int(np.ceil(rows[finite].max())) - int(np.floor(rows[finite].min())) + 3,
+        ).clip(*self.dim)
+        if source is None:
+            return out
+        array = self.array_float(source, band)
+        # Points which could not be transformed fall outside of the array
+        coords = [np.where(finite, rows - source.yoff, -2), np.where(finite, cols - source.xoff, -2)]
+        ndimage.map_coordinates(
+            array, coords, output=out, order=order, mode="constant", cval=np.nan, prefilter=False
+        )
+        return out
+
+    def difference(self, other: "GeoRaster", output: Optional[str] = None, **kwargs):
+        """Difference self - other on the grid of self and its statistics
+
+        See `edef.processing.dem_difference.dem_difference`.
+        """
+        from edef.processing.dem_difference import dem_difference
+
+        return dem_difference(self, other, output, **kwargs)
+
+    def coregister(self, reference: "GeoRaster", method: str = "nuth_kaab", **kwargs):
+        """Rigid transform aligning this DEM onto a reference and its statistics
+
+        See `edef.processing.coregistration.coregister`, the transform is
+        applied lazily with `RigidTransform.apply_raster`.
+        """
+        from edef.processing.coregistration import coregister
+
+        return coregister(reference, self, method, **kwargs)
+
+    def cached(self, store: ChunkStore, method: str, *args, **kwargs):
+        """Result of a method of this raster, kept in a chunk store
+
+        The entry is keyed by the method name, this raster, `args` and
+        `kwargs`: an already stored result is read back lazily without
+        calling the method, otherwise only its missing chunks are computed
+        and stored when it is evaluated. See `ChunkStore.cached`.
 
-    def laplacien():
+        Arguments:
+            store: chunk store
+            method: name of a method returning a GeoRaster or a tuple of
+                GeoRaster (gradient, slope, gaussian_filter...)
+            args, kwargs: arguments of the method, also keys of the entry
+        """
+        return store.cached(
+            method,
+            [self, *args],
+            kwargs,
+            lambda: getattr(self, method)(*args, **kwargs),
+        )
+
+    def save(self, path: str, **kwargs):
+        """Write the raster chunk by chunk as a tiled and compressed GeoTiff
+
+        Arguments:
+            path: output path
+            kwargs: options of `edef.eobject.utils.gdal_utils.TiledWriter`
+                (compress, block_size, nodata, dtype, cog...)
+        """
+        write_dask(
+            path,
+            da.asarray(self.data),
+            geotransform=self.geotransform,
+            projection=self.projection or self.srs.ExportToWkt(),
+            **kwargs,
+        )
+
+    def pixel_spacing(self) -> Tuple[float, float]:
+        """Pixel size (x, y) in meters
+
+        For geographic coordinates, the size is taken at the center latitude.
+        """
+        _, dx, _, y0, _, dy = self.geotransform
+        if self.srs.IsGeographic():
+            lat = np.radians(y0 + dy * self.dim[1] / 2)
+            return abs(dx) * 111320 * np.cos(lat), abs(dy) * 110540
+        return abs(dx), abs(dy)
+
+    def terrain(
+        self, products: List[str], azimuth: float = 315.0, altitude: float = 45.0
+    ) -> Dict[str, "GeoRaster"]:
+        """Lazy terrain products sharing a single stencil pass
+
+        All products come from the same dask graph, computing them together
+        evaluates the finite differences only once per chunk.
+
+        Arguments:
+            products: product names, see `edef.eobject.utils.terrain.PRODUCTS`
+            azimuth: sun azimuth for the hillshade, in degrees from north
+            altitude: sun elevation for the hillshade, in degrees
+        """
+        engine = TerrainEngine(
+            *self.pixel_spacing(), products, azimuth, altitude, reuse=False
+        )
+        data = da.asarray(self.data)
+        if self.nodata() is not None:
+            # NaN voids propagate through the stencil instead of the nodata value
+            data = da.where(self._is_nodata(data), np.nan, data.astype(np.float64))
+        overlapped = da.overlap.overlap(data, depth=HALO, boundary="none")
+        stack = overlapped.map_blocks(
+            stack_block,
+            engine=engine,
+            new_axis=0,
+            chunks=((len(engine.products),),) + data.chunks,
+            dtype=np.float32,
+        )
+        return {
+            p: GeoRaster.from_array(stack[i], self)
+            for i, p in enumerate(engine.products)
+        }
+
+    def iter_terrain(
+        self, products: List[str], tile: int = 1024, **kwargs
+    ) -> Iterator[Tuple[Window, Dict[str, np.ndarray]]]:
+        """Terrain products computed tile by tile, see `TerrainEngine.run`
+
+        The yielded arrays are reused buffers, valid until the next tile.
+        """
+        engine = TerrainEngine(*self.pixel_spacing(), products, **kwargs)
+        return engine.run(self.array_float, (self.dim[1], self.dim[0]), tile)
+
+    def gradient(self) -> Tuple["GeoRaster", "GeoRaster"]:
+        """First derivative along x (east) and y (north)"""
+        t = self.terrain(["gradient_x", "gradient_y"])
+        return t["gradient_x"], t["gradient_y"]
+
+    def laplacien(self) -> "GeoRaster":
         """second derivative"""
-        pass
+        return self.terrain(["laplacian"])["laplacian"]
 
     def divergence():
         pass
@@ -53,31 +495,57 @@ class GeoRaster:
     def rotational():
         pass
 
-    def hessian():
-        pass
+    def hessian(self) -> Tuple["GeoRaster", "GeoRaster", "GeoRaster"]:
+        """Second derivatives xx, xy and yy"""
+        t = self.terrain(["hessian_xx", "hessian_xy", "hessian_yy"])
+        return t["hessian_xx"], t["hessian_xy"], t["hessian_yy"]
 
-    def slope():
-        """Get the slope at each pixel
+    def slope(self) -> "GeoRaster":
+        """Get the slope at each pixel, in degrees
         """
-        pass
+        return self.terrain(["slope"])["slope"]
 
-    def aspect():
+    def aspect(self) -> "GeoRaster":
         """Get the aspect at each pixel
-        """
-        pass
 
-    def hillshade():
-        """Create an hillshade view
+        Direction of the steepest descent, in degrees clockwise from north.
+        NaN on flat pixels.
         """
-        pass
+        return self.terrain(["aspect"])["aspect"]
+
+    def hillshade(self, azimuth: float = 315.0, altitude: float = 45.0) -> "GeoRaster":
+        """Create an hillshade view, in [0, 1]
 
-    def curvature():
+        Arguments:
+            azimuth: sun azimuth, in degrees from north
+            altitude: sun elevation, in degrees
         """
+        return self.terrain(["hillshade"], azimuth, altitude)["hillshade"]
+
+    def curvature(self, kind: str = "mean") -> "GeoRaster":
+        """Surface curvature, positive on convex shapes
+
+        Arguments:
+            kind: "mean", "profile" or "plan"
         """
-        pass
+        name = {
+            "mean": "curvature",
+            "profile": "profile_curvature",
+            "plan": "plan_curvature",
+        }[kind]
+        return self.terrain([name])[name]
 
-    def edges():
-        pass
+    def edges(self, threshold: Optional[float] = None, **kwargs) -> "GeoRaster":
+        """Sobel gradient magnitude, in unit of z per meter
+
+        Arguments:
+            threshold: return a 0 / 1 mask of the magnitudes above it if given
+            kwargs: options of `edef.eobject.utils.filters.filter_raster`
+        """
+        magnitude = filters.sobel_filter(self, **kwargs)
+        if threshold is None:
+            return magnitude
+        return GeoRaster.from_array((da.asarray(magnitude.data) > threshold).astype(np.uint8), self)
 
     def watershed():
         pass
@@ -93,11 +561,118 @@ class GeoRaster:
     def ramp_to():
         pass
 
-    def gaussian_filter():
-        pass
+    def gaussian_filter(
+        self, sigma: Union[float, Tuple[float, float]], truncate: float = 4.0, **kwargs
+    ) -> "GeoRaster":
+        """Gaussian smoothing ignoring nodata, computed tile by tile
 
-    def set_resolution():
-        pass
+        The result is lazy unless an `output` GeoTiff is given.
+
+        Arguments:
+            sigma: standard deviation of the kernel, in pixels
+            truncate: kernel radius, in number of sigma
+            kwargs: options of `edef.eobject.utils.filters.filter_raster`
+                (output, tile, workers, keep_nodata...)
+        """
+        return filters.gaussian_filter(self, sigma, truncate, **kwargs)
+
+    def median_filter(self, size: int, **kwargs) -> "GeoRaster":
+        """Median over a square window ignoring nodata, lazy unless an `output` is given"""
+        return filters.median_filter(self, size, **kwargs)
+
+    def convolve(self, kernel: np.ndarray, normalized: bool = True, **kwargs) -> "GeoRaster":
+        """Correlation with a custom kernel, see `edef.eobject.utils.filters.convolve`"""
+        return filters.convolve_filter(self, kernel, normalized, **kwargs)
+
+    def _pixel_size(self) -> float:
+        """Largest side of the pixels, in map units"""
+        return max(abs(self.geotransform[1]), abs(self.geotransform[5]))
+
+    def build_pyramid(self, method: str = "average", min_size: int = 256, **kwargs) -> Pyramid:
+        """Compute the decimated levels of the file, see `Pyramid.build`
+
+        Arguments:
+            method: "average", "nearest", "mode", "min" or "max"
+            min_size: size of the largest side of the coarsest level
+            kwargs: options of `Pyramid.build` (tile, workers, compress...)
+        """
+        if not self.path:
+            raise ValueError("Pyramids can only be built for rasters read from a file")
+        self.pyramid = Pyramid.build(self.path, method, min_size, **kwargs)
+        return self.pyramid
+
+    def overview(self, resolution: float) -> "GeoRaster":
+        """Coarsest level of the pyramid whose pixels are not larger than the resolution
+
+        The raster itself is returned when there is no pyramid or no level
+        coarse enough.
+        """
+        if self.pyramid is None:
+            return self
+        factor = self.pyramid.factor_for(resolution / self._pixel_size())
+        if factor == 1:
+            return self
+        return GeoRaster.from_file(self.pyramid.paths[factor])
+
+    def set_resolution(self, resolution: float, order: int = 1) -> "GeoRaster":
+        """Lazy raster resampled to a new pixel size, on the same extent
+
+        The pixels are interpolated from the closest finer level of the
+        pyramid, when there is one.
+
+        Arguments:
+            resolution: pixel size, in map units
+            order: resampling, 0 for nearest neighbour, 1 for bilinear
+        """
+        from edef.processing.mosaic import align
+
+        x0, dx, _, y0, _, dy = self.geotransform
+        width = max(1, int(round(self.dim[0] * abs(dx) / resolution)))
+        height = max(1, int(round(self.dim[1] * abs(dy) / resolution)))
+        grid = GeoRaster.from_grid(
+            (x0, np.sign(dx) * resolution, 0, y0, 0, np.sign(dy) * resolution),
+            width,
+            height,
+            self.srs if self.projection else None,
+        )
+        return align([self.overview(resolution)], grid, order)[0]
+
+    def preview(self, max_size: int = 1024, kind: str = "amplitude", band: int = 1) -> "GeoRaster":
+        """Quick look of the whole raster, at most `max_size` pixels wide
+
+        Only the level of the pyramid closest to the size is read.
+
+        Arguments:
+            max_size: largest side of the preview, in pixels
+            kind: "amplitude" (values stretched from the 2nd to the 98th
+                percentile to [0, 1]), "hillshade" (in [0, 1]) or "raw"
+            band: band number, starting at 1
+        """
+        if kind not in ["amplitude", "hillshade", "raw"]:
+            raise ValueError(f"Unknown preview {kind}")
+        resolution = max(self.dim) * self._pixel_size() / max_size
+        level = self.overview(resolution)
+        array = level.array_float(Window(0, 0, *level.dim), band)
+        factor = -(-max(level.dim) // max_size)
+        if factor > 1:
+            array = decimate(array, factor, "average")
+        x0, dx, _, y0, _, dy = level.geotransform
+        geotransform = (x0, dx * factor, 0, y0, 0, dy * factor)
+
+        if kind == "amplitude":
+            low, high = np.nanpercentile(array, [2, 98]) if np.isfinite(array).any() else (0, 1)
+            array = np.clip((array - low) / max(high - low, 1e-12), 0, 1)
+        elif kind == "hillshade":
+            dx_m, dy_m = level.pixel_spacing()
+            engine = TerrainEngine(dx_m * factor, dy_m * factor, ["hillshade"], reuse=False)
+            array = engine.compute(pad_edges(array, True, True, True, True))["hillshade"]
+        return GeoRaster.from_grid(
+            geotransform,
+            array.shape[1],
+            array.shape[0],
+            self.srs if self.projection else None,
+            array.astype(np.float32),
+        )
 
     def set_spatial_coverage():
         pass
@@ -106,11 +681,27 @@ class GeoRaster:
         pass
 
 
-def r_align():
-    """Padd the array for pixel correspondance"""
-    pass
+def r_align(rasters: List[Union[str, GeoRaster]], **kwargs) -> List[GeoRaster]:
+    """Lazy rasters resampled on a common grid, see `edef.processing.mosaic.align`"""
+    from edef.processing.mosaic import align
+
+    return align(rasters, **kwargs)
+
+
+def r_mosaicking(
+    rasters: List[Union[str, GeoRaster]],
+    method: str = "first",
+    output: Optional[str] = None,
+    **kwargs,
+) -> GeoRaster:
+    """Merge rasters tile by tile, see `edef.processing.mosaic.Mosaic`
 
+    Arguments:
+        rasters: input rasters, paths or rasters
+        method: blending method, "first", "last", "mean", "median" or "feather"
+        output: output GeoTiff, the mosaic is kept in memory if None
+        kwargs: options of `Mosaic`
+    """
+    from edef.processing.mosaic import Mosaic
 
-def r_mosaicking():
-    """Merging"""
-    pass
+    return Mosaic(rasters, method, **kwargs).run(output)
@@ -1,15 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename, dirname, join
+from threading import Lock, local
+from typing import Dict, Iterator, Optional, Tuple
+import numpy as np
+import dask.array as da
+from edef.eobject.georaster import GeoRaster
+from edef.eobject.utils.gdal_utils import Window
+from edef.eobject.utils.pyramid import decimate
+from edef.eobject.utils.stats import ErrorStats
+
+
 class SpatialImage:
     def __init__(self):
         self.folder_path = ""
         self.file_name = ""
         self.x_dim = None
         self.y_dim = None
+        self.raster = None
+
+    @property
+    def path(self):
+        return join(self.folder_path, self.file_name)
 
     def from_file(self, path):
-        pass
+        self.folder_path = dirname(path)
+        self.file_name = basename(path)
+        self.raster = GeoRaster.from_file(path)
+        self.x_dim, self.y_dim = self.raster.dim
+        return self
 
     def to_file(self, path):
-        pass
+        self.raster.save(path)
 
 
 class RawImage(SpatialImage):
@@ -25,4 +46,224 @@ class CoregImage(SpatialImage):
 
 
 class CorrelationImage(SpatialImage):
-    pass
+    """Offsets between two images
+
+    Bands: east offset, north offset (map units), signal to noise ratio
+    """
+
+    bands = ["east", "north", "snr"]
+
+
+class DisparityStats:
+    """Statistics of the horizontal and vertical disparities of a map
+
+    Arguments:
+        bin_width: precision of the percentiles and histograms, in pixels
+        limit: disparities beyond +/- limit are counted at the limit
+    """
+
+    components = ["horizontal", "vertical"]
+
+    def __init__(self, bin_width: float = 0.05, limit: float = 2000.0):
+        self.stats = {c: ErrorStats(None, bin_width, limit) for c in self.components}
+        self.total = 0
+
+    @property
+    def valid(self) -> int:
+        return self.stats["horizontal"].stats.count
+
+    def update(self, dx: np.ndarray, dy: np.ndarray):
+        """Add the valid pixels of masked disparity blocks"""
+        self.total += dx.size
+        valid = ~np.ma.getmaskarray(dx)
+        self.stats["horizontal"].update(np.ma.getdata(dx)[valid])
+        self.stats["vertical"].update(np.ma.getdata(dy)[valid])
+
+    def merge(self, other: "DisparityStats"):
+        self.total += other.total
+        for c in self.components:
+            self.stats[c].merge(other.stats[c])
+
+    def percentile_range(
+        self, component: str, low: float = 2.0, high: float = 98.0
+    ) -> Tuple[float, float]:
+        """Disparities at two percentiles, the range of the previews"""
+        lo, hi = self.stats[component].sketch.quantiles([low / 100, high / 100])
+        return float(lo), float(hi)
+
+    def histogram(
+        self, component: str, bins: int = 256, low: float = 0.1, high: float = 99.9
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Counts and edges of a histogram between two percentiles
+
+        Computed from the sketch, without reading the map again.
+        """
+        sketch = self.stats[component].sketch
+        lo, hi = self.percentile_range(component, low, high)
+        if not np.isfinite(lo):
+            return np.zeros(bins, dtype=np.int64), np.linspace(0, 1, bins + 1)
+        hi = max(hi, lo + sketch.bin_width)
+        edges = np.linspace(lo, hi, bins + 1)
+        centers = -sketch.limit + (np.arange(sketch.counts.size) + 0.5) * sketch.bin_width
+        counts, _ = np.histogram(centers, edges, weights=sketch.counts)
+        return counts.astype(np.int64), edges
+
+    def summary(self) -> dict:
+        return {
+            "total": self.total,
+            "valid": self.valid,
+            "valid_fraction": self.valid / self.total if self.total else np.nan,
+        } | {c: self.stats[c].summary() for c in self.components}
+
+
+class DisparityImage(SpatialImage):
+    """ASP disparity map (-D.tif, -F.tif...) read in process
+
+    Bands: horizontal disparity, vertical disparity (pixels), validity.
+    Pixels with a null validity, non finite or nodata disparities are masked.
+    Replaces the band extraction and masking of `asp.disparitydebug` without
+    intermediate files.
+    """
+
+    bands = ["horizontal", "vertical", "valid"]
+
+    def from_file(self, path):
+        super().from_file(path)
+        if self.raster.reader.count < 2:
+            raise ValueError(f"{path} is not a disparity map, it has less than 2 bands")
+        return self
+
+    def _mask(self, dx: np.ndarray, dy: np.ndarray, valid: Optional[np.ndarray]) -> np.ndarray:
+        """Mask of the invalid pixels"""
+        mask = ~(np.isfinite(dx) & np.isfinite(dy))
+        nodata = self.raster.nodata()
+        if nodata is not None:
+            mask |= (dx == nodata) | (dy == nodata)
+        if valid is not None:
+            mask |= valid == 0
+        return mask
+
+    def read(self, window: Optional[Window] = None) -> Tuple[np.ma.MaskedArray, np.ma.MaskedArray]:
+        """Masked horizontal and vertical disparities of a window, the whole map if None"""
+        reader = self.raster.reader
+        if window is None:
+            window = reader.full_window()
+        dx, dy = reader.read(window, 1), reader.read(window, 2)
+        valid = reader.read(window, 3) if reader.count >= 3 else None
+        mask = self._mask(dx, dy, valid)
+        return np.ma.MaskedArray(dx, mask), np.ma.MaskedArray(dy, mask)
+
+    def to_dask(self, chunks: Optional[Tuple[int, int]] = None) -> Tuple[da.Array, da.Array]:
+        """Lazy masked horizontal and vertical disparities, chunked on the file blocks"""
+        dx, dy = self.raster.to_dask(1, chunks), self.raster.to_dask(2, chunks)
+        valid = self.raster.to_dask(3, chunks) if self.raster.reader.count >= 3 else None
+        mask = da.map_blocks(self._mask, dx, dy, valid, dtype=bool)
+        return da.ma.masked_array(dx, mask), da.ma.masked_array(dy, mask)
+
+    def iter_blocks(
+        self, tile: int = 1024
+    ) -> Iterator[Tuple[Window, np.ma.MaskedArray, np.ma.MaskedArray]]:
+        """Masked disparities, window by window"""
+        for window in self.raster.reader.iter_windows(tile, tile):
+            yield (window, *self.read(window))
+
+    def stats(
+        self,
+        tile: int = 1024,
+        workers: int = 4,
+        bin_width: float = 0.05,
+        limit: float = 2000.0,
+        preview_size: Optional[int] = None,
+    ) -> Tuple[DisparityStats, Dict[str, np.ndarray]]:
+        """Statistics, and optionally decimated disparities, in one read pass
+
+        Arguments:
+            tile: tile size in pixels
+            workers: number of threads
+            bin_width: precision of the percentiles and histograms, in pixels
+            limit: disparities beyond +/- limit are counted at the limit for
+                the percentiles and histograms
+            preview_size: largest side of the decimated disparities, none if None
+
+        Returns:
+            statistics and decimated disparities (NaN where invalid) by component
+        """
+        width, height = self.raster.dim
+        factor = 1 if preview_size is None else -(-max(width, height) // preview_size)
+        tile = -(-tile // factor) * factor
+        previews = {}
+        if preview_size is not None:
+            shape = (-(-height // factor), -(-width // factor))
+            previews = {
+                c: np.full(shape, np.nan, dtype=np.float32) for c in DisparityStats.components
+            }
+
+        states, states_lock = [], Lock()
+        thread = local()
+
+        def process(window: Window):
+            if not hasattr(thread, "stats"):
+                thread.stats = DisparityStats(bin_width, limit)
+                with states_lock:
+                    states.append(thread.stats)
+            dx, dy = self.read(window)
+            thread.stats.update(dx, dy)
+            for c, d in zip(DisparityStats.components, [dx, dy]):
+                if c in previews:
+                    small = decimate(d.filled(np.nan).astype(np.float64), factor, "average")
+                    y, x = window.yoff // factor, window.xoff // factor
+                    previews[c][y : y + small.shape[0], x : x + small.shape[1]] = small
+
+        windows = [
+            Window(x, y, tile, tile).clip(width, height)
+            for y in range(0, height, tile)
+            for x in range(0, width, tile)
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(process, windows))
+
+        stats = DisparityStats(bin_width, limit)
+        for s in states:
+            stats.merge(s)
+        return stats, previews
+
+    def preview(
+        self,
+        prefix: Optional[str] = None,
+        max_size: int = 1024,
+        low: float = 2.0,
+        high: float = 98.0,
+        **kwargs,
+    ) -> Tuple[DisparityStats, Dict[str, GeoRaster]]:
+        """Normalized previews of the disparities, as `asp.disparitydebug`
+
+        Disparities are decimated to `max_size` and stretched to [0, 1]
+        between the `low` and `high` percentiles, NaN where invalid. The map
+        is read once, for both the statistics and the previews.
+
+        Arguments:
+            prefix: previews are written to `<prefix>-H.tif` and `<prefix>-V.tif` if given
+            max_size: largest side of the previews, in pixels
+            low: percentile mapped to 0
+            high: percentile mapped to 1
+            kwargs: options of `stats` (tile, workers, bin_width, limit)
+        """
+        stats, small = self.stats(preview_size=max_size, **kwargs)
+        width, height = self.raster.dim
+        factor = -(-max(width, height) // max_size)
+        x0, dx, _, y0, _, dy = self.raster.geotransform
+        geotransform = (x0, dx * factor, 0, y0, 0, dy * factor)
+        previews = {}
+        for c, suffix in zip(DisparityStats.components, ["H", "V"]):
+            lo, hi = stats.percentile_range(c, low, high)
+            array = np.clip((small[c] - lo) / max(hi - lo, 1e-12), 0, 1).astype(np.float32)
+            previews[c] = GeoRaster.from_grid(
+                geotransform,
+                array.shape[1],
+                array.shape[0],
+                self.raster.srs if self.raster.projection else None,
+                array,
+            )
+            if prefix is not None:
+                previews[c].save(f"{prefix}-{suffix}.tif", nodata=np.nan)
+        return stats, previews
@@ -0,0 +1,82 @@
+# ASP point clouds (-PC.tif) read as arrays of points
+
+from typing import Iterator, Optional, Tuple
+import numpy as np
+
+from edef.eobject.utils.gdal_utils import BlockCache, BlockReader, Window
+from edef.eobject.utils.srs_utils import SrsLike, transform_points
+
+# Points of ASP clouds are cartesian coordinates centered on the Earth (WGS84)
+ECEF = 4978
+
+
+class PointCloud:
+    """ASP point cloud, a raster whose first three bands are point coordinates
+
+    Coordinates are stored relatively to the `POINT_OFFSET` of the file
+    metadata when it is set. Points whose three coordinates are null are
+    invalid. A fourth band, when present, is the triangulation error.
+
+    Arguments:
+        path: path to the -PC.tif file
+        srs: system of the coordinates, ECEF by default
+        cache: optional block cache
+    """
+
+    def __init__(self, path: str, srs: SrsLike = ECEF, cache: Optional[BlockCache] = None):
+        self.path = path
+        self.srs = srs
+        self.reader = BlockReader(path, cache)
+        if self.reader.count < 3:
+            raise ValueError(f"{path} is not a point cloud, it has less than 3 bands")
+        self.offset = self.point_offset(self.reader.dataset.GetMetadataItem("POINT_OFFSET"))
+
+    @staticmethod
+    def point_offset(value: Optional[str]) -> np.ndarray:
+        """Offset added to the stored coordinates, zero if not set"""
+        if not value:
+            return np.zeros(3)
+        return np.array([float(v) for v in value.replace(",", " ").split()][:3])
+
+    @property
+    def dim(self) -> Tuple[int, int]:
+        return self.reader.width, self.reader.height
+
+    def __len__(self):
+        return self.reader.width * self.reader.height
+
+    def read(
+        self, window: Optional[Window] = None, error: bool = False
+    ) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Valid points of a window, the whole cloud if None
+
+        Returns:
+            (N, 3) float64 coordinates, and the (N,) errors if asked and available
+        """
+        if window is None:
+            window = self.reader.full_window()
+        xyz = np.stack([self.reader.read(window, b) for b in (1, 2, 3)], axis=-1)
+        valid = np.any(xyz != 0, axis=-1) & np.all(np.isfinite(xyz), axis=-1)
+        points = xyz[valid].astype(np.float64)
+        points += self.offset
+        errors = None
+        if error and self.reader.count >= 4:
+            errors = self.reader.read(window, 4)[valid].astype(np.float64)
+        return points, errors
+
+    def iter_points(
+        self, tile: int = 1024, srs: Optional[SrsLike] = None
+    ) -> Iterator[Tuple[Window, np.ndarray]]:
+        """Valid points, tile by tile, reprojected to `srs` if given"""
+        for window in self.reader.iter_windows(tile, tile):
+            points, _ = self.read(window)
+            if srs is not None:
+                points = self.transform(points, srs)
+            yield window, points
+
+    def transform(self, points: np.ndarray, srs: SrsLike) -> np.ndarray:
+        """(N, 3) points of the cloud in another system, points which fail are dropped"""
+        if len(points) == 0:
+            return points
+        points = transform_points(points, self.srs, srs)
+        return points[np.all(np.isfinite(points), axis=1)]
@@ -0,0 +1,249 @@
+# Persistent catalog of the Pleiades products of an archive
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from fnmatch import fnmatch
+from os import scandir
+from os.path import abspath, dirname, join
+from threading import Lock
+from typing import Dict, List, Optional, Tuple, Union
+import json
+import sqlite3
+
+from edef.eobject.boundary import Bbox, BboxArray
+from edef.eobject.sats.pleiades import PleiadesDim
+from edef.eobject.spatial_index import SpatialIndex
+from edef.eobject.utils.srs_utils import to_srs
+
+COLUMNS = {
+    "dim_path": "TEXT PRIMARY KEY",
+    "folder": "TEXT",
+    "mtime_ns": "INTEGER",
+    "size": "INTEGER",
+    "name": "TEXT",
+    "mission": "TEXT",
+    "mode": "TEXT",
+    "time": "TEXT",
+    "xmin": "REAL",
+    "xmax": "REAL",
+    "ymin": "REAL",
+    "ymax": "REAL",
+    "ncols": "INTEGER",
+    "nrows": "INTEGER",
+    "nbands": "INTEGER",
+    "azimuth": "REAL",
+    "viewing_angle_across_track": "REAL",
+    "viewing_angle_along_track": "REAL",
+    "incidence_angle": "REAL",
+    "sun_azimuth": "REAL",
+    "sun_elevation": "REAL",
+    "gsd_across_track": "REAL",
+    "gsd_along_track": "REAL",
+    "images": "TEXT",
+    "error": "TEXT",
+}
+
+
+def scan_dims(roots: List[str], workers: int = 8) -> Dict[str, Tuple[int, int]]:
+    """Find the DIM files under archive roots, walking folders in parallel
+
+    Returns:
+        (mtime_ns, size) of each DIM file found
+    """
+    found = {}
+    lock = Lock()
+
+    def scan(folder):
+        subfolders = []
+        try:
+            entries = list(scandir(folder))
+        except (PermissionError, FileNotFoundError):
+            return subfolders
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subfolders.append(entry.path)
+            elif fnmatch(entry.name, "DIM_PHR*.XML"):
+                st = entry.stat()
+                with lock:
+                    found[abspath(entry.path)] = (st.st_mtime_ns, st.st_size)
+        return subfolders
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(scan, r) for r in roots}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending |= {pool.submit(scan, f) for f in future.result()}
+    return found
+
+
+def parse_dim(path: str) -> dict:
+    """Catalog fields of a product, the error message if it can not be parsed"""
+    try:
+        summary = PleiadesDim(path).summary()
+        summary["images"] = json.dumps(summary["images"])
+        return summary
+    except Exception as e:
+        return {"error": repr(e)}
+
+
+class Catalog:
+    """SQLite catalog of the Pleiades products found under archive roots
+
+    Each product is a row holding the fields needed to search the archive
+    (footprint in longitude / latitude, acquisition time, angles, GSD, sun
+    geometry, image files). `update` only parses the DIM files which are
+    new or whose modification time or size changed since the last update.
+
+    Arguments:
+        path: SQLite database file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        columns = ", ".join(f"{c} {t}" for c, t in COLUMNS.items())
+        with self.connection:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS products ({columns})")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS products_bounds ON products (xmin, xmax, ymin, ymax)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS products_time ON products (time)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+    def update(
+        self, roots: Union[str, List[str]], workers: int = 8, processes: Optional[int] = None
+    ) -> Dict[str, int]:
+        """Synchronize the catalog with the content of archive roots
+
+        Arguments:
+            roots: archive folders
+            workers: threads walking the folders
+            processes: processes parsing the DIM files, default to the cores
+
+        Returns:
+            number of products added, updated and removed
+        """
+        if isinstance(roots, str):
+            roots = [roots]
+        roots = [abspath(r) for r in roots]
+        found = scan_dims(roots, workers)
+
+        known = {}
+        for root in roots:
+            # Exact prefix: LIKE treats "_" as a wildcard and ignores the case
+            prefix = join(root, "")
+            rows = self.connection.execute(
+                "SELECT dim_path, mtime_ns, size FROM products"
+                " WHERE substr(dim_path, 1, length(?)) = ?",
+                (prefix, prefix),
+            )
+            known |= {r["dim_path"]: (r["mtime_ns"], r["size"]) for r in rows}
+
+        changed = [p for p, stat in found.items() if known.get(p) != stat]
+        removed = [p for p in known if p not in found]
+
+        rows = []
+        if changed:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                for path, fields in zip(changed, pool.map(parse_dim, changed, chunksize=16)):
+                    mtime_ns, size = found[path]
+                    rows.append(
+                        {c: None for c in COLUMNS}
+                        | fields
+                        | {"dim_path": path, "folder": dirname(path), "mtime_ns": mtime_ns, "size": size}
+                    )
+
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM products WHERE dim_path = ?", [(p,) for p in removed]
+            )
+            if rows:
+                names = ", ".join(COLUMNS)
+                values = ", ".join(f":{c}" for c in COLUMNS)
+                self.connection.executemany(
+                    f"INSERT OR REPLACE INTO products ({names}) VALUES ({values})", rows
+                )
+        return {
+            "added": sum(p not in known for p in changed),
+            "updated": sum(p in known for p in changed),
+            "removed": len(removed),
+        }
+
+    def query(
+        self,
+        bbox: Optional[Bbox] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        mode: Optional[str] = None,
+        max_incidence: Optional[float] = None,
+        covering: bool = False,
+    ) -> List[dict]:
+        """Products matching all the given criteria
+
+        Arguments:
+            bbox: area of interest, reprojected to longitude / latitude if needed
+            start: earliest acquisition time
+            end: latest acquisition time
+            mode: spectral processing ("P", "MS", "PMS"...)
+            max_incidence: maximum incidence angle, in degrees
+            covering: products containing the whole bbox instead of intersecting it
+        """
+        where, params = ["error IS NULL"], []
+        if bbox is not None:
+            if bbox.srs is not None:
+                bbox = bbox.reproject(4326)
+            where.append("xmin <= ? AND xmax >= ? AND ymin <= ? AND ymax >= ?")
+            if covering:
+                params += [bbox.xmin, bbox.xmax, bbox.ymin, bbox.ymax]
+            else:
+                params += [bbox.xmax, bbox.xmin, bbox.ymax, bbox.ymin]
+        if start is not None:
+            where.append("time >= ?")
+            params.append(start.strftime("%Y-%m-%dT%H:%M:%S"))
+        if end is not None:
+            where.append("time <= ?")
+            params.append(end.strftime("%Y-%m-%dT%H:%M:%S.999999Z"))
+        if mode is not None:
+            where.append("mode = ?")
+            params.append(mode)
+        if max_incidence is not None:
+            where.append("incidence_angle <= ?")
+            params.append(max_incidence)
+        rows = self.connection.execute(
+            f"SELECT * FROM products WHERE {' AND '.join(where)} ORDER BY time", params
+        )
+        return [self._record(r) for r in rows]
+
+    def errors(self) -> Dict[str, str]:
+        """Products which could not be parsed"""
+        rows = self.connection.execute(
+            "SELECT dim_path, error FROM products WHERE error IS NOT NULL"
+        )
+        return {r["dim_path"]: r["error"] for r in rows}
+
+    def spatial_index(self) -> SpatialIndex:
+        """Index of the product footprints, ids are the DIM paths"""
+        rows = self.connection.execute(
+            "SELECT dim_path, xmin, xmax, ymin, ymax FROM products WHERE error IS NULL"
+        ).fetchall()
+        bounds = BboxArray([tuple(r)[1:] for r in rows], to_srs(4326))
+        return SpatialIndex.build(bounds, [r["dim_path"] for r in rows])
+
+    @staticmethod
+    def _record(row: sqlite3.Row) -> dict:
+        record = dict(row)
+        record["images"] = json.loads(record["images"])
+        return record
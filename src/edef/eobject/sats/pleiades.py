@@ -1,84 +1,323 @@
 import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from functools import cached_property
 from os import listdir
 from os.path import join, dirname, basename, splitext, isdir
 from fnmatch import fnmatch
-import xmltodict
 from datetime import datetime
+from typing import Dict, Iterable, List, Optional
 
 from edef.eobject.boundary import Bbox
+from edef.eobject.sats.rpc import RpcModel
+from edef.eobject.utils.srs_utils import to_srs
+
+
+def select_records(path: str, specs: Dict[str, tuple]) -> Dict[str, List[dict]]:
+    """Extract a few fields from an XML file in a single streaming pass
+
+    Each spec is (record_path, fields): `record_path` is the path of the
+    repeated element from the document root, `fields` maps names to paths
+    relative to the record. A path ending with `@attr` reads an attribute,
+    `..@attr` reads an attribute of the parent of the record. Elements are
+    cleared as soon as they are closed and the parsing stops once all the
+    requested sections are read.
+
+    Returns:
+        list of the records found for each spec, as dicts of strings
+    """
+    records = {name: [] for name in specs}
+    record_paths = {tuple(s[0].split("/")): name for name, s in specs.items()}
+    sections = {p[0] for p in record_paths}
+    stack, elems, current = [], [], {}
+
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        tag = elem.tag.rsplit("}", 1)[-1]
+        if event == "start":
+            stack.append(tag)
+            elems.append(elem)
+            name = record_paths.get(tuple(stack[1:]))
+            if name is not None:
+                values = {}
+                for field, field_path in specs[name][1].items():
+                    if field_path.startswith("..@"):
+                        values[field] = elems[-2].get(field_path[3:])
+                current[name] = (len(stack), values)
+            continue
+
+        for name, (depth, values) in current.items():
+            rel = "/".join(stack[depth:])
+            for field, field_path in specs[name][1].items():
+                node, _, attr = field_path.partition("@")
+                if node == rel:
+                    values[field] = elem.get(attr) if attr else (elem.text or "").strip()
+        name = record_paths.get(tuple(stack[1:]))
+        if name is not None:
+            depth, values = current.pop(name)
+            records[name].append(values)
+        if len(stack) == 2:
+            # End of a top level section
+            elem.clear()
+            sections.discard(tag)
+            if not sections:
+                break
+        stack.pop()
+        elems.pop()
+        if len(stack) >= 2 and not current:
+            elem.clear()
+    return records
+
+
+@dataclass(slots=True)
+class DataFile:
+    """Image file of a product, one per tile (and per band for separate bands)"""
+
+    path: str
+    tile_row: int = 1
+    tile_col: int = 1
+    band: Optional[int] = None
+
+
+@dataclass(slots=True)
+class PleiadesGeometry:
+    """Viewing and solar geometry at a location of the product (Top, Center, Bottom)"""
+
+    location: str
+    time: str
+    azimuth: float
+    viewing_angle_across_track: float
+    viewing_angle_along_track: float
+    viewing_angle: float
+    incidence_angle_across_track: float
+    incidence_angle_along_track: float
+    incidence_angle: float
+    sun_azimuth: float
+    sun_elevation: float
+    gsd_across_track: float
+    gsd_along_track: float
 
+    @staticmethod
+    def from_record(record: dict):
+        values = {
+            k: v if k in ["location", "time"] else float(v) for k, v in record.items()
+        }
+        return PleiadesGeometry(**values)
 
-class PleiadesDim:
-    def __init__(self, dim_path):
-        self.path = dim_path
-        dim_dict = xmltodict.parse(self.path)
-        self.dimap = Dimap(dim_dict)
+    def roll(self):
+        return self.viewing_angle_across_track
+
+    def pitch(self):
+        return self.viewing_angle_along_track
+
+    def combined(self):
+        return self.viewing_angle
+
+    def datetime(self):
+        return datetime.strptime(self.time, "%Y-%m-%dT%H:%M:%S.%fZ")
 
-        self.img_paths = ""
-        self.bbox = []
-        self.top_angles = None
-        self.center_angles = None
-        self.bottom_angles = None
+
+_ANGLES = "Acquisition_Angles/"
+_SUN = "Solar_Incidences/"
+_GSD = "Ground_Sample_Distance/"
 
 
 class Dimap:
-    supported_version = "2.15"
+    """Selective reader of a DIMAP v2 file
+
+    Only the fields listed in `SECTIONS` are extracted and each section is
+    parsed on first access, see `load` to read several sections in a
+    single pass.
 
-    def __init__(self, dim_dict: dict):
-        dim = dim_dict["Dimap_Document"]
-        self.metadata_identification = dim["Metadata_Identification"]
-        self.dataset_identification = dim["Dataset_Identification"]
-        self.dataset_content = dim["Dataset_Content"]
-        self.product_information = dim["Product_Information"]
-        self.coordinate_reference_system = dim["Coordinate_Reference_System"]
-        self.geoposition = dim["Geoposition"]
-        self.processing_information = dim["Processing_Information"]
-        self.raster_data = dim["Raster_Data"]
-        self.radiometric_data = dim["Radiometric_Data"]
-        self.geometric_data = dim["Geometric_Data"]
-        self.quality_assessment = dim["Quality_Assessment"]
-        self.dataset_sources = dim["Dataset_sources"]
+    Arguments:
+        path: path of the DIM_PHR*.XML file
+    """
+
+    supported_version = "2.15"
 
+    SECTIONS = {
+        "metadata": ("Metadata_Identification", {"version": "METADATA_FORMAT@version"}),
+        "identification": ("Dataset_Identification", {"name": "DATASET_NAME"}),
+        "vertices": (
+            "Dataset_Content/Dataset_Extent/Vertex",
+            {"lon": "LON", "lat": "LAT", "row": "ROW", "col": "COL"},
+        ),
+        "rpc": (
+            "Geoposition/Geoposition_Models/Rational_Function_Model/Component",
+            {"path": "COMPONENT_PATH@href"},
+        ),
+        "product_settings": (
+            "Processing_Information/Product_Settings",
+            {"mode": "SPECTRAL_PROCESSING"},
+        ),
+        "dimensions": (
+            "Raster_Data/Raster_Dimensions",
+            {"nrows": "NROWS", "ncols": "NCOLS", "nbands": "NBANDS"},
+        ),
+        "data_files": (
+            "Raster_Data/Data_Access/Data_Files/Data_File",
+            {
+                "path": "DATA_FILE_PATH@href",
+                "tile_row": "@tile_R",
+                "tile_col": "@tile_C",
+                "band": "@band_index",
+                "files_band": "..@band_index",
+            },
+        ),
+        "geometries": (
+            "Geometric_Data/Use_Area/Located_Geometric_Values",
+            {
+                "location": "LOCATION_TYPE",
+                "time": "TIME",
+                "azimuth": _ANGLES + "AZIMUTH_ANGLE",
+                "viewing_angle_across_track": _ANGLES + "VIEWING_ANGLE_ACROSS_TRACK",
+                "viewing_angle_along_track": _ANGLES + "VIEWING_ANGLE_ALONG_TRACK",
+                "viewing_angle": _ANGLES + "VIEWING_ANGLE",
+                "incidence_angle_across_track": _ANGLES + "INCIDENCE_ANGLE_ACROSS_TRACK",
+                "incidence_angle_along_track": _ANGLES + "INCIDENCE_ANGLE_ALONG_TRACK",
+                "incidence_angle": _ANGLES + "INCIDENCE_ANGLE",
+                "sun_azimuth": _SUN + "SUN_AZIMUTH",
+                "sun_elevation": _SUN + "SUN_ELEVATION",
+                "gsd_across_track": _GSD + "GSD_ACROSS_TRACK",
+                "gsd_along_track": _GSD + "GSD_ALONG_TRACK",
+            },
+        ),
+        "source": (
+            "Dataset_Sources/Source_Identification/Strip_Source",
+            {"mission": "MISSION", "mission_index": "MISSION_INDEX", "date": "IMAGING_DATE"},
+        ),
+    }
+
+    def __init__(self, path: str):
+        self.path = path
+        self._records: Dict[str, List[dict]] = {}
         self.__check_version()
 
+    def load(self, sections: Iterable[str]):
+        """Parse the sections not read yet, in a single pass"""
+        missing = {s: Dimap.SECTIONS[s] for s in sections if s not in self._records}
+        if missing:
+            self._records |= select_records(self.path, missing)
+
+    def records(self, section: str) -> List[dict]:
+        self.load([section])
+        return self._records[section]
+
     def __check_version(self):
-        if self.metadata_identification["METADAT_FORMAT"]["@version"] != "2.15":
+        metadata = self.records("metadata")
+        if not metadata or metadata[0].get("version") != Dimap.supported_version:
             raise Exception(
                 "Dimap format not supported. Unexpected behaviour can occur."
             )
 
+    @cached_property
+    def name(self) -> str:
+        return self.records("identification")[0]["name"]
+
+    @cached_property
+    def mode(self) -> str:
+        return self.records("product_settings")[0]["mode"]
+
+    @cached_property
+    def dimensions(self) -> Dict[str, int]:
+        return {k: int(v) for k, v in self.records("dimensions")[0].items()}
+
+    @cached_property
+    def vertices(self) -> List[tuple]:
+        """(lon, lat) of the corners of the product"""
+        return [(float(v["lon"]), float(v["lat"])) for v in self.records("vertices")]
+
+    @cached_property
+    def data_files(self) -> List[DataFile]:
+        files = []
+        for r in self.records("data_files"):
+            band = r["band"] or r["files_band"]
+            files.append(
+                DataFile(
+                    join(dirname(self.path), r["path"]),
+                    int(r["tile_row"] or 1),
+                    int(r["tile_col"] or 1),
+                    int(band) if band else None,
+                )
+            )
+        return files
 
-class PleiadesGeometry:
-    def __init__(self, geom_dict: dict):
-        self.time = geom_dict["TIME"]
-        self.geometric_gliding = geom_dict["GEOMETRIC_GLIDING"]
-        angles = geom_dict["Acquisition_Angles"]
-        self.azimuth = angles["AZIMUTH_ANGLE"]
-        self.viewing_angle_across_track = angles["VIEWING_ANGLE_ACROSS_TRACK"]
-        self.viewing_angle_along_track = angles["VIEWING_ANGLE_ALONG_TRACK"]
-        self.viewing_angle = angles["VIEWING_ANGLE"]
-        self.incidence_angle_across_track = angles["INCIDENCE_ANGLE_ACROSS_TRACK"]
-        self.incidence_angle_along_track = angles["INCIDENCE_ANGLE_ALONG_TRACK"]
-        self.incidence_angle = angles["INCIDENCE_ANGLE"]
-        self.sun_azimuth = geom_dict["Solar_Incidences"]["SUN_AZIMUTH"]
-        self.sun_elevation = geom_dict["Solar_Incidences"]["SUN_ELEVATION"]
-        self.gsd_across_track = geom_dict["Ground_Sample_Distance"]["GSD_ACROSS_TRACK"]
-        self.gsd_along_track = geom_dict["Ground_Sample_Distance"]["GSD_ALONG_TRACK"]
-
-    def azimuth(self):
-        return self.azimuth
+    @cached_property
+    def geometries(self) -> Dict[str, PleiadesGeometry]:
+        """Geometry of each location type (Top, Center, Bottom)"""
+        return {
+            r["location"]: PleiadesGeometry.from_record(r) for r in self.records("geometries")
+        }
 
-    def roll(self):
-        return self.viewing_angle_across_track
+    @cached_property
+    def mission(self) -> str:
+        source = self.records("source")[0]
+        return f"{source['mission']}{source['mission_index']}"
 
-    def pitch(self):
-        return self.viewing_angle_along_track
+    @cached_property
+    def rpc_path(self) -> Optional[str]:
+        rpc = self.records("rpc")
+        return join(dirname(self.path), rpc[0]["path"]) if rpc else None
 
-    def combined(self):
-        return self.viewing_angle
 
-    def time(self):
-        return datetime.strptime(self.time, "%Y-%m-%dT%H:%M:%S.%fZ")
+class PleiadesDim:
+    def __init__(self, dim_path):
+        self.path = dim_path
+        self.dimap = Dimap(self.path)
+
+    @property
+    def img_paths(self):
+        return [f.path for f in self.dimap.data_files]
+
+    @cached_property
+    def bbox(self):
+        bbox = Bbox.from_points(self.dimap.vertices)
+        bbox.srs = to_srs(4326)
+        return bbox
+
+    @cached_property
+    def rpc(self) -> RpcModel:
+        if self.dimap.rpc_path is None:
+            raise ValueError(f"No RPC model referenced in {self.path}")
+        return RpcModel.from_file(self.dimap.rpc_path)
+
+    @property
+    def top_angles(self):
+        return self.dimap.geometries.get("Top")
+
+    @property
+    def center_angles(self):
+        return self.dimap.geometries.get("Center")
+
+    @property
+    def bottom_angles(self):
+        return self.dimap.geometries.get("Bottom")
+
+    def summary(self) -> dict:
+        """Fields of the product used to search an archive"""
+        self.dimap.load(
+            ["identification", "vertices", "product_settings", "dimensions"]
+            + ["data_files", "geometries", "source"]
+        )
+        center = self.center_angles
+        return {
+            "name": self.dimap.name,
+            "mission": self.dimap.mission,
+            "mode": self.dimap.mode,
+            "time": center.time,
+            "xmin": self.bbox.xmin,
+            "xmax": self.bbox.xmax,
+            "ymin": self.bbox.ymin,
+            "ymax": self.bbox.ymax,
+            **self.dimap.dimensions,
+            "azimuth": center.azimuth,
+            "viewing_angle_across_track": center.viewing_angle_across_track,
+            "viewing_angle_along_track": center.viewing_angle_along_track,
+            "incidence_angle": center.incidence_angle,
+            "sun_azimuth": center.sun_azimuth,
+            "sun_elevation": center.sun_elevation,
+            "gsd_across_track": center.gsd_across_track,
+            "gsd_along_track": center.gsd_along_track,
+            "images": self.img_paths,
+        }
 
 
 class Pleiades:
@@ -103,10 +342,10 @@ class Pleiades:
 
     @staticmethod
     def __check_paths(paths):
-        if paths is str:
+        if isinstance(paths, str):
             paths = [paths]
 
-        if paths is list and paths:
+        if isinstance(paths, list) and 0 < len(paths) <= 3:
             if all([isdir(p) for p in paths]):
                 return paths, Pleiades.__acquisition_type[len(paths) - 1]
             else:
@@ -133,6 +372,24 @@ class Pleiades:
             all_dims.append(basename(dim[0]))
         return all_dims
 
+    def dim_paths(self):
+        """Full path of the DIM file of each view"""
+        return [join(p, d) for p, d in zip(self.folder_paths, self.dim_files)]
+
+    def image_paths(self):
+        """Image tiles (`IMG_PHR*_R*C*`) of each view"""
+        all_imgs = []
+        for p in self.folder_paths:
+            imgs = sorted(
+                join(p, f)
+                for f in listdir(p)
+                if fnmatch(f, "IMG_PHR*.TIF") or fnmatch(f, "IMG_PHR*.JP2")
+            )
+            if not imgs:
+                raise ValueError(f"No image found in the Pleiades folder {p}")
+            all_imgs.append(imgs)
+        return all_imgs
+
 
 def ortho_from_pleiades(raw: Pleiades):
     pass
@@ -0,0 +1,357 @@
+# Rational polynomial camera model (RPC00B) evaluated on arrays of points
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Tuple, Union
+import xml.etree.ElementTree as ET
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+from edef.eobject.boundary import Bbox
+from edef.eobject.georaster import GeoRaster
+from edef.eobject.utils.srs_utils import srs_key, to_srs, transform_points
+
+# Points evaluated per batch, bounds the memory of the (20, N) monomials
+CHUNK = 2**18
+
+SCALES = [
+    "LONG_OFF",
+    "LONG_SCALE",
+    "LAT_OFF",
+    "LAT_SCALE",
+    "HEIGHT_OFF",
+    "HEIGHT_SCALE",
+    "LINE_OFF",
+    "LINE_SCALE",
+    "SAMP_OFF",
+    "SAMP_SCALE",
+]
+
+
+def monomials(x: np.ndarray, y: np.ndarray, z: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """(20, N) terms of a cubic RPC polynomial in the RPC00B order"""
+    t = np.empty((20, x.size)) if out is None else out[:, : x.size]
+    t[0] = 1
+    t[1], t[2], t[3] = x, y, z
+    np.multiply(x, y, out=t[4])
+    np.multiply(x, z, out=t[5])
+    np.multiply(y, z, out=t[6])
+    np.multiply(x, x, out=t[7])
+    np.multiply(y, y, out=t[8])
+    np.multiply(z, z, out=t[9])
+    np.multiply(t[4], z, out=t[10])
+    np.multiply(t[7], x, out=t[11])
+    np.multiply(x, t[8], out=t[12])
+    np.multiply(x, t[9], out=t[13])
+    np.multiply(t[7], y, out=t[14])
+    np.multiply(t[8], y, out=t[15])
+    np.multiply(y, t[9], out=t[16])
+    np.multiply(t[7], z, out=t[17])
+    np.multiply(t[8], z, out=t[18])
+    np.multiply(t[9], z, out=t[19])
+    return t
+
+
+def _derivative(terms: list) -> np.ndarray:
+    """(20, 20) matrix mapping the coefficients of a polynomial to its derivative"""
+    d = np.zeros((20, 20))
+    for k, j, factor in terms:
+        d[k, j] = factor
+    return d
+
+
+# Derivatives of the terms along x and y, as (term, derivative term, factor)
+DX = _derivative(
+    [(1, 0, 1), (4, 2, 1), (5, 3, 1), (7, 1, 2), (10, 6, 1),
+     (11, 7, 3), (12, 8, 1), (13, 9, 1), (14, 4, 2), (17, 5, 2)]
+)
+DY = _derivative(
+    [(2, 0, 1), (4, 1, 1), (6, 3, 1), (8, 2, 2), (10, 5, 1),
+     (12, 4, 2), (14, 7, 1), (15, 8, 3), (16, 9, 1), (18, 6, 2)]
+)
+
+
+def _chunks(n: int):
+    for start in range(0, n, CHUNK):
+        yield slice(start, min(start + CHUNK, n))
+
+
+class DemSampler:
+    """Bilinear sampling of a DEM at longitude / latitude points
+
+    Arguments:
+        dem: DEM raster, in any projection
+        bbox: area read from the DEM, whole DEM if None
+    """
+
+    def __init__(self, dem: GeoRaster, bbox: Optional[Bbox] = None):
+        self.dem = dem
+        window = dem.reader.full_window() if dem.reader is not None else None
+        if bbox is not None:
+            if bbox.srs is not None:
+                bbox = bbox.reproject(dem.srs)
+            window = dem.bbox_to_window(bbox.pad_ratio(0.05))
+            if window is None:
+                raise ValueError("The DEM does not cover the requested area")
+        if window is None:
+            self.xoff = self.yoff = 0
+            self.array = np.asarray(dem.compute(), dtype=np.float64)
+        else:
+            self.xoff, self.yoff = window.xoff, window.yoff
+            self.array = np.asarray(dem.array_view(window), dtype=np.float64)
+        nodata = dem.reader.nodata if dem.reader is not None else None
+        if nodata is not None:
+            self.array[self.array == nodata] = np.nan
+
+    def __call__(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        """Heights at the points, NaN outside of the DEM"""
+        points = np.stack([lon.ravel(), lat.ravel()], axis=1)
+        pixels = self.dem.xy_to_pixel(points, to_srs(4326))
+        # Pixel centers are at half integers of the geotransform
+        rows = pixels[:, 1] - 0.5 - self.yoff
+        cols = pixels[:, 0] - 0.5 - self.xoff
+        h = map_coordinates(self.array, [rows, cols], order=1, cval=np.nan, prefilter=False)
+        return h.reshape(lon.shape)
+
+
+@dataclass
+class RpcModel:
+    """Rational polynomial camera model
+
+    Image coordinates are 0-based (col, row) with the center of the first
+    pixel at (0, 0), ground coordinates are longitude / latitude in degrees
+    and ellipsoidal height in meters.
+
+    Attributes:
+        line_num, line_den, samp_num, samp_den: (20,) coefficients (RPC00B order)
+        *_off, *_scale: normalization of each coordinate
+    """
+
+    line_num: np.ndarray
+    line_den: np.ndarray
+    samp_num: np.ndarray
+    samp_den: np.ndarray
+    lon_off: float
+    lon_scale: float
+    lat_off: float
+    lat_scale: float
+    height_off: float
+    height_scale: float
+    line_off: float
+    line_scale: float
+    samp_off: float
+    samp_scale: float
+
+    @staticmethod
+    def from_file(path: str):
+        """Read the ground to image model of a Pleiades `RPC_PHR*.XML` file
+
+        Pleiades offsets are 1-based, they are shifted to the 0-based pixel
+        convention.
+        """
+        root = ET.parse(path).getroot()
+        inverse = root.find(".//Inverse_Model")
+        validity = root.find(".//RFM_Validity")
+        if inverse is None or validity is None:
+            raise ValueError(f"No RPC inverse model found in {path}")
+
+        def coeffs(prefix):
+            return np.array([float(inverse.findtext(f"{prefix}_{i}")) for i in range(1, 21)])
+
+        scales = [float(validity.findtext(k)) for k in SCALES]
+        scales[6] -= 1  # LINE_OFF
+        scales[8] -= 1  # SAMP_OFF
+        return RpcModel(
+            coeffs("LINE_NUM_COEFF"),
+            coeffs("LINE_DEN_COEFF"),
+            coeffs("SAMP_NUM_COEFF"),
+            coeffs("SAMP_DEN_COEFF"),
+            *scales,
+        )
+
+    @staticmethod
+    def from_metadata(rpc: dict):
+        """Model from the RPC metadata domain of a GDAL dataset (0-based already)"""
+
+        def coeffs(key):
+            return np.array([float(v) for v in rpc[key].split()])
+
+        return RpcModel(
+            coeffs("LINE_NUM_COEFF"),
+            coeffs("LINE_DEN_COEFF"),
+            coeffs("SAMP_NUM_COEFF"),
+            coeffs("SAMP_DEN_COEFF"),
+            *[float(rpc[k].split()[0]) for k in SCALES],
+        )
+
+    @property
+    def _coeffs(self) -> np.ndarray:
+        return np.stack([self.samp_num, self.samp_den, self.line_num, self.line_den])
+
+    def _normalize_ground(self, lon, lat, h):
+        return (
+            (np.asarray(lon, dtype=np.float64) - self.lon_off) / self.lon_scale,
+            (np.asarray(lat, dtype=np.float64) - self.lat_off) / self.lat_scale,
+            (np.asarray(h, dtype=np.float64) - self.height_off) / self.height_scale,
+        )
+
+    def ground_to_image(self, lon, lat, h) -> Tuple[np.ndarray, np.ndarray]:
+        """Image (col, row) of ground points, arrays of any shape"""
+        x, y, z = np.broadcast_arrays(*self._normalize_ground(lon, lat, h))
+        shape = x.shape
+        x, y, z = x.ravel(), y.ravel(), z.ravel()
+        col, row = np.empty(x.size), np.empty(x.size)
+        coeffs = self._coeffs
+        terms = np.empty((20, min(CHUNK, x.size)))
+        for s in _chunks(x.size):
+            sn, sd, ln, ld = coeffs @ monomials(x[s], y[s], z[s], terms)
+            col[s] = sn / sd
+            row[s] = ln / ld
+        col = col * self.samp_scale + self.samp_off
+        row = row * self.line_scale + self.line_off
+        return col.reshape(shape), row.reshape(shape)
+
+    def image_to_ground(
+        self, col, row, h, max_iter: int = 10, tol: float = 1e-10
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """(lon, lat) of image points at given heights, by Newton iterations
+
+        Arguments:
+            col, row: image coordinates
+            h: heights of the points
+            max_iter: maximum number of iterations
+            tol: convergence threshold on the normalized ground coordinates
+        """
+        col, row, h = np.broadcast_arrays(
+            np.asarray(col, dtype=np.float64),
+            np.asarray(row, dtype=np.float64),
+            np.asarray(h, dtype=np.float64),
+        )
+        shape = col.shape
+        u = (col.ravel() - self.samp_off) / self.samp_scale
+        v = (row.ravel() - self.line_off) / self.line_scale
+        z = (h.ravel() - self.height_off) / self.height_scale
+        x, y = np.zeros(u.size), np.zeros(u.size)
+        # Values and derivatives along x and y of the 4 polynomials
+        coeffs = self._coeffs
+        coeffs = np.concatenate([coeffs, coeffs @ DX, coeffs @ DY])
+        terms = np.empty((20, min(CHUNK, u.size)))
+
+        for s in _chunks(u.size):
+            xs, ys, zs, us, vs = x[s], y[s], z[s], u[s], v[s]
+            for _ in range(max_iter):
+                sn, sd, ln, ld, dsn, dsd, dln, dld, esn, esd, eln, eld = coeffs @ monomials(
+                    xs, ys, zs, terms
+                )
+                fu, fv = sn / sd - us, ln / ld - vs
+                # Jacobian of (samp, line) along (x, y), quotient rule
+                a = (dsn * sd - sn * dsd) / sd**2
+                b = (esn * sd - sn * esd) / sd**2
+                c = (dln * ld - ln * dld) / ld**2
+                d = (eln * ld - ln * eld) / ld**2
+                det = a * d - b * c
+                dx = (d * fu - b * fv) / det
+                dy = (a * fv - c * fu) / det
+                xs -= dx
+                ys -= dy
+                if max(np.abs(dx).max(initial=0), np.abs(dy).max(initial=0)) < tol:
+                    break
+        lon = x * self.lon_scale + self.lon_off
+        lat = y * self.lat_scale + self.lat_off
+        return lon.reshape(shape), lat.reshape(shape)
+
+    def image_to_ground_dem(
+        self,
+        col,
+        row,
+        dem: Union[GeoRaster, DemSampler],
+        max_iter: int = 20,
+        tol: float = 0.01,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(lon, lat, h) of image points intersected with a DEM
+
+        The line of sight is intersected by alternating between the
+        inversion at fixed height and the sampling of the DEM. Points
+        falling outside of the DEM keep the last valid height.
+
+        Arguments:
+            col, row: image coordinates
+            dem: DEM raster or sampler
+            max_iter: maximum number of iterations
+            tol: convergence threshold on the heights, in meters
+        """
+        sampler = dem if isinstance(dem, DemSampler) else DemSampler(dem)
+        col, row = np.broadcast_arrays(
+            np.asarray(col, dtype=np.float64), np.asarray(row, dtype=np.float64)
+        )
+        h = np.full(col.shape, self.height_off)
+        for _ in range(max_iter):
+            lon, lat = self.image_to_ground(col, row, h)
+            h_new = sampler(lon, lat)
+            h_new = np.where(np.isnan(h_new), h, h_new)
+            converged = np.nanmax(np.abs(h_new - h), initial=0) < tol
+            h = h_new
+            if converged:
+                break
+        lon, lat = self.image_to_ground(col, row, h)
+        return lon, lat, h
+
+    def footprint(self, width: int, height: int, h: Optional[float] = None, densify: int = 21) -> Bbox:
+        """Longitude / latitude bbox of the image at a constant height
+
+        Arguments:
+            width, height: size of the image, in pixels
+            h: height of the ground, default to the height offset of the model
+            densify: number of points along each edge
+        """
+        t = np.linspace(0, 1, densify)
+        cols = np.concatenate([t, np.ones_like(t), t, np.zeros_like(t)]) * (width - 1)
+        rows = np.concatenate([np.zeros_like(t), t, np.ones_like(t), t]) * (height - 1)
+        lon, lat = self.image_to_ground(cols, rows, self.height_off if h is None else h)
+        return Bbox(lon.min(), lon.max(), lat.min(), lat.max(), to_srs(4326))
+
+    def ground_grid(
+        self, bbox: Bbox, resolution: float, h: Union[float, GeoRaster] = None, workers: int = 0
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Image (col, row) of the nodes of a ground grid, to resample an ortho preview
+
+        Arguments:
+            bbox: grid extent, in longitude / latitude or in a projection
+            resolution: grid spacing, in the units of the bbox
+            h: constant height or DEM, default to the height offset of the model
+            workers: processes computing blocks of rows, in-process if 0 or for
+                an in-memory DEM
+        """
+        xs = np.arange(bbox.xmin + resolution / 2, bbox.xmax, resolution)
+        ys = np.arange(bbox.ymax - resolution / 2, bbox.ymin, -resolution)
+        # In-memory DEMs can not be reopened by worker processes
+        in_memory = isinstance(h, GeoRaster) and not h.path
+        if workers and len(ys) > 1 and not in_memory:
+            # Datasets and osr objects can not be sent to the workers, they
+            # reopen the DEM and rebuild the system from its key
+            dem = h.path if isinstance(h, GeoRaster) else h
+            srs = srs_key(bbox.srs) if bbox.srs is not None else None
+            blocks = np.array_split(ys, workers * 4)
+            jobs = [(self, srs, xs, b, dem) for b in blocks if b.size]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_ground_grid_block, jobs))
+            return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+        return _ground_grid_block((self, bbox.srs, xs, ys, h))
+
+
+def _ground_grid_block(job) -> Tuple[np.ndarray, np.ndarray]:
+    model, srs, xs, ys, h = job
+    x, y = np.meshgrid(xs, ys)
+    if srs is not None:
+        lonlat = transform_points(np.stack([x.ravel(), y.ravel()], axis=1), srs, 4326)
+        lon, lat = lonlat[:, 0].reshape(x.shape), lonlat[:, 1].reshape(x.shape)
+    else:
+        lon, lat = x, y
+    if isinstance(h, str):
+        h = GeoRaster.from_file(h)
+    if h is None:
+        h = model.height_off
+    elif isinstance(h, GeoRaster):
+        bbox = Bbox(lon.min(), lon.max(), lat.min(), lat.max(), to_srs(4326))
+        h = DemSampler(h, bbox)(lon, lat)
+    return model.ground_to_image(lon, lat, h)
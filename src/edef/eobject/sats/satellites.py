@@ -1,4 +1,4 @@
-from pleiades import Pleiades
+from edef.eobject.sats.pleiades import Pleiades
 
 # SATELLITES = ["S1", "S2", "TSX", "PAZ", "Pleiades", "ALOS"]
 
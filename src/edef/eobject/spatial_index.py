@@ -0,0 +1,274 @@
+from heapq import heappop, heappush
+from typing import List, Optional, Union
+import numpy as np
+from osgeo.osr import SpatialReference
+
+from edef.eobject.boundary import Bbox, BboxArray
+from edef.eobject.utils.srs_utils import SrsLike, same_srs
+
+
+def str_order(bounds: np.ndarray, capacity: int) -> np.ndarray:
+    """Sort-Tile-Recursive order of boxes
+
+    Boxes are sorted by x center into vertical slices, then by y center in
+    each slice, so that consecutive groups of `capacity` boxes are compact.
+    """
+    n = bounds.shape[0]
+    cx = bounds[:, 0] + bounds[:, 1]
+    cy = bounds[:, 2] + bounds[:, 3]
+    leaves = -(-n // capacity)
+    slices = int(np.ceil(np.sqrt(leaves)))
+    per_slice = max(1, slices) * capacity
+    by_x = np.argsort(cx, kind="stable")
+    order = np.empty(n, dtype=np.int64)
+    for start in range(0, n, per_slice):
+        part = by_x[start : start + per_slice]
+        order[start : start + part.size] = part[np.argsort(cy[part], kind="stable")]
+    return order
+
+
+def _children(start: np.ndarray, count: np.ndarray) -> np.ndarray:
+    """Concatenated ranges [start, start + count)"""
+    total = int(count.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    offsets = np.repeat(start - np.cumsum(count) + count, count)
+    return offsets + np.arange(total)
+
+
+def _box_distance(bounds: np.ndarray, x: float, y: float) -> np.ndarray:
+    dx = np.maximum(np.maximum(bounds[:, 0] - x, x - bounds[:, 1]), 0)
+    dy = np.maximum(np.maximum(bounds[:, 2] - y, y - bounds[:, 3]), 0)
+    return np.hypot(dx, dy)
+
+
+class SpatialIndex:
+    """Packed R-tree (STR bulk loaded) over footprints
+
+    Footprints are bulk loaded into a static tree queried level by level
+    with vectorized box tests. Inserted footprints go to a small buffer
+    searched by brute force and deleted ones are masked, the tree is
+    rebuilt when the buffer or the deleted footprints grow too large.
+
+    Arguments:
+        capacity: number of children of each node
+        srs: spatial reference system of the footprints
+    """
+
+    def __init__(self, capacity: int = 16, srs: Optional[SpatialReference] = None):
+        self.capacity = capacity
+        self.srs = srs
+        # Footprints, in the order of the tree leaves for the first `packed`
+        self.bounds = np.empty((0, 4))
+        self.ids = np.empty(0, dtype=str)
+        self.alive = np.empty(0, dtype=bool)
+        self.packed = 0
+        # Tree levels from the leaves parents to the root:
+        # node bounds, first child and number of children
+        self.levels: List[tuple] = []
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    @staticmethod
+    def build(footprints: BboxArray, ids: List[str], capacity: int = 16):
+        """Bulk load footprints
+
+        Arguments:
+            footprints: boxes to index
+            ids: identifier of each box (path of the product...)
+        """
+        index = SpatialIndex(capacity, footprints.srs)
+        index.bounds = footprints.bounds.copy()
+        index.ids = np.asarray(ids, dtype=str)
+        if index.ids.shape[0] != index.bounds.shape[0]:
+            raise ValueError("One id is needed per footprint")
+        index.alive = np.ones(len(index.ids), dtype=bool)
+        index.rebuild()
+        return index
+
+    @staticmethod
+    def from_rasters(paths: List[str], srs: Optional[SrsLike] = None, capacity: int = 16):
+        """Index the footprints of rasters (DEMs, orthos...), ids are the paths
+
+        Arguments:
+            paths: raster files
+            srs: system of the index, the footprints are reprojected to it
+            capacity: number of children of each node
+        """
+        from edef.eobject.georaster import GeoRaster
+
+        bboxs = [GeoRaster.from_file(p).footprint(srs) for p in paths]
+        return SpatialIndex.build(BboxArray.from_bboxs(bboxs), paths, capacity)
+
+    def rebuild(self):
+        """Pack all the live footprints into a new tree"""
+        self.bounds = self.bounds[self.alive]
+        self.ids = self.ids[self.alive]
+        order = str_order(self.bounds, self.capacity)
+        self.bounds, self.ids = self.bounds[order], self.ids[order]
+        self.alive = np.ones(len(self.ids), dtype=bool)
+        self.packed = len(self.ids)
+        self.levels = []
+
+        boxes = self.bounds
+        while boxes.shape[0] > 1 or not self.levels:
+            n = boxes.shape[0]
+            start = np.arange(0, n, self.capacity)
+            count = np.minimum(self.capacity, n - start)
+            parents = np.empty((start.size, 4))
+            if n:
+                parents[:, 0] = np.minimum.reduceat(boxes[:, 0], start)
+                parents[:, 1] = np.maximum.reduceat(boxes[:, 1], start)
+                parents[:, 2] = np.minimum.reduceat(boxes[:, 2], start)
+                parents[:, 3] = np.maximum.reduceat(boxes[:, 3], start)
+            self.levels.append((parents, start, count))
+            if start.size <= 1:
+                break
+            # Pack the parents in turn, moving their children ranges with them
+            order = str_order(parents, self.capacity)
+            self.levels[-1] = (parents[order], start[order], count[order])
+            boxes = parents[order]
+
+    def _query(self, node_test, leaf_test) -> np.ndarray:
+        """Indices of the footprints passing the tests, tree then buffer"""
+        found = []
+        if self.packed:
+            nodes = np.arange(self.levels[-1][0].shape[0])
+            for bounds, start, count in reversed(self.levels[1:]):
+                nodes = nodes[node_test(bounds[nodes])]
+                nodes = _children(start[nodes], count[nodes])
+            bounds, start, count = self.levels[0]
+            nodes = nodes[node_test(bounds[nodes])]
+            items = _children(start[nodes], count[nodes])
+            found.append(items[leaf_test(self.bounds[items])])
+        if len(self.ids) > self.packed:
+            pending = np.arange(self.packed, len(self.ids))
+            found.append(pending[leaf_test(self.bounds[pending])])
+        items = np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+        return items[self.alive[items]]
+
+    def _box(self, bbox: Union[Bbox, tuple]) -> tuple:
+        """Bounds of a query box, reprojected to the index system if needed"""
+        if not isinstance(bbox, Bbox):
+            return tuple(bbox)
+        if bbox.srs is not None and self.srs is not None and not same_srs(bbox.srs, self.srs):
+            bbox = bbox.reproject(self.srs)
+        return bbox.to_xia_yia()
+
+    def intersects(self, bbox: Union[Bbox, tuple]) -> List[str]:
+        """Footprints intersecting a box"""
+        xmin, xmax, ymin, ymax = self._box(bbox)
+
+        def test(b):
+            return (b[:, 0] <= xmax) & (xmin <= b[:, 1]) & (b[:, 2] <= ymax) & (ymin <= b[:, 3])
+
+        return self.ids[self._query(test, test)].tolist()
+
+    def contains(self, bbox: Union[Bbox, tuple]) -> List[str]:
+        """Footprints containing a box (acquisitions covering a site)"""
+        xmin, xmax, ymin, ymax = self._box(bbox)
+
+        def test(b):
+            return (b[:, 0] <= xmin) & (xmax <= b[:, 1]) & (b[:, 2] <= ymin) & (ymax <= b[:, 3])
+
+        return self.ids[self._query(test, test)].tolist()
+
+    def within(self, bbox: Union[Bbox, tuple]) -> List[str]:
+        """Footprints contained in a box"""
+        xmin, xmax, ymin, ymax = self._box(bbox)
+
+        def node_test(b):
+            return (b[:, 0] <= xmax) & (xmin <= b[:, 1]) & (b[:, 2] <= ymax) & (ymin <= b[:, 3])
+
+        def leaf_test(b):
+            return (xmin <= b[:, 0]) & (b[:, 1] <= xmax) & (ymin <= b[:, 2]) & (b[:, 3] <= ymax)
+
+        return self.ids[self._query(node_test, leaf_test)].tolist()
+
+    def nearest(self, x: float, y: float, k: int = 1) -> List[str]:
+        """The `k` footprints closest to a point, best first search"""
+        heap = []
+        if self.packed:
+            bounds = self.levels[-1][0]
+            for node, d in enumerate(_box_distance(bounds, x, y)):
+                heappush(heap, (d, len(self.levels) - 1, node))
+        pending = np.arange(self.packed, len(self.ids))
+        pending = pending[self.alive[pending]]
+        for item, d in zip(pending, _box_distance(self.bounds[pending], x, y)):
+            heappush(heap, (d, -1, int(item)))
+
+        found = []
+        while heap and len(found) < k:
+            d, level, node = heappop(heap)
+            if level == -1:
+                found.append(node)
+                continue
+            _, start, count = self.levels[level]
+            children = np.arange(start[node], start[node] + count[node])
+            if level == 0:
+                children = children[self.alive[children]]
+                distances = _box_distance(self.bounds[children], x, y)
+                for child, dc in zip(children, distances):
+                    heappush(heap, (dc, -1, int(child)))
+            else:
+                distances = _box_distance(self.levels[level - 1][0][children], x, y)
+                for child, dc in zip(children, distances):
+                    heappush(heap, (dc, level - 1, int(child)))
+        return self.ids[found].tolist()
+
+    def insert(self, footprints: Union[Bbox, BboxArray], ids: Union[str, List[str]]):
+        """Add footprints, the tree is rebuilt when the buffer grows too large"""
+        if isinstance(footprints, Bbox):
+            footprints, ids = BboxArray.from_bboxs([footprints]), [ids]
+        self.bounds = np.concatenate([self.bounds, footprints.bounds])
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=str)])
+        self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+        if len(self.ids) - self.packed > max(1024, self.packed // 10):
+            self.rebuild()
+
+    def delete(self, ids: Union[str, List[str]]) -> int:
+        """Remove footprints by id, return the number removed"""
+        removed = np.isin(self.ids, np.atleast_1d(np.asarray(ids, dtype=str))) & self.alive
+        self.alive[removed] = False
+        if (~self.alive).sum() > max(1024, len(self.ids) // 4):
+            self.rebuild()
+        return int(removed.sum())
+
+    def footprints(self) -> BboxArray:
+        return BboxArray(self.bounds[self.alive], self.srs)
+
+    def save(self, path: str):
+        """Save the index as a `.npz` file"""
+        arrays = {
+            "bounds": self.bounds,
+            "ids": self.ids,
+            "alive": self.alive,
+            "meta": np.array([self.capacity, self.packed, len(self.levels)]),
+            "srs": np.array(self.srs.ExportToWkt() if self.srs else ""),
+        }
+        for i, (bounds, start, count) in enumerate(self.levels):
+            arrays[f"level{i}_bounds"] = bounds
+            arrays[f"level{i}_start"] = start
+            arrays[f"level{i}_count"] = count
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def load(path: str):
+        with np.load(path) as data:
+            capacity, packed, nlevels = data["meta"].tolist()
+            srs = None
+            if str(data["srs"]):
+                srs = SpatialReference()
+                srs.ImportFromWkt(str(data["srs"]))
+            index = SpatialIndex(capacity, srs)
+            index.bounds = data["bounds"]
+            index.ids = data["ids"]
+            index.alive = data["alive"]
+            index.packed = packed
+            index.levels = [
+                (data[f"level{i}_bounds"], data[f"level{i}_start"], data[f"level{i}_count"])
+                for i in range(nlevels)
+            ]
+        return index
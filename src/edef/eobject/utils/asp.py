@@ -1,9 +1,62 @@
 # ASP binaries wrapper
 
-from subprocess import run
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os.path import exists, splitext
+from subprocess import run, CompletedProcess
+from time import time
 from typing import List, Union, Optional
 from pydantic import validate_call
 
+from edef.eobject.utils.asp_monitor import Monitor
+from edef.eobject.utils.step_cache import StepCache
+
+# Step cache used by all the wrappers, disabled if None
+_cache: Optional[StepCache] = None
+
+# Capture the output of the commands instead of printing it
+capture_output: ContextVar[bool] = ContextVar("capture_output", default=False)
+
+# Monitor of the commands run in the current context, if any
+_monitor: ContextVar[Optional[Monitor]] = ContextVar("monitor", default=None)
+
+
+def enable_cache(folder: str) -> StepCache:
+    """Skip the ASP calls whose command and input files did not change
+
+    Arguments:
+        folder: folder of the cache manifest
+    """
+    global _cache
+    _cache = StepCache(folder)
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+
+@contextmanager
+def monitored(**kwargs):
+    """Stream, parse and profile the ASP commands run inside the block
+
+    ```python
+    with monitored(on_progress=print, profile_dir="profiles") as monitor:
+        parallel_stereo(images, cameras, "out/run")
+    print(monitor.profiles)
+    ```
+
+    Arguments:
+        kwargs: options of `edef.eobject.utils.asp_monitor.Monitor`
+    """
+    monitor = Monitor(**kwargs)
+    token = _monitor.set(monitor)
+    try:
+        yield monitor
+    finally:
+        _monitor.reset(token)
+
 
 def arg_to_str(arg) -> str:
     """
@@ -12,14 +65,98 @@ def arg_to_str(arg) -> str:
     var > str(var)
     None > ""
     """
-    if not arg:
-        if arg is list:
-            # Concatenate multiples elements with space
-            return " ".join([str(a) for a in arg])
-        # Return element as string
-        return str(arg)
-    # return empty string
-    return ""
+    return " ".join(arg_to_list(arg))
+
+
+def arg_to_list(arg) -> List[str]:
+    """
+    [10, 10] > ["10", "10"]
+    var > [str(var)]
+    None > []
+    """
+    if arg is None:
+        return []
+    if isinstance(arg, (list, tuple)):
+        return [str(a) for a in arg]
+    return [str(arg)]
+
+
+def opts_to_list(opts: dict) -> List[str]:
+    """
+    {"threads": 4} > ["--threads", "4"]
+    {"t": "rpc"} > ["-t", "rpc"]
+    {"bundle_adjust_prefix": "ba/run"} > ["--bundle-adjust-prefix", "ba/run"]
+    {"--tr": [2, 2]} > ["--tr", "2", "2"]
+    {"flag": True} > ["--flag"]
+    {"flag": False} or {"flag": None} > []
+    """
+    args = []
+    for key, value in opts.items():
+        if value is None or value is False:
+            continue
+        if not key.startswith("-"):
+            key = ("-" if len(key) == 1 else "--") + key.replace("_", "-")
+        args.append(key)
+        if value is not True:
+            args += arg_to_list(value)
+    return args
+
+
+def thread_opts(tool: str, threads: int) -> dict:
+    """Options limiting an ASP tool to `threads` cores"""
+    if tool == "parallel_stereo":
+        return {
+            "processes": threads,
+            "threads_multiprocess": 1,
+            "threads_singleprocess": threads,
+        }
+    if tool in ["geodiff", "disparitydebug", "orbitviz"]:
+        return {}
+    return {"threads": threads}
+
+
+def option_inputs(opts: Optional[dict]) -> List[str]:
+    """Input files given as options: existing paths and `*prefix` values"""
+    inputs = []
+    for key, value in (opts or {}).items():
+        if "output" in key or key.strip("-") == "o":
+            continue
+        for v in arg_to_list(value):
+            if exists(v) or key.endswith("prefix"):
+                inputs.append(v)
+    return inputs
+
+
+def execute(
+    cmd: List[str],
+    inputs: Optional[List[str]] = None,
+    outputs: Optional[List[str]] = None,
+) -> CompletedProcess:
+    """Run an ASP command, raise CalledProcessError on failure
+
+    When the step cache is enabled, a command already run with the same
+    input files is skipped if its outputs are unchanged.
+
+    Arguments:
+        cmd: command and arguments
+        inputs: input files, folders or prefixes
+        outputs: output files or prefixes, the call is not cached if None
+    """
+    cache = _cache if outputs else None
+    if cache is not None:
+        key = cache.key(cmd, inputs or [])
+        if cache.lookup(key) is not None:
+            return CompletedProcess(cmd, 0)
+    started = time()
+    capture = capture_output.get()
+    monitor = _monitor.get()
+    if monitor is not None:
+        result = monitor.run(cmd, capture)
+    else:
+        result = run(cmd, check=True, capture_output=capture, text=capture)
+    if cache is not None:
+        cache.record(key, cmd, inputs or [], outputs, started, time() - started)
+    return result
 
 
 @validate_call
@@ -47,29 +184,28 @@ def bundle_adjust(
         * [Bundle Adjustement](https://stereopipeline.readthedocs.io/en/latest/bundle_adjustment.html)
     
     """
-    images_str = arg_to_str(images)
-    cameras_str = arg_to_str(cameras)
-    gcp_str = arg_to_str(optional_ground_control_points)
-
-    if output_prefix is not str:
-        raise TypeError("Output prefix should be string")
-
-    opts_str = " ".join([key + " " + arg_to_str(value) for key, value in opts])
-
-    run(
-        "bundle_adjust {} {} {} -o {} {}".format(
-            images_str,
-            cameras_str,
-            gcp_str,
-            output_prefix,
-            opts_str,
-        )
+    return execute(
+        ["bundle_adjust"]
+        + arg_to_list(images)
+        + arg_to_list(cameras)
+        + arg_to_list(optional_ground_control_points)
+        + ["-o", output_prefix]
+        + opts_to_list(opts),
+        arg_to_list(images)
+        + arg_to_list(cameras)
+        + arg_to_list(optional_ground_control_points)
+        + option_inputs(opts),
+        [output_prefix],
     )
 
 
 @validate_call
 def mapproject(
-    dem: str, camera_image: str, camera_model: str, output_image: str, opts: dict
+    dem: str,
+    camera_image: str,
+    camera_model: str,
+    output_image: str,
+    opts: Optional[dict] = None,
 ):
     """ Map Projection
 
@@ -87,16 +223,12 @@ def mapproject(
         [mapproject](https://stereopipeline.readthedocs.io/en/latest/tools/mapproject.html)
 
     """
-    opts_str = " ".join([key + " " + arg_to_str(value) for key, value in opts])
-
-    run(
-        "mapproject {} {} {} {} {}".format(
-            opts_str,
-            dem,
-            camera_image,
-            camera_model,
-            output_image,
-        )
+    return execute(
+        ["mapproject"]
+        + opts_to_list(opts or {})
+        + [dem, camera_image, camera_model, output_image],
+        [dem, camera_image, camera_model] + option_inputs(opts),
+        [output_image],
     )
 
 
@@ -105,6 +237,7 @@ def parallel_stereo(
     images: Union[List[str], str],
     cameras: Optional[Union[List[str], str]],
     output_file_prefix: str,
+    dem: Optional[str] = None,
     **opts,
 ):
     """ Stereo Primary Tool
@@ -115,23 +248,22 @@ def parallel_stereo(
         images
         cameras
         output_file_prefix
+        dem: DEM used to mapproject the images, for mapprojected inputs
         opts
 
     ASP Docs
         [parallel_stereo](https://stereopipeline.readthedocs.io/en/latest/tools/parallel_stereo.html)
     
     """
-    images_str = arg_to_str(images)
-    cameras_str = arg_to_str(cameras)
-    opts_str = arg_to_str(opts)
-
-    run(
-        "parallel_stereo {} {} {} {}".format(
-            opts_str,
-            images_str,
-            cameras_str,
-            output_file_prefix,
-        )
+    return execute(
+        ["parallel_stereo"]
+        + opts_to_list(opts)
+        + arg_to_list(images)
+        + arg_to_list(cameras)
+        + [output_file_prefix]
+        + arg_to_list(dem),
+        arg_to_list(images) + arg_to_list(cameras) + arg_to_list(dem) + option_inputs(opts),
+        [output_file_prefix],
     )
 
 
@@ -154,34 +286,39 @@ def orbitviz(
         [orbitviz](https://stereopipeline.readthedocs.io/en/latest/tools/parallel_stereo.html)
 
     """
-    images_str = arg_to_str(images)
-    cameras_str = arg_to_str(cameras)
-    opts_str = arg_to_str(opts)
-
-    run("orbitviz {} {} {}".format(opts_str, images_str, cameras_str))
+    return execute(
+        ["orbitviz"] + opts_to_list(opts) + arg_to_list(images) + arg_to_list(cameras)
+    )
 
 
 @validate_call
-def point2dem(output: str, **opts):
+def point2dem(
+    point_clouds: Union[List[str], str],
+    output_prefix: Optional[str] = None,
+    **opts,
+):
     """ Point to DEM
 
     Produce a Digital elevation Model (GeoTiff) from a set of point clouds.
+    `edef.processing.point_cloud_dem` grids the clouds in process.
 
     Arguments:
-        output
+        point_clouds
+        output_prefix: default to the prefix of the first point cloud
+        opts
 
     ASP Docs:
         [point2dem](https://stereopipeline.readthedocs.io/en/latest/tools/point2dem.html)
     
     """
-    # TODO check for input pcs indication in cmd
-    opts_str = arg_to_str(opts)
-
-    run(
-        "point2dem {} {}".format(
-            output,
-            opts_str,
-        )
+    out = ["-o", output_prefix] if output_prefix else []
+    clouds = arg_to_list(point_clouds)
+    if not output_prefix:
+        output_prefix = splitext(clouds[0])[0].removesuffix("-PC")
+    return execute(
+        ["point2dem"] + opts_to_list(opts) + clouds + out,
+        clouds + option_inputs(opts),
+        [output_prefix],
     )
 
 
@@ -196,6 +333,7 @@ def pc_align(
     """ Point Clouds Alignment
 
     Aligns two point clouds.
+    `edef.processing.coregistration` aligns DEMs and point arrays in process.
 
     Arguments:
         reference_cloud
@@ -208,17 +346,12 @@ def pc_align(
         [pc_align](https://stereopipeline.readthedocs.io/en/latest/tools/pc_align.html)
         
     """
-    max_disp_str = arg_to_str(max_displacement)
-    opts_str = arg_to_str(opts)
-
-    run(
-        "pc_align --max-displacement {} {} {} {} -o {}".format(
-            max_disp_str,
-            opts_str,
-            reference_cloud,
-            source_cloud,
-            output_prefix,
-        )
+    return execute(
+        ["pc_align", "--max-displacement", str(max_displacement)]
+        + opts_to_list(opts)
+        + [reference_cloud, source_cloud, "-o", output_prefix],
+        [reference_cloud, source_cloud] + option_inputs(opts),
+        [output_prefix],
     )
 
 
@@ -241,15 +374,10 @@ def pc_merge(
         [pc_merge](https://stereopipeline.readthedocs.io/en/latest/tools/pc_merge.html)
 
     """
-    pc_inputs_str = arg_to_str(pc_inputs)
-    opts_str = arg_to_str(opts)
-
-    run(
-        "pc_merge {} {} -o {}".format(
-            opts_str,
-            pc_inputs_str,
-            pc_output,
-        )
+    return execute(
+        ["pc_merge"] + opts_to_list(opts) + arg_to_list(pc_inputs) + ["-o", pc_output],
+        arg_to_list(pc_inputs) + option_inputs(opts),
+        [pc_output],
     )
 
 
@@ -275,15 +403,10 @@ def image_align(
         [image_align](https://stereopipeline.readthedocs.io/en/latest/tools/image_align.html)
 
     """
-    opts_str = arg_to_str(opts)
-
-    run(
-        "image_align {} {} {} -o {}".format(
-            opts_str,
-            ref_img,
-            src_img,
-            out_img,
-        )
+    return execute(
+        ["image_align"] + opts_to_list(opts) + [ref_img, src_img, "-o", out_img],
+        [ref_img, src_img] + option_inputs(opts),
+        [out_img],
     )
 
 
@@ -309,18 +432,11 @@ def geodiff(
         [geodiff](https://stereopipeline.readthedocs.io/en/latest/tools/geodiff.html)
 
     """
-    out_str = arg_to_str(output_file_prefix)
-    if out_str:
-        out_str = "-o " + out_str
-    opts_str = arg_to_str(opts)
-
-    run(
-        "geodiff {} {} {} {}".format(
-            opts_str,
-            dem1,
-            dem2,
-            out_str,
-        )
+    out = ["-o", output_file_prefix] if output_file_prefix else []
+    return execute(
+        ["geodiff"] + opts_to_list(opts) + [dem1, dem2] + out,
+        [dem1, dem2] + option_inputs(opts),
+        [output_file_prefix] if output_file_prefix else None,
     )
 
 
@@ -344,15 +460,10 @@ def n_align(
         [n_align](https://stereopipeline.readthedocs.io/en/latest/tools/n_align.html)
 
     """
-    opts_str = arg_to_str(opts)
-    cloud_str = arg_to_str(cloud_files)
-
-    run(
-        "n_align {} {} -o {}".format(
-            opts_str,
-            cloud_str,
-            output_prefix,
-        )
+    return execute(
+        ["n_align"] + opts_to_list(opts) + cloud_files + ["-o", output_prefix],
+        cloud_files + option_inputs(opts),
+        [output_prefix],
     )
 
 
@@ -380,16 +491,12 @@ def corr_eval(
         [corr_eval](https://stereopipeline.readthedocs.io/en/latest/tools/corr_eval.html)
 
     """
-    opts_str = arg_to_str(opts)
-
-    run(
-        "corr_eval {} {} {} {} {}".format(
-            opts_str,
-            left_img,
-            right_img,
-            disparity_img,
-            output_prefix,
-        )
+    return execute(
+        ["corr_eval"]
+        + opts_to_list(opts)
+        + [left_img, right_img, disparity_img, output_prefix],
+        [left_img, right_img, disparity_img] + option_inputs(opts),
+        [output_prefix],
     )
 
 
@@ -418,6 +525,9 @@ def disparitydebug(
     done
     ```
 
+    In process, `edef.eobject.images.DisparityImage` reads the masked
+    disparities and writes normalized previews without intermediate files.
+
     Arguments:
         disparity_map
 
@@ -425,8 +535,8 @@ def disparitydebug(
         [disparitydebug](https://stereopipeline.readthedocs.io/en/latest/tools/disparitydebug.html)
         [Extract Disparity Bands](https://stereopipeline.readthedocs.io/en/latest/tools/image_calc.html#mask-disparity)
     """
-    run(
-        "disparitydebug {}".format(
-            disparity_map
-        )
+    return execute(
+        ["disparitydebug", disparity_map],
+        [disparity_map],
+        [splitext(disparity_map)[0]],
     )
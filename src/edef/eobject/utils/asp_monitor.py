@@ -0,0 +1,236 @@
+# Live progress and resource monitoring of ASP subprocesses
+
+from dataclasses import asdict, dataclass
+from os import makedirs
+from os.path import basename, join
+from subprocess import PIPE, CalledProcessError, CompletedProcess, Popen
+from threading import Event, Thread
+from time import perf_counter, strftime
+from typing import Callable, List, Optional
+import csv
+import json
+import re
+import sys
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# ASP progress bars end with a percentage, stages are announced as
+# "Stage 1 --> CORRELATION" or "--> Running stereo_corr"
+PERCENT = re.compile(r"(\d{1,3}(?:\.\d+)?)\s*%")
+STAGE = re.compile(r"Stage\s+\d+\s*-+>\s*(\w+)|-+>\s*Running\s+(\S+)")
+
+
+@dataclass
+class Sample:
+    """Resources of the process tree at a given time
+
+    Attributes:
+        time: seconds since the start of the run
+        cpu: CPU usage summed over the processes, in percent of one core
+        rss: resident memory, in bytes
+        read_bytes: bytes read since the start of the processes
+        write_bytes: bytes written since the start of the processes
+        processes: number of processes in the tree
+        stage: last ASP stage announced
+        percent: last progress percentage parsed
+    """
+
+    time: float
+    cpu: float
+    rss: int
+    read_bytes: int
+    write_bytes: int
+    processes: int
+    stage: str
+    percent: Optional[float]
+
+
+class ProgressParser:
+    """Extract the stage and the completion percentage from ASP output lines"""
+
+    def __init__(self):
+        self.stage = ""
+        self.percent = None
+
+    def feed(self, line: str) -> bool:
+        """Update from a line, return True if the progress changed"""
+        changed = False
+        stage = STAGE.search(line)
+        if stage:
+            self.stage = stage.group(1) or basename(stage.group(2))
+            self.percent = 0.0
+            changed = True
+        percents = PERCENT.findall(line)
+        if percents:
+            percent = min(float(percents[-1]), 100.0)
+            changed = changed or percent != self.percent
+            self.percent = percent
+        return changed
+
+
+class ResourceSampler(Thread):
+    """Sample periodically the resources of a process and its children"""
+
+    def __init__(self, pid: int, interval: float, progress: ProgressParser):
+        super().__init__(daemon=True)
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.progress = progress
+        self.samples: List[Sample] = []
+        self._done = Event()
+        self._start = perf_counter()
+        self._cpu = {}
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def sample(self):
+        try:
+            procs = [self.process] + self.process.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return
+        cpu = rss = read = write = 0
+        for p in procs:
+            try:
+                with p.oneshot():
+                    if p.pid not in self._cpu:
+                        # First call of cpu_percent only sets the reference
+                        self._cpu[p.pid] = p
+                        p.cpu_percent(None)
+                    cpu += self._cpu[p.pid].cpu_percent(None)
+                    rss += p.memory_info().rss
+                    if hasattr(p, "io_counters"):
+                        io = p.io_counters()
+                        read += io.read_bytes
+                        write += io.write_bytes
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        self.samples.append(
+            Sample(
+                perf_counter() - self._start,
+                cpu,
+                rss,
+                read,
+                write,
+                len(procs),
+                self.progress.stage,
+                self.progress.percent,
+            )
+        )
+
+    def run(self):
+        while not self._done.is_set():
+            self.sample()
+            self._done.wait(self.interval)
+
+
+class Monitor:
+    """Stream, parse and profile ASP subprocesses
+
+    Used by `edef.eobject.utils.asp.monitored`, the output of the commands
+    is read line by line, progress is reported to the callbacks, and the
+    resources of the process tree are sampled and saved as a profile per
+    run. Stderr is read by a separate thread and kept apart from stdout.
+
+    Arguments:
+        on_line: called with each stdout line
+        on_progress: called with (stage, percent) when the progress changes
+        profile_dir: folder of the JSON and CSV profiles, no profile if None
+        interval: sampling period of the resources, in seconds
+        echo: print the output lines when they are not captured
+    """
+
+    def __init__(
+        self,
+        on_line: Optional[Callable[[str], None]] = None,
+        on_progress: Optional[Callable[[str, float], None]] = None,
+        profile_dir: Optional[str] = None,
+        interval: float = 1.0,
+        echo: bool = True,
+    ):
+        if profile_dir is not None and psutil is None:
+            raise ImportError("psutil is needed to sample the process resources")
+        self.on_line = on_line
+        self.on_progress = on_progress
+        self.profile_dir = profile_dir
+        self.interval = interval
+        self.echo = echo
+        self.profiles: List[str] = []
+
+    def run(self, cmd: List[str], capture: bool = False) -> CompletedProcess:
+        """Run a command, raise CalledProcessError on failure"""
+        progress = ProgressParser()
+        lines, errors = [], []
+        start = perf_counter()
+        with Popen(cmd, stdout=PIPE, stderr=PIPE, text=True, bufsize=1) as proc:
+
+            def read_stderr():
+                for line in proc.stderr:
+                    line = line.rstrip("\n")
+                    if capture:
+                        errors.append(line)
+                    elif self.echo:
+                        print(line, file=sys.stderr, flush=True)
+
+            stderr_reader = Thread(target=read_stderr, daemon=True)
+            stderr_reader.start()
+            sampler = None
+            if self.profile_dir is not None:
+                sampler = ResourceSampler(proc.pid, self.interval, progress)
+                sampler.start()
+            for line in proc.stdout:
+                line = line.rstrip("\n")
+                if capture:
+                    lines.append(line)
+                elif self.echo:
+                    print(line, flush=True)
+                if self.on_line is not None:
+                    self.on_line(line)
+                if progress.feed(line) and self.on_progress is not None:
+                    self.on_progress(progress.stage, progress.percent)
+            returncode = proc.wait()
+            stderr_reader.join()
+            if sampler is not None:
+                sampler.stop()
+                self.save(cmd, proc.pid, sampler.samples, returncode, perf_counter() - start)
+
+        stdout = "\n".join(lines) if capture else None
+        stderr = "\n".join(errors) if capture else None
+        if returncode != 0:
+            raise CalledProcessError(returncode, cmd, stdout, stderr)
+        return CompletedProcess(cmd, returncode, stdout, stderr)
+
+    def save(
+        self,
+        cmd: List[str],
+        pid: int,
+        samples: List[Sample],
+        returncode: int,
+        duration: float,
+    ):
+        """Write the samples of a run as `<tool>-<date>-<pid>.json` and `.csv`"""
+        makedirs(self.profile_dir, exist_ok=True)
+        name = f"{basename(cmd[0])}-{strftime('%Y%m%d-%H%M%S')}-{pid}"
+        prefix = join(self.profile_dir, name)
+        rows = [asdict(s) for s in samples]
+        with open(prefix + ".json", "w") as f:
+            json.dump(
+                {
+                    "cmd": cmd,
+                    "returncode": returncode,
+                    "duration": duration,
+                    "peak_rss": max([s.rss for s in samples], default=0),
+                    "samples": rows,
+                },
+                f,
+                indent=1,
+            )
+        with open(prefix + ".csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(Sample.__dataclass_fields__))
+            writer.writeheader()
+            writer.writerows(rows)
+        self.profiles.append(prefix + ".json")
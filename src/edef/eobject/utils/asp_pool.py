@@ -0,0 +1,180 @@
+# Concurrent execution of batches of ASP commands
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from dataclasses import dataclass, field
+from os import cpu_count
+from subprocess import CalledProcessError
+from time import perf_counter
+from typing import Callable, Iterable, List, Optional, Union
+import asyncio
+
+from edef.eobject.utils import asp
+
+
+@dataclass
+class AspResult:
+    """Outcome of an ASP invocation
+
+    Attributes:
+        tool: name of the ASP tool
+        cmd: command line run, empty if it could not be built
+        returncode: exit code of the command, None if it did not run
+        duration: wall time, in seconds
+        stdout: captured standard output
+        stderr: captured standard error
+        error: error raised before or instead of the command, if any
+    """
+
+    tool: str
+    cmd: List[str] = field(default_factory=list)
+    returncode: Optional[int] = None
+    duration: float = 0.0
+    stdout: str = ""
+    stderr: str = ""
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+
+def _with_threads(tool: str, args: tuple, kwargs: dict, threads: Optional[int]):
+    """Add the thread options of a tool to its arguments"""
+    if not threads:
+        return args, kwargs
+    opts = asp.thread_opts(tool, threads)
+    if tool != "mapproject":
+        return args, opts | kwargs
+    # mapproject takes its options as a dict
+    if len(args) > 4:
+        return args[:4] + ((opts | (args[4] or {})),), kwargs
+    return args, kwargs | {"opts": opts | (kwargs.get("opts") or {})}
+
+
+def run_job(
+    tool: Union[str, Callable], *args, threads: Optional[int] = None, **kwargs
+) -> AspResult:
+    """Run an ASP wrapper, capture its logs and never raise
+
+    Arguments:
+        tool: wrapper of `edef.eobject.utils.asp` or its name
+        args: arguments of the wrapper
+        threads: number of threads given to the tool
+        kwargs: keyword arguments and ASP options of the wrapper
+    """
+    func = getattr(asp, tool) if isinstance(tool, str) else tool
+    name = func.__name__
+    args, kwargs = _with_threads(name, args, kwargs, threads)
+    result = AspResult(name)
+    token = asp.capture_output.set(True)
+    start = perf_counter()
+    try:
+        proc = func(*args, **kwargs)
+        result.cmd = list(proc.args)
+        result.returncode = proc.returncode
+        result.stdout = proc.stdout or ""
+        result.stderr = proc.stderr or ""
+    except CalledProcessError as e:
+        result.cmd = list(e.cmd)
+        result.returncode = e.returncode
+        result.stdout = e.stdout or ""
+        result.stderr = e.stderr or ""
+    except Exception as e:
+        result.error = repr(e)
+    finally:
+        result.duration = perf_counter() - start
+        asp.capture_output.reset(token)
+    return result
+
+
+class AspExecutor:
+    """Bounded pool running many ASP invocations concurrently
+
+    Each job is an ASP subprocess, at most `max_jobs` run at the same time
+    and each one is limited to `threads_per_job` threads so that together
+    they do not oversubscribe the cores.
+
+    Arguments:
+        max_jobs: number of concurrent jobs, default to cores / threads_per_job
+        threads_per_job: threads given to each tool, ASP default if None
+    """
+
+    def __init__(self, max_jobs: Optional[int] = None, threads_per_job: Optional[int] = None):
+        self.threads_per_job = threads_per_job
+        self.max_jobs = max_jobs or max(1, cpu_count() // (threads_per_job or 1))
+        self._pool = ThreadPoolExecutor(max_workers=self.max_jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
+    def submit(self, tool: Union[str, Callable], *args, **kwargs) -> "Future[AspResult]":
+        """Queue an ASP invocation, see `run_job`
+
+        The job runs in the context of the caller, so it follows the cache
+        and monitoring settings active at submission.
+        """
+        kwargs.setdefault("threads", self.threads_per_job)
+        return self._pool.submit(copy_context().run, run_job, tool, *args, **kwargs)
+
+    def map(self, tool: Union[str, Callable], jobs: Iterable[tuple], **opts) -> List[AspResult]:
+        """Run a tool on each tuple of arguments, results in the jobs order"""
+        futures = [self.submit(tool, *job, **opts) for job in jobs]
+        return [f.result() for f in futures]
+
+    def mapproject_many(
+        self,
+        dem: str,
+        camera_images: List[str],
+        camera_models: List[str],
+        output_images: List[str],
+        opts: Optional[dict] = None,
+    ) -> List[AspResult]:
+        """Mapproject many images on the same DEM"""
+        jobs = [
+            (dem, img, cam, out, dict(opts or {}))
+            for img, cam, out in zip(camera_images, camera_models, output_images, strict=True)
+        ]
+        return self.map("mapproject", jobs)
+
+    def geodiff_many(
+        self, dems1: List[str], dems2: List[str], output_prefixes: List[str], **opts
+    ) -> List[AspResult]:
+        """Difference of many pairs of DEMs"""
+        jobs = zip(dems1, dems2, output_prefixes, strict=True)
+        return self.map("geodiff", jobs, **opts)
+
+    async def submit_async(self, tool: Union[str, Callable], *args, **kwargs) -> AspResult:
+        """Awaitable version of `submit`"""
+        return await asyncio.wrap_future(self.submit(tool, *args, **kwargs))
+
+
+async def run_many_async(
+    tool: Union[str, Callable],
+    jobs: Iterable[tuple],
+    max_jobs: Optional[int] = None,
+    threads: Optional[int] = None,
+    **opts,
+) -> List[AspResult]:
+    """Run a tool on each tuple of arguments from an asyncio event loop
+
+    Arguments:
+        tool: wrapper of `edef.eobject.utils.asp` or its name
+        jobs: arguments of each invocation
+        max_jobs: number of concurrent jobs, default to cores / threads
+        threads: threads given to each tool
+        opts: ASP options common to all the jobs
+    """
+    limit = asyncio.Semaphore(max_jobs or max(1, cpu_count() // (threads or 1)))
+
+    async def one(job):
+        async with limit:
+            return await asyncio.to_thread(run_job, tool, *job, threads=threads, **opts)
+
+    return await asyncio.gather(*[one(job) for job in jobs])
@@ -0,0 +1,382 @@
+# Chunked and compressed on-disk cache of raster intermediates
+
+from itertools import product
+from os import getpid, makedirs, remove, replace, scandir, utime
+from os.path import dirname, exists, getmtime, join
+from shutil import rmtree
+from threading import get_ident
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import json
+import zlib
+import numpy as np
+import dask.array as da
+from dask.base import tokenize
+from dask.highlevelgraph import HighLevelGraph
+
+from edef.eobject.utils.step_cache import fingerprint
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+# Codecs by order of preference, zlib is always available
+CODECS = ["zstd", "blosc", "zlib"]
+# Chunk shape (lines, columns) of entries whose data is not chunked
+DEFAULT_CHUNKS = (1024, 1024)
+
+
+def available_codecs() -> List[str]:
+    return [
+        c
+        for c, module in zip(CODECS, [zstandard, blosc, zlib])
+        if module is not None
+    ]
+
+
+def _shuffle(data: np.ndarray) -> bytes:
+    """Bytes grouped by significance, which compress much better for floats"""
+    raw = np.ascontiguousarray(data).view(np.uint8)
+    return raw.reshape(-1, data.dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(buf: bytes, dtype: np.dtype, shape: Tuple[int, ...]) -> np.ndarray:
+    raw = np.frombuffer(buf, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(raw.T).view(dtype).reshape(shape)
+
+
+def compress(data: np.ndarray, codec: str, level: int) -> bytes:
+    """Byte shuffled and compressed array"""
+    if codec == "blosc":
+        return blosc.compress(
+            np.ascontiguousarray(data).tobytes(),
+            typesize=data.dtype.itemsize,
+            clevel=min(level, 9),
+            shuffle=blosc.SHUFFLE,
+            cname="zstd",
+        )
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(_shuffle(data))
+    return zlib.compress(_shuffle(data), min(level, 9))
+
+
+def decompress(buf: bytes, codec: str, dtype, shape: Tuple[int, ...]) -> np.ndarray:
+    dtype = np.dtype(dtype)
+    if codec == "blosc":
+        return np.frombuffer(blosc.decompress(buf), dtype=dtype).reshape(shape).copy()
+    if codec == "zstd":
+        return _unshuffle(zstandard.ZstdDecompressor().decompress(buf), dtype, shape)
+    return _unshuffle(zlib.decompress(buf), dtype, shape)
+
+
+def token(value) -> str:
+    """Deterministic token of an input of an operation
+
+    Rasters read from a file are identified by the fingerprint of the file
+    and their grid, lazy rasters by the name of their dask graph (which is
+    itself derived from their inputs) and in-memory arrays by their content.
+    """
+    from edef.eobject.georaster import GeoRaster
+
+    if isinstance(value, GeoRaster):
+        grid = (value.geotransform, value.dim, value.projection)
+        if value.path:
+            return tokenize("file", value.path, fingerprint(value.path), grid)
+        if isinstance(value.data, da.Array):
+            return tokenize("dask", value.data.name, grid)
+        return tokenize("array", np.asarray(value.data), grid)
+    if isinstance(value, da.Array):
+        return tokenize("dask", value.name)
+    if isinstance(value, (list, tuple)):
+        return tokenize([token(v) for v in value])
+    if isinstance(value, dict):
+        return tokenize({k: token(v) for k, v in sorted(value.items())})
+    return tokenize(value)
+
+
+class ChunkStore:
+    """Local store of the chunks of intermediate rasters
+
+    An entry holds the outputs of an operation, identified by the name of
+    the operation, the tokens of its inputs (see `token`) and its
+    parameters. Each chunk is compressed in its own file, written to a
+    temporary file and renamed, so that threads and worker processes write
+    the chunks of an entry concurrently without lock. Files are evicted by
+    least recent use once the store exceeds `max_bytes`, a read chunk being
+    touched.
+
+    As outputs read from the store keep a deterministic dask name, chained
+    operations get stable keys: re-running an analysis with other
+    downstream parameters reuses the upstream chunks without computing
+    them.
+
+    Folder layout:
+        <key>/entry.json: operation, codec and grid, shape, dtype and chunks
+            of each output
+        <key>/<output>.<line>.<column>: compressed chunks
+
+    Arguments:
+        folder: folder of the store, created if needed
+        max_bytes: size budget of the compressed chunks
+        codec: "zstd", "blosc" or "zlib", the first available if None
+        level: compression level
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        max_bytes: int = 16 * 2**30,
+        codec: Optional[str] = None,
+        level: int = 3,
+    ):
+        available = available_codecs()
+        if codec is None:
+            codec = available[0]
+        elif codec not in available:
+            raise ValueError(f"Codec {codec} is not available, use one of {available}")
+        makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.level = level
+        # Bytes written by this process since the last eviction
+        self._written = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_written"] = 0
+        return state
+
+    def key(self, operation: str, inputs: Iterable = (), params: Optional[dict] = None) -> str:
+        return tokenize(operation, [token(i) for i in inputs], token(params or {}))
+
+    def _chunk_path(self, key: str, output: int, index: Tuple[int, int]) -> str:
+        return join(self.folder, key, f"{output}.{index[0]}.{index[1]}")
+
+    def _entry(self, key: str) -> Optional[dict]:
+        try:
+            with open(join(self.folder, key, "entry.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _indices(self, chunks) -> List[Tuple[int, int]]:
+        return list(product(range(len(chunks[0])), range(len(chunks[1]))))
+
+    def contains(self, key: str) -> bool:
+        """True if all the chunks of the entry are stored"""
+        entry = self._entry(key)
+        if entry is None:
+            return False
+        return all(
+            exists(self._chunk_path(key, o, index))
+            for o, out in enumerate(entry["outputs"])
+            for index in self._indices(out["chunks"])
+        )
+
+    def read_chunk(self, key: str, output: int, index: Tuple[int, int], codec, dtype, shape):
+        path = self._chunk_path(key, output, index)
+        with open(path, "rb") as f:
+            buf = f.read()
+        utime(path)
+        return decompress(buf, codec, dtype, shape)
+
+    def write_chunk(self, key: str, output: int, index: Tuple[int, int], data: np.ndarray):
+        """Atomically store a chunk, returned unchanged"""
+        data = np.asarray(data)
+        buf = compress(data, self.codec, self.level)
+        path = self._chunk_path(key, output, index)
+        makedirs(join(self.folder, key), exist_ok=True)
+        tmp = f"{path}.{getpid()}-{get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(buf)
+        replace(tmp, path)
+        self._written += len(buf)
+        if self._written > self.max_bytes // 16:
+            self._written = 0
+            self.evict()
+        return data
+
+    def _output(self, key: str, entry: dict, o: int, source: Optional[da.Array]) -> da.Array:
+        """Dask array of an output: stored chunks are read, missing ones computed and stored"""
+        out = entry["outputs"][o]
+        chunks = tuple(tuple(c) for c in out["chunks"])
+        dtype = np.dtype(out["dtype"])
+        name = f"chunkstore-{key}-{o}"
+        dsk = {}
+        for i, j in self._indices(chunks):
+            path = self._chunk_path(key, o, (i, j))
+            if exists(path):
+                # Touched now so that it is not evicted before being read
+                utime(path)
+                shape = (chunks[0][i], chunks[1][j])
+                dsk[(name, i, j)] = (
+                    self.read_chunk, key, o, (i, j), entry["codec"], dtype, shape
+                )
+            elif source is None:
+                raise KeyError(f"Chunk {(i, j)} of output {o} of {key} is not stored")
+            else:
+                dsk[(name, i, j)] = (self.write_chunk, key, o, (i, j), (source.name, i, j))
+        deps = [] if source is None else [source]
+        graph = HighLevelGraph.from_collections(name, dsk, dependencies=deps)
+        return da.Array(graph, name, chunks, dtype=dtype)
+
+    def load(self, key: str):
+        """Outputs of a complete entry, as lazy GeoRaster (tuple if several)"""
+        from edef.eobject.georaster import GeoRaster
+
+        entry = self._entry(key)
+        if entry is None:
+            raise KeyError(f"No entry {key} in the chunk store")
+        rasters = [
+            GeoRaster.from_grid(
+                out["geotransform"],
+                out["shape"][1],
+                out["shape"][0],
+                out["projection"] or None,
+                self._output(key, entry, o, None),
+            )
+            for o, out in enumerate(entry["outputs"])
+        ]
+        return rasters[0] if entry["single"] else tuple(rasters)
+
+    def cached(
+        self,
+        operation: str,
+        inputs: Iterable,
+        params: Optional[dict],
+        compute: Callable,
+        chunks: Optional[Tuple[int, int]] = None,
+    ):
+        """Outputs of an operation, read from the store or computed lazily
+
+        `compute` is only called when some chunks are missing, and only the
+        missing chunks are computed and stored when the result is evaluated.
+
+        Arguments:
+            operation: name of the operation
+            inputs: rasters, arrays or values the result depends on
+            params: parameters of the operation
+            compute: function without argument returning the GeoRaster, or
+                tuple of GeoRaster, of the operation
+            chunks: chunk shape of the stored outputs, the chunks of the
+                result (or `DEFAULT_CHUNKS`) if None
+
+        Returns:
+            lazy GeoRaster, or tuple of GeoRaster as `compute`
+        """
+        from edef.eobject.georaster import GeoRaster
+
+        key = self.key(operation, inputs, params)
+        if self.contains(key):
+            return self.load(key)
+
+        result = compute()
+        single = isinstance(result, GeoRaster)
+        rasters = [result] if single else list(result)
+        previous = self._entry(key)
+        arrays, outputs = [], []
+        for o, raster in enumerate(rasters):
+            data = raster.data
+            if not isinstance(data, da.Array):
+                data = da.from_array(np.asarray(data), chunks=chunks or DEFAULT_CHUNKS)
+            if data.ndim != 2:
+                raise ValueError(f"Only 2D outputs can be cached, got shape {data.shape}")
+            if previous is not None and o < len(previous["outputs"]):
+                # Chunks already stored keep their layout
+                data = data.rechunk(tuple(tuple(c) for c in previous["outputs"][o]["chunks"]))
+            elif chunks is not None:
+                data = data.rechunk(chunks)
+            arrays.append(data)
+            outputs.append(
+                {
+                    "shape": list(data.shape),
+                    "dtype": data.dtype.str,
+                    "chunks": [list(c) for c in data.chunks],
+                    "geotransform": list(raster.geotransform),
+                    "projection": raster.projection or "",
+                }
+            )
+        codec = previous["codec"] if previous is not None else self.codec
+        if previous is not None and (
+            codec != self.codec
+            or [(o["shape"], o["dtype"]) for o in previous["outputs"]]
+            != [(o["shape"], o["dtype"]) for o in outputs]
+        ):
+            rmtree(join(self.folder, key), ignore_errors=True)
+            codec = self.codec
+        entry = {"operation": operation, "codec": codec, "single": single, "outputs": outputs}
+        makedirs(join(self.folder, key), exist_ok=True)
+        tmp = join(self.folder, key, f"entry.json.{getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(entry, f, indent=1)
+        replace(tmp, join(self.folder, key, "entry.json"))
+
+        stored = [
+            GeoRaster.from_array(self._output(key, entry, o, data), raster)
+            for o, (raster, data) in enumerate(zip(rasters, arrays))
+        ]
+        return stored[0] if single else tuple(stored)
+
+    def nbytes(self) -> int:
+        """Size of the stored chunks"""
+        return sum(size for _, _, size in self._files())
+
+    def _files(self) -> List[Tuple[float, str, int]]:
+        files = []
+        for entry in scandir(self.folder):
+            if not entry.is_dir():
+                continue
+            for f in scandir(entry.path):
+                if f.name == "entry.json" or f.name.endswith(".tmp"):
+                    continue
+                try:
+                    st = f.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, f.path, st.st_size))
+        return files
+
+    def evict(self, max_bytes: Optional[int] = None):
+        """Remove the least recently used chunks until the store fits in `max_bytes`
+
+        Entries left without chunks are removed, an entry missing some
+        chunks is completed by the next `cached` call.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        files = sorted(self._files())
+        total = sum(size for _, _, size in files)
+        emptied = set()
+        for _, path, size in files:
+            if total <= max_bytes:
+                break
+            try:
+                remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            emptied.add(dirname(path))
+        for folder in emptied:
+            if all(f.name == "entry.json" for f in scandir(folder)):
+                rmtree(folder, ignore_errors=True)
+
+    def clear(self):
+        for entry in scandir(self.folder):
+            if entry.is_dir():
+                rmtree(entry.path, ignore_errors=True)
+
+    def entries(self) -> Dict[str, dict]:
+        """Entries of the store by key, with the time of their last use"""
+        out = {}
+        for d in scandir(self.folder):
+            entry = self._entry(d.name) if d.is_dir() else None
+            if entry is not None:
+                entry["used"] = max(
+                    [getmtime(f.path) for f in scandir(d.path)], default=0.0
+                )
+                out[d.name] = entry
+        return out
@@ -0,0 +1,326 @@
+# Neighbourhood filters computed tile by tile on rasters larger than memory
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+from typing import Callable, Optional, Tuple, Union
+import numpy as np
+import dask.array as da
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import ndimage, signal
+
+from edef.eobject.utils.gdal_utils import TiledWriter, Window
+
+# Gaussians with a larger sigma, in pixels, are convolved by FFT
+FFT_SIGMA = 8.0
+# Custom kernels with more coefficients are convolved by FFT
+FFT_KERNEL_SIZE = 31**2
+# Number of values of the sliding windows given at once to the NaN median
+MEDIAN_CHUNK = 2**22
+
+
+def gaussian_kernel(sigma: float, truncate: float = 4.0) -> np.ndarray:
+    """Normalized 1D gaussian, of radius `int(truncate * sigma + 0.5)` as scipy"""
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def _correlate1d(z: np.ndarray, kernel: np.ndarray, axis: int, fft: bool) -> np.ndarray:
+    """Correlation along an axis, with zeros outside the array"""
+    if fft:
+        shape = [1, 1]
+        shape[axis] = kernel.size
+        return signal.oaconvolve(z, kernel[::-1].reshape(shape), mode="same", axes=axis)
+    return ndimage.correlate1d(z, kernel, axis=axis, mode="constant", cval=0.0)
+
+
+def _normalized(z: np.ndarray, correlate: Callable, keep_nodata: bool) -> np.ndarray:
+    """Normalized convolution: filtered values over filtered weights of the valid pixels"""
+    valid = np.isfinite(z)
+    values = correlate(np.where(valid, z, 0.0))
+    weights = correlate(valid.astype(np.float64))
+    out = np.full(z.shape, np.nan)
+    np.divide(values, weights, out=out, where=weights > 1e-12)
+    if keep_nodata:
+        out[~valid] = np.nan
+    return out
+
+
+def gaussian(
+    z: np.ndarray,
+    sigma: Union[float, Tuple[float, float]],
+    truncate: float = 4.0,
+    keep_nodata: bool = True,
+) -> np.ndarray:
+    """Gaussian smoothing ignoring NaN
+
+    The two separable passes run by FFT for large sigmas, so the cost does
+    not grow with the kernel size.
+
+    Arguments:
+        z: array, NaN on nodata
+        sigma: standard deviation in pixels, or (lines, columns)
+        truncate: kernel radius, in number of sigma
+        keep_nodata: NaN stay NaN, otherwise they are filled from their neighbours
+    """
+    sy, sx = (sigma, sigma) if np.isscalar(sigma) else sigma
+    ky, kx = gaussian_kernel(sy, truncate), gaussian_kernel(sx, truncate)
+
+    def correlate(a):
+        return _correlate1d(_correlate1d(a, ky, 0, sy > FFT_SIGMA), kx, 1, sx > FFT_SIGMA)
+
+    return _normalized(np.asarray(z, dtype=np.float64), correlate, keep_nodata)
+
+
+def convolve(
+    z: np.ndarray, kernel: np.ndarray, normalized: bool = True, keep_nodata: bool = True
+) -> np.ndarray:
+    """Correlation with a custom kernel of odd shape
+
+    Arguments:
+        z: array, NaN on nodata
+        kernel: 2D kernel, centered on its middle coefficient
+        normalized: divide by the kernel weights of the valid pixels, so that
+            NaN are ignored. Otherwise pixels whose kernel meets a NaN are NaN
+        keep_nodata: NaN stay NaN with a normalized convolution
+    """
+    kernel = np.asarray(kernel, dtype=np.float64)
+    if kernel.ndim != 2 or kernel.shape[0] % 2 == 0 or kernel.shape[1] % 2 == 0:
+        raise ValueError(f"Kernel of shape {kernel.shape} is not 2D with odd sides")
+
+    def correlate(a, k=kernel):
+        if k.size > FFT_KERNEL_SIZE:
+            return signal.fftconvolve(a, k[::-1, ::-1], mode="same")
+        return ndimage.correlate(a, k, mode="constant", cval=0.0)
+
+    z = np.asarray(z, dtype=np.float64)
+    if normalized:
+        return _normalized(z, correlate, keep_nodata)
+    invalid = ~np.isfinite(z)
+    out = correlate(np.where(invalid, 0.0, z))
+    out[correlate(invalid.astype(np.float64), np.abs(kernel)) > 1e-12] = np.nan
+    return out
+
+
+def _nanmedian(z: np.ndarray, size: int) -> np.ndarray:
+    """Median ignoring NaN over all the pixels, NaN outside the array"""
+    r = size // 2
+    windows = sliding_window_view(np.pad(z, r, constant_values=np.nan), (size, size))
+    out = np.empty(z.shape)
+    lines = max(1, MEDIAN_CHUNK // (z.shape[1] * size**2))
+    for i in range(0, z.shape[0], lines):
+        strip = windows[i : i + lines]
+        strip = strip.reshape(strip.shape[0], strip.shape[1], -1)
+        # All NaN windows give NaN, without warning
+        filled = np.isfinite(strip).any(axis=-1)
+        strip = np.where(filled[..., None], strip, 0.0)
+        out[i : i + lines] = np.where(filled, np.nanmedian(strip, axis=-1), np.nan)
+    return out
+
+
+def median(z: np.ndarray, size: int, keep_nodata: bool = True) -> np.ndarray:
+    """Median over a square window ignoring NaN
+
+    Outside the array is NaN, so that the edge pixels get the median of the
+    pixels available, as the tiles of `median_filter`.
+
+    Arguments:
+        z: array, NaN on nodata
+        size: odd side of the window, in pixels
+        keep_nodata: NaN stay NaN, otherwise they are filled from their neighbours
+    """
+    z = np.asarray(z, dtype=np.float64)
+    valid = np.isfinite(z)
+    r = size // 2
+    if valid.all() and min(z.shape) > 2 * r:
+        out = ndimage.median_filter(z, size, mode="nearest")
+        if r > 0:
+            # Windows of the edge pixels overlap the outside of the array
+            out[:r] = _nanmedian(z[: 2 * r], size)[:r]
+            out[-r:] = _nanmedian(z[-2 * r :], size)[-r:]
+            out[:, :r] = _nanmedian(z[:, : 2 * r], size)[:, :r]
+            out[:, -r:] = _nanmedian(z[:, -2 * r :], size)[:, -r:]
+    else:
+        out = _nanmedian(z, size)
+    if keep_nodata:
+        out[~valid] = np.nan
+    return out
+
+
+def sobel(z: np.ndarray, dx: float = 1.0, dy: float = 1.0) -> np.ndarray:
+    """Gradient magnitude from Sobel operators, in unit of z per unit of dx
+
+    NaN propagate to their neighbours.
+    """
+    z = np.asarray(z, dtype=np.float64)
+    gx = ndimage.sobel(z, axis=1, mode="nearest") / (8 * dx)
+    gy = ndimage.sobel(z, axis=0, mode="nearest") / (8 * dy)
+    return np.hypot(gx, gy)
+
+
+# Rasters opened by each worker process
+_OPENED = {}
+
+
+def _read_padded(raster, window: Window, halo: int, boundary: str, band: int) -> np.ndarray:
+    """Window of a raster with a halo, padded outside the raster"""
+    width, height = raster.dim
+    wide = Window(
+        window.xoff - halo, window.yoff - halo, window.xsize + 2 * halo, window.ysize + 2 * halo
+    )
+    inside = wide.clip(width, height)
+    z = raster.array_float(inside, band)
+    pads = (
+        (inside.yoff - wide.yoff, wide.yoff + wide.ysize - inside.yoff - inside.ysize),
+        (inside.xoff - wide.xoff, wide.xoff + wide.xsize - inside.xoff - inside.xsize),
+    )
+    if boundary == "edge":
+        return np.pad(z, pads, mode="edge")
+    return np.pad(z, pads, constant_values=np.nan)
+
+
+def _filter_window(
+    source, window: Window, func: Callable, halo: int, boundary: str, band: int
+) -> Tuple[Window, np.ndarray]:
+    if isinstance(source, str):
+        from edef.eobject.georaster import GeoRaster
+
+        if source not in _OPENED:
+            _OPENED[source] = GeoRaster.from_file(source)
+        source = _OPENED[source]
+    z = _read_padded(source, window, halo, boundary, band)
+    out = func(z)
+    return window, out[halo : halo + window.ysize, halo : halo + window.xsize]
+
+
+def filter_raster(
+    raster,
+    func: Callable,
+    halo: int,
+    output: Optional[str] = None,
+    boundary: str = "nan",
+    band: int = 1,
+    tile: int = 1024,
+    workers: int = 4,
+    **writer_opts,
+):
+    """Apply a neighbourhood filter tile by tile
+
+    Each tile is read with a halo of `halo` pixels, so the result equals the
+    filter applied on the whole array padded in the same way. Outside the
+    raster, the halo is NaN (`boundary="nan"`) or the edge pixels
+    (`boundary="edge"`). Without `output`, the result is a lazy dask array
+    with the same tiles and halo. Otherwise rasters read from a file are
+    filtered by a pool of processes, in-memory rasters by a pool of threads,
+    and the tiles are written as they come.
+
+    Arguments:
+        raster: GeoRaster or path
+        func: picklable function of a 2D float array (NaN on nodata),
+            returning an array of the same shape
+        halo: radius of the neighbourhood used by `func`, in pixels
+        output: output GeoTiff, lazy result if None
+        boundary: padding outside the raster, "nan" or "edge"
+        band: band number, starting at 1
+        tile: tile size in pixels, at least four times the halo
+        workers: number of processes, the dask scheduler runs a lazy result
+        writer_opts: options of `TiledWriter` (compress, block_size...)
+
+    Returns:
+        filtered GeoRaster, float32 with NaN on nodata
+    """
+    from edef.eobject.georaster import GeoRaster
+
+    if boundary not in ["nan", "edge"]:
+        raise ValueError(f"Unknown boundary {boundary}")
+    if isinstance(raster, str):
+        raster = GeoRaster.from_file(raster)
+    width, height = raster.dim
+    tile = max(tile, 4 * halo)
+    if output is None:
+        raw = raster.to_dask(band)
+        data = raw.astype(np.float64)
+        if raster.nodata() is not None:
+            data = da.where(raster._is_nodata(raw), np.nan, data)
+        data = data.rechunk((tile, tile))
+        out = data.map_overlap(
+            func,
+            depth=halo,
+            boundary=np.nan if boundary == "nan" else "nearest",
+            dtype=np.float64,
+        )
+        return GeoRaster.from_array(out.astype(np.float32), raster)
+
+    writer_opts.setdefault("nodata", np.nan)
+    writer = TiledWriter(
+        output,
+        width,
+        height,
+        geotransform=raster.geotransform,
+        projection=raster.projection or "",
+        **writer_opts,
+    )
+    tile = -(-tile // writer.block_size) * writer.block_size
+
+    if raster.path:
+        source, executor = raster.path, ProcessPoolExecutor(max_workers=workers)
+    else:
+        source, executor = raster, ThreadPoolExecutor(max_workers=workers)
+    windows = iter(
+        [
+            Window(x, y, tile, tile).clip(width, height)
+            for y in range(0, height, tile)
+            for x in range(0, width, tile)
+        ]
+    )
+    task = partial(_filter_window, source, func=func, halo=halo, boundary=boundary, band=band)
+
+    # At most two tiles per worker in flight, results are written as they come
+    with writer, executor:
+        pending = {executor.submit(task, w) for _, w in zip(range(2 * workers), windows)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                window, values = future.result()
+                writer.write(window, values.astype(writer.dtype))
+                window = next(windows, None)
+                if window is not None:
+                    pending.add(executor.submit(task, window))
+    return GeoRaster.from_file(output)
+
+
+def gaussian_filter(
+    raster,
+    sigma: Union[float, Tuple[float, float]],
+    truncate: float = 4.0,
+    keep_nodata: bool = True,
+    **kwargs,
+):
+    """Gaussian smoothing of a raster ignoring nodata, see `gaussian` and `filter_raster`"""
+    halo = int(truncate * (sigma if np.isscalar(sigma) else max(sigma)) + 0.5)
+    func = partial(gaussian, sigma=sigma, truncate=truncate, keep_nodata=keep_nodata)
+    return filter_raster(raster, func, halo, **kwargs)
+
+
+def median_filter(raster, size: int, keep_nodata: bool = True, **kwargs):
+    """Median filter of a raster ignoring nodata, see `median` and `filter_raster`"""
+    func = partial(median, size=size, keep_nodata=keep_nodata)
+    return filter_raster(raster, func, size // 2, **kwargs)
+
+
+def convolve_filter(raster, kernel: np.ndarray, normalized: bool = True, **kwargs):
+    """Convolution of a raster by a custom kernel, see `convolve` and `filter_raster`"""
+    kernel = np.asarray(kernel)
+    func = partial(convolve, kernel=kernel, normalized=normalized)
+    return filter_raster(raster, func, max(kernel.shape) // 2, **kwargs)
+
+
+def sobel_filter(raster, **kwargs):
+    """Sobel gradient magnitude of a raster, in unit of z per meter"""
+    if isinstance(raster, str):
+        from edef.eobject.georaster import GeoRaster
+
+        raster = GeoRaster.from_file(raster)
+    dx, dy = raster.pixel_spacing()
+    return filter_raster(raster, partial(sobel, dx=dx, dy=dy), 1, boundary="edge", **kwargs)
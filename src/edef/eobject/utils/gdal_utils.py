@@ -1,4 +1,8 @@
-from osgeo import gdal
+from osgeo import gdal, gdal_array
+from collections import OrderedDict
+from threading import Lock, local
+from typing import Iterable, Iterator, NamedTuple, Optional, Tuple
+import numpy as np
 import os
 
 
@@ -14,14 +18,558 @@ def open_tif(full_path):
     return (values, nlines, ncols, proj, geotransform)
 
 
-def save_tif(full_path, data, ncol, nrow, proj, geotransform):
-    drv = gdal.GetDriverByName("GTiff")
-    dst_ds = drv.Create(full_path, ncol, nrow, 1, gdal.GDT_Float32)
-    dst_band = dst_ds.GetRasterBand(1)
-    dst_ds.SetGeoTransform(geotransform)
-    dst_ds.SetProjection(proj)
-    dst_band.WriteArray(data)
-    dst_ds.FlushCache()
+def save_tif(full_path, data, ncol, nrow, proj, geotransform, **kwargs):
+    """Save an array as a tiled and compressed GeoTiff
+
+    Arguments:
+        kwargs: options of `TiledWriter`, the data type defaults to Float32
+    """
+    kwargs.setdefault("dtype", np.float32)
+    with TiledWriter(
+        full_path, ncol, nrow, geotransform=geotransform, projection=proj, **kwargs
+    ) as writer:
+        for window in writer.iter_windows():
+            writer.write(window, data[window.slices()])
+
+
+class Window(NamedTuple):
+    """Pixel window - offset and size of a raster portion
+
+    Attributes:
+        xoff: column of the upper left pixel
+        yoff: line of the upper left pixel
+        xsize: number of columns
+        ysize: number of lines
+    """
+
+    xoff: int
+    yoff: int
+    xsize: int
+    ysize: int
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.ysize, self.xsize
+
+    def clip(self, width: int, height: int) -> Optional["Window"]:
+        """Restrict the window to a raster of size `width` x `height`
+
+        Return None if the window does not overlap the raster.
+        """
+        x0, y0 = max(self.xoff, 0), max(self.yoff, 0)
+        x1 = min(self.xoff + self.xsize, width)
+        y1 = min(self.yoff + self.ysize, height)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return Window(x0, y0, x1 - x0, y1 - y0)
+
+    def intersection(self, other: "Window") -> Optional["Window"]:
+        x0, y0 = max(self.xoff, other.xoff), max(self.yoff, other.yoff)
+        x1 = min(self.xoff + self.xsize, other.xoff + other.xsize)
+        y1 = min(self.yoff + self.ysize, other.yoff + other.ysize)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return Window(x0, y0, x1 - x0, y1 - y0)
+
+    def slices(self, origin: Optional["Window"] = None) -> Tuple[slice, slice]:
+        """Numpy slices of the window, relative to the `origin` window if given"""
+        x0 = self.xoff - origin.xoff if origin else self.xoff
+        y0 = self.yoff - origin.yoff if origin else self.yoff
+        return slice(y0, y0 + self.ysize), slice(x0, x0 + self.xsize)
+
+
+class BlockCache:
+    """Least recently used cache of decoded raster blocks
+
+    Arguments:
+        max_bytes: memory budget of the cache, oldest blocks are dropped first
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._blocks = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def get(self, key) -> Optional[np.ndarray]:
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+            return block
+
+    def put(self, key, block: np.ndarray):
+        if block.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._blocks:
+                self.nbytes -= self._blocks.pop(key).nbytes
+            self._blocks[key] = block
+            self.nbytes += block.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self._blocks.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.nbytes = 0
+
+
+class BlockReader:
+    """Windowed GeoTiff reader aligned on the internal blocks of the file
+
+    Only the blocks overlapping a requested window are decoded. When a
+    `BlockCache` is given, decoded blocks are kept so that neighbouring
+    windows do not decode them again.
+
+    Arguments:
+        path: path to the GeoTiff
+        cache: optional block cache, can be shared between readers
+    """
+
+    def __init__(self, path: str, cache: Optional[BlockCache] = None):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"File {path} not found")
+        self.path = path
+        self.cache = cache
+        self.dataset = gdal.OpenEx(
+            path, gdal.OF_RASTER | gdal.OF_READONLY, allowed_drivers=["GTiff"]
+        )
+        if self.dataset is None:
+            raise ValueError(f"File {path} could not be opened as a GeoTiff")
+        self.width = self.dataset.RasterXSize
+        self.height = self.dataset.RasterYSize
+        self.count = self.dataset.RasterCount
+        band = self.dataset.GetRasterBand(1)
+        self.block_xsize, self.block_ysize = band.GetBlockSize()
+        self.dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+        self.nodata = band.GetNoDataValue()
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.dataset = None
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.height, self.width
+
+    def full_window(self) -> Window:
+        return Window(0, 0, self.width, self.height)
+
+    def block_window(self, bx: int, by: int) -> Window:
+        """Pixel window of the block at column `bx` and line `by`"""
+        return Window(
+            bx * self.block_xsize, by * self.block_ysize, self.block_xsize, self.block_ysize
+        ).clip(self.width, self.height)
+
+    def blocks(self, window: Window) -> Iterator[Tuple[int, int]]:
+        """Indices of the blocks overlapping the window"""
+        bx0 = window.xoff // self.block_xsize
+        by0 = window.yoff // self.block_ysize
+        bx1 = (window.xoff + window.xsize - 1) // self.block_xsize
+        by1 = (window.yoff + window.ysize - 1) // self.block_ysize
+        for by in range(by0, by1 + 1):
+            for bx in range(bx0, bx1 + 1):
+                yield bx, by
+
+    def aligned_window(self, window: Window) -> Window:
+        """Smallest block aligned window containing `window`"""
+        x0 = window.xoff // self.block_xsize * self.block_xsize
+        y0 = window.yoff // self.block_ysize * self.block_ysize
+        x1 = -(-(window.xoff + window.xsize) // self.block_xsize) * self.block_xsize
+        y1 = -(-(window.yoff + window.ysize) // self.block_ysize) * self.block_ysize
+        return Window(x0, y0, x1 - x0, y1 - y0).clip(self.width, self.height)
+
+    def iter_windows(
+        self, tile_xsize: Optional[int] = None, tile_ysize: Optional[int] = None
+    ) -> Iterator[Window]:
+        """Cover the raster with block aligned windows
+
+        Tile sizes are rounded up to a multiple of the block size and default
+        to a single block.
+        """
+        tx = -(-(tile_xsize or self.block_xsize) // self.block_xsize) * self.block_xsize
+        ty = -(-(tile_ysize or self.block_ysize) // self.block_ysize) * self.block_ysize
+        for y in range(0, self.height, ty):
+            for x in range(0, self.width, tx):
+                yield Window(x, y, tx, ty).clip(self.width, self.height)
+
+    def _read_raw(self, window: Window, band: int) -> np.ndarray:
+        # GDAL datasets are not thread safe
+        with self._lock:
+            return self.dataset.GetRasterBand(band).ReadAsArray(
+                window.xoff, window.yoff, window.xsize, window.ysize
+            )
+
+    def read_block(self, bx: int, by: int, band: int = 1) -> np.ndarray:
+        """Decoded block, taken from the cache when available"""
+        key = (self.path, band, bx, by)
+        if self.cache is not None:
+            block = self.cache.get(key)
+            if block is not None:
+                return block
+        block = self._read_raw(self.block_window(bx, by), band)
+        if self.cache is not None:
+            block.flags.writeable = False
+            self.cache.put(key, block)
+        return block
+
+    def read(self, window: Optional[Window] = None, band: int = 1) -> np.ndarray:
+        """Read a window of a band
+
+        Arguments:
+            window: pixel window, the full raster if None
+            band: band number, starting at 1
+        """
+        if window is None:
+            window = self.full_window()
+        clipped = window.clip(self.width, self.height)
+        if clipped != window:
+            raise ValueError(
+                f"Window {window} is outside of the raster ({self.width}x{self.height})"
+            )
+        if band < 1 or band > self.count:
+            raise ValueError(f"Band {band} not in the raster (1-{self.count})")
+        if self.cache is None:
+            return self._read_raw(window, band)
+
+        out = np.empty(window.shape, dtype=self.dtype)
+        for bx, by in self.blocks(window):
+            block_win = self.block_window(bx, by)
+            overlap = block_win.intersection(window)
+            out[overlap.slices(window)] = self.read_block(bx, by, band)[
+                overlap.slices(block_win)
+            ]
+        return out
+
+
+class TiledWriter:
+    """Incremental writer of tiled and compressed GeoTiffs
+
+    Blocks are written as they come, so the full raster never has to be in
+    memory. With `cog`, the file is written to a temporary GeoTiff and
+    converted to a Cloud Optimized GeoTiff with internal overviews when the
+    writer is closed.
+
+    Arguments:
+        path: output path
+        width: number of columns
+        height: number of lines
+        count: number of bands
+        dtype: numpy data type of the bands
+        geotransform: GDAL geotransform
+        projection: WKT of the spatial reference system
+        nodata: nodata value set on every band
+        compress: "DEFLATE", "ZSTD", "LZW" or "NONE"
+        level: compression level, default to the GDAL one
+        predictor: 1 (none), 2 (integers) or 3 (floats), chosen from the
+            data type if None
+        block_size: size of the square internal tiles, multiple of 16
+        cog: finish as a Cloud Optimized GeoTiff
+        resampling: resampling of the COG overviews
+    """
+
+    def __init__(
+        self,
+        path: str,
+        width: int,
+        height: int,
+        count: int = 1,
+        dtype=np.float32,
+        geotransform: Optional[Tuple[float, ...]] = None,
+        projection: str = "",
+        nodata: Optional[float] = None,
+        compress: str = "DEFLATE",
+        level: Optional[int] = None,
+        predictor: Optional[int] = None,
+        block_size: int = 512,
+        cog: bool = False,
+        resampling: str = "AVERAGE",
+    ):
+        compress = compress.upper()
+        if compress not in ["DEFLATE", "ZSTD", "LZW", "NONE"]:
+            raise ValueError(f"Compression {compress} is not supported")
+        if block_size % 16 != 0:
+            raise ValueError(f"Block size {block_size} is not a multiple of 16")
+        self.path = path
+        self.width = width
+        self.height = height
+        self.count = count
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        self.cog = cog
+        self.resampling = resampling
+
+        if predictor is None:
+            predictor = 3 if self.dtype.kind == "f" else 2
+        self.options = [f"COMPRESS={compress}"]
+        if compress != "NONE":
+            self.options.append(f"PREDICTOR={predictor}")
+        if level is not None and compress == "DEFLATE":
+            self.options.append(f"ZLEVEL={level}")
+        if level is not None and compress == "ZSTD":
+            self.options.append(f"ZSTD_LEVEL={level}")
+
+        self._target = path + ".tmp.tif" if cog else path
+        self.dataset = gdal.GetDriverByName("GTiff").Create(
+            self._target,
+            width,
+            height,
+            count,
+            gdal_array.NumericTypeCodeToGDALTypeCode(self.dtype),
+            options=self.options
+            + [
+                "TILED=YES",
+                f"BLOCKXSIZE={block_size}",
+                f"BLOCKYSIZE={block_size}",
+                "BIGTIFF=IF_SAFER",
+            ],
+        )
+        if self.dataset is None:
+            raise ValueError(f"File {path} could not be created")
+        if geotransform is not None:
+            self.dataset.SetGeoTransform(geotransform)
+        if projection:
+            self.dataset.SetProjection(projection)
+        if nodata is not None:
+            for b in range(count):
+                self.dataset.GetRasterBand(b + 1).SetNoDataValue(nodata)
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.dataset = None
+
+    def iter_windows(self) -> Iterator[Window]:
+        """Windows of the internal tiles, in file order"""
+        for y in range(0, self.height, self.block_size):
+            for x in range(0, self.width, self.block_size):
+                yield Window(x, y, self.block_size, self.block_size).clip(
+                    self.width, self.height
+                )
+
+    def write(self, window: Window, block: np.ndarray, band: Optional[int] = None):
+        """Write a block at a window
+
+        Arguments:
+            window: pixel window of the block
+            block: (lines, columns) array, or (bands, lines, columns) to
+                write all the bands at once
+            band: band number of a 2D block, default to 1
+        """
+        block = np.asarray(block)
+        if block.shape[-2:] != window.shape:
+            raise ValueError(f"Block shape {block.shape} does not match {window}")
+        if block.ndim == 2:
+            blocks = {band or 1: block}
+        else:
+            blocks = {b + 1: block[b] for b in range(block.shape[0])}
+        with self._lock:
+            for b, values in blocks.items():
+                self.dataset.GetRasterBand(b).WriteArray(
+                    values.astype(self.dtype, copy=False), window.xoff, window.yoff
+                )
+
+    def __setitem__(self, key, value):
+        # Target interface of dask.array.store
+        rows, cols = key[-2:]
+        y0, y1, _ = rows.indices(self.height)
+        x0, x1, _ = cols.indices(self.width)
+        window = Window(x0, y0, x1 - x0, y1 - y0)
+        if len(key) == 3:
+            b0, b1, _ = key[0].indices(self.count)
+            for b in range(b0, b1):
+                self.write(window, value[b - b0], b + 1)
+        else:
+            self.write(window, value)
+
+    def close(self):
+        """Flush the data, and convert to COG if requested"""
+        if self.dataset is None:
+            return
+        self.dataset.FlushCache()
+        self.dataset = None
+        if self.cog:
+            # The COG driver names the DEFLATE and ZSTD levels LEVEL
+            options = [
+                "LEVEL=" + o.split("=", 1)[1] if o.startswith(("ZLEVEL=", "ZSTD_LEVEL=")) else o
+                for o in self.options
+            ]
+            options += [
+                f"BLOCKSIZE={self.block_size}",
+                "OVERVIEWS=AUTO",
+                f"OVERVIEW_RESAMPLING={self.resampling}",
+                "BIGTIFF=IF_SAFER",
+            ]
+            gdal.Translate(
+                self.path, self._target, format="COG", creationOptions=options
+            )
+            gdal.GetDriverByName("GTiff").Delete(self._target)
+
+
+def write_blocks(
+    path: str, blocks: Iterable[Tuple[Window, np.ndarray]], width: int, height: int, **kwargs
+):
+    """Write (window, block) pairs as they are produced
+
+    Arguments:
+        blocks: iterable of windows and (lines, columns) or (bands, lines,
+            columns) arrays
+        kwargs: options of `TiledWriter`
+    """
+    with TiledWriter(path, width, height, **kwargs) as writer:
+        for window, block in blocks:
+            writer.write(window, block)
+
+
+def write_dask(path: str, array, **kwargs):
+    """Compute a dask array chunk by chunk into a GeoTiff
+
+    Chunks are written as soon as they are computed, the full array is never
+    held in memory.
+
+    Arguments:
+        array: (lines, columns) or (bands, lines, columns) dask array
+        kwargs: options of `TiledWriter`, the data type defaults to the
+            array one
+    """
+    import dask.array as da
+
+    kwargs.setdefault("dtype", array.dtype)
+    count = array.shape[0] if array.ndim == 3 else 1
+    with TiledWriter(
+        path, array.shape[-1], array.shape[-2], count=count, **kwargs
+    ) as writer:
+        da.store(array, writer, lock=False)
+
+
+def memmap_band(path: str, band: int = 1) -> Optional[np.ndarray]:
+    """Zero copy view of a band of an uncompressed GeoTiff
+
+    Only files whose pixels are stored as contiguous strips are mapped,
+    band or pixel interleaved. For pixel interleaved files the view is
+    strided over the bands.
+
+    Arguments:
+        path: path to the GeoTiff
+        band: band number, starting at 1
+
+    Returns:
+        read only `numpy.memmap` (lines, columns) view, or None when the
+        layout can not be mapped (compressed, tiled, sparse...)
+    """
+    ds = gdal.OpenEx(path, gdal.OF_RASTER | gdal.OF_READONLY, allowed_drivers=["GTiff"])
+    if ds is None:
+        raise ValueError(f"File {path} could not be opened as a GeoTiff")
+    if ds.GetMetadataItem("COMPRESSION", "IMAGE_STRUCTURE"):
+        return None
+    width, height, count = ds.RasterXSize, ds.RasterYSize, ds.RasterCount
+    if band < 1 or band > count:
+        raise ValueError(f"Band {band} not in the raster (1-{count})")
+    pixel_interleaved = count > 1 and (
+        ds.GetMetadataItem("INTERLEAVE", "IMAGE_STRUCTURE") == "PIXEL"
+    )
+    src_band = ds.GetRasterBand(1 if pixel_interleaved else band)
+    block_xsize, block_ysize = src_band.GetBlockSize()
+    if block_xsize != width:
+        return None
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(src_band.DataType))
+    nstrips = -(-height // block_ysize)
+    samples = count if pixel_interleaved else 1
+    strip_bytes = block_ysize * width * samples * dtype.itemsize
+    # Every strip must be written (sparse files have null offsets) and follow
+    # the previous one
+    offsets = []
+    for i in range(nstrips):
+        offset = src_band.GetMetadataItem(f"BLOCK_OFFSET_0_{i}", "TIFF")
+        if not offset or int(offset) == 0:
+            return None
+        offsets.append(int(offset))
+        if offsets[i] != offsets[0] + i * strip_bytes:
+            return None
+
+    with open(path, "rb") as f:
+        byte_order = f.read(2)
+    dtype = dtype.newbyteorder("<" if byte_order == b"II" else ">")
+    shape = (height, width, samples) if pixel_interleaved else (height, width)
+    view = np.memmap(path, dtype=dtype, mode="r", offset=offsets[0], shape=shape)
+    return view[:, :, band - 1] if pixel_interleaved else view
+
+
+class LazyBand:
+    """Array-like access to a GeoTiff band, to be wrapped by `dask.array`
+
+    Each thread opens its own `BlockReader` as GDAL datasets can not be
+    shared between threads. Only the path is pickled, so the object can be
+    sent to worker processes.
+
+    Arguments:
+        path: path to the GeoTiff
+        band: band number, starting at 1
+        cache: optional block cache, not sent to worker processes
+    """
+
+    def __init__(self, path: str, band: int = 1, cache: Optional[BlockCache] = None):
+        self.path = path
+        self.band = band
+        self.cache = cache
+        with BlockReader(path) as reader:
+            self.shape = reader.shape
+            self.dtype = reader.dtype
+            self.block_shape = (reader.block_ysize, reader.block_xsize)
+        self.ndim = 2
+        self._local = local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["cache"] = None
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = local()
+
+    def _reader(self) -> BlockReader:
+        reader = getattr(self._local, "reader", None)
+        if reader is None:
+            reader = BlockReader(self.path, cache=self.cache)
+            self._local.reader = reader
+        return reader
+
+    def __getitem__(self, key) -> np.ndarray:
+        rows, cols = key
+        y0, y1, _ = rows.indices(self.shape[0])
+        x0, x1, _ = cols.indices(self.shape[1])
+        if y1 <= y0 or x1 <= x0:
+            return np.empty((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=self.dtype)
+        return self._reader().read(Window(x0, y0, x1 - x0, y1 - y0), self.band)
+
+
+def block_chunks(
+    block_shape: Tuple[int, int], target: int = 2048
+) -> Tuple[int, int]:
+    """Chunk shape made of whole blocks, close to `target` pixels per side
+
+    Striped files (blocks of a single line or a few) are grouped into
+    chunks of `target` lines.
+    """
+    return tuple(max(b, target // b * b) for b in block_shape)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,238 @@
+# Decimated levels of a GeoTiff, built in a single pass over its blocks
+
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from os import makedirs, remove, stat
+from os.path import basename, join
+from typing import List, Optional
+import json
+import numpy as np
+
+from edef.eobject.utils.gdal_utils import BlockReader, TiledWriter, Window
+
+RESAMPLINGS = ["average", "nearest", "mode", "min", "max"]
+
+
+def decimate(array: np.ndarray, factor: int, method: str = "average") -> np.ndarray:
+    """Reduce an array by an integer factor, ignoring NaN
+
+    Cells on the right and bottom edges may be incomplete, they are reduced
+    from the pixels available. Cells without valid pixel are NaN.
+
+    Arguments:
+        array: (lines, columns) array
+        factor: decimation factor
+        method: "average", "nearest", "mode", "min" or "max"
+    """
+    if method not in RESAMPLINGS:
+        raise ValueError(f"Unknown resampling {method}, use one of {RESAMPLINGS}")
+    h, w = array.shape
+    ch, cw = -(-h // factor), -(-w // factor)
+    if method == "nearest":
+        rows = np.minimum(np.arange(ch) * factor + factor // 2, h - 1)
+        cols = np.minimum(np.arange(cw) * factor + factor // 2, w - 1)
+        return np.asarray(array, dtype=np.float64)[np.ix_(rows, cols)]
+
+    padded = np.full((ch * factor, cw * factor), np.nan)
+    padded[:h, :w] = array
+    cells = padded.reshape(ch, factor, cw, factor).swapaxes(1, 2).reshape(ch, cw, factor**2)
+    if method == "min":
+        return np.fmin.reduce(cells, axis=-1)
+    if method == "max":
+        return np.fmax.reduce(cells, axis=-1)
+    if method == "mode":
+        return _mode(cells.reshape(-1, factor**2)).reshape(ch, cw)
+    valid = ~np.isnan(cells)
+    count = valid.sum(axis=-1)
+    total = np.where(valid, cells, 0.0).sum(axis=-1)
+    out = np.full((ch, cw), np.nan)
+    np.divide(total, count, out=out, where=count > 0)
+    return out
+
+
+def _mode(rows: np.ndarray) -> np.ndarray:
+    """Most frequent value of each row, the smallest one on ties, NaN ignored"""
+    n, m = rows.shape
+    s = np.sort(rows, axis=1).ravel()
+    # Start of the runs of equal values, each row starting a new run
+    start = np.ones(s.size, dtype=bool)
+    start[1:] = s[1:] != s[:-1]
+    start[::m] = True
+    starts = np.flatnonzero(start)
+    lengths = np.diff(np.append(starts, s.size))
+    lengths[np.isnan(s[starts])] = 0
+    row = starts // m
+    # Longest run of each row, runs being sorted by value inside a row
+    order = np.lexsort((-lengths, row))
+    first = order[np.r_[True, row[order][1:] != row[order][:-1]]]
+    return s[starts[first]]
+
+
+class Pyramid:
+    """Levels of a raster decimated by 2, 4, 8... down to a minimum size
+
+    Levels are tiled GeoTiffs `x<factor>.tif` in the folder `<raster>.pyramid`,
+    with the data type and nodata of the raster. They are all produced by a
+    single pass over the raster: each tile read is reduced to every level
+    directly, so "mode", "nearest", "min" and "max" are exact at every level.
+    The size and modification time of the raster are kept in `source.json`,
+    levels of a raster overwritten since are not opened.
+
+    Arguments:
+        folder: folder of the levels
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.paths = {}
+        for path in glob(join(folder, "x*.tif")):
+            factor = basename(path)[1:-4]
+            if factor.isdigit():
+                self.paths[int(factor)] = path
+        self._readers = {}
+
+    @property
+    def factors(self) -> List[int]:
+        return sorted(self.paths)
+
+    @staticmethod
+    def folder_of(path: str) -> str:
+        return path + ".pyramid"
+
+    @staticmethod
+    def _source(path: str) -> dict:
+        st = stat(path)
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+    @staticmethod
+    def open(path: str) -> Optional["Pyramid"]:
+        """Pyramid of a raster, None if it has not been built or is out of date"""
+        folder = Pyramid.folder_of(path)
+        try:
+            with open(join(folder, "source.json")) as f:
+                source = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return Pyramid(folder) if source == Pyramid._source(path) else None
+
+    @staticmethod
+    def build(
+        path: str,
+        method: str = "average",
+        min_size: int = 256,
+        tile: int = 1024,
+        workers: int = 4,
+        **writer_opts,
+    ) -> "Pyramid":
+        """Compute the levels of a GeoTiff
+
+        Arguments:
+            path: path to the GeoTiff
+            method: resampling, see `decimate`
+            min_size: levels stop when the largest side would be smaller
+            tile: minimum size of the tiles read from the raster
+            workers: number of threads
+            writer_opts: options of `TiledWriter` (compress, block_size...)
+        """
+        if method not in RESAMPLINGS:
+            raise ValueError(f"Unknown resampling {method}, use one of {RESAMPLINGS}")
+        reader = BlockReader(path)
+        factors = []
+        while max(reader.width, reader.height) // (2 ** (len(factors) + 1)) >= min_size:
+            factors.append(2 ** (len(factors) + 1))
+
+        folder = Pyramid.folder_of(path)
+        makedirs(folder, exist_ok=True)
+        for old in glob(join(folder, "x*.tif")) + glob(join(folder, "source.json")):
+            remove(old)
+        if not factors:
+            return Pyramid(folder)
+
+        x0, dx, rx, y0, ry, dy = reader.dataset.GetGeoTransform()
+        projection = reader.dataset.GetProjection()
+        writer_opts.setdefault("block_size", 256)
+        writers = {
+            f: TiledWriter(
+                join(folder, f"x{f}.tif"),
+                -(-reader.width // f),
+                -(-reader.height // f),
+                count=reader.count,
+                dtype=reader.dtype,
+                geotransform=(x0, dx * f, rx, y0, ry, dy * f),
+                projection=projection,
+                nodata=reader.nodata,
+                **writer_opts,
+            )
+            for f in factors
+        }
+
+        # Tiles aligned on the coarsest level cells and on the file blocks
+        coarsest = factors[-1]
+        if reader.block_xsize >= reader.width:
+            # Striped file: full width strips of about tile * tile pixels
+            step = int(np.lcm(coarsest, reader.block_ysize))
+            lines = max(tile * tile // reader.width, 1)
+            size_x, size_y = reader.width, -(-lines // step) * step
+        else:
+            step = int(np.lcm.reduce([coarsest, reader.block_xsize, reader.block_ysize]))
+            size_x = size_y = -(-tile // step) * step
+        integer = reader.dtype.kind in "iub"
+        fill = reader.nodata if reader.nodata is not None else 0
+
+        def process(window: Window):
+            for band in range(1, reader.count + 1):
+                raw = reader.read(window, band)
+                array = raw.astype(np.float64)
+                if reader.nodata is not None:
+                    nodata = reader.nodata
+                    if raw.dtype.kind == "f":
+                        nodata = raw.dtype.type(nodata)
+                    array[raw == nodata] = np.nan
+                for f, writer in writers.items():
+                    level = decimate(array, f, method)
+                    if integer:
+                        level = np.where(np.isnan(level), fill, np.round(level))
+                    elif reader.nodata is not None:
+                        level[np.isnan(level)] = reader.nodata
+                    target = Window(window.xoff // f, window.yoff // f, *level.shape[::-1])
+                    writer.write(target, level.astype(writer.dtype), band)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(process, reader.iter_windows(size_x, size_y)))
+        finally:
+            for writer in writers.values():
+                writer.close()
+            reader.close()
+        with open(join(folder, "source.json"), "w") as f:
+            json.dump(Pyramid._source(path), f)
+        return Pyramid(folder)
+
+    def factor_for(self, factor: float) -> int:
+        """Largest level factor not larger than `factor`, 1 for the raster itself"""
+        return max([f for f in self.factors if f <= factor + 1e-9], default=1)
+
+    @staticmethod
+    def level_window(window: Window, factor: int) -> Window:
+        """Window of a level covering a window of the raster"""
+        x0, y0 = window.xoff // factor, window.yoff // factor
+        x1 = -(-(window.xoff + window.xsize) // factor)
+        y1 = -(-(window.yoff + window.ysize) // factor)
+        return Window(x0, y0, x1 - x0, y1 - y0)
+
+    def reader(self, factor: int) -> BlockReader:
+        if factor not in self._readers:
+            self._readers[factor] = BlockReader(self.paths[factor])
+        return self._readers[factor]
+
+    def read(self, factor: int, window: Window, band: int = 1) -> np.ndarray:
+        """Read the level covering a window of the raster
+
+        Arguments:
+            factor: level factor
+            window: pixel window of the raster (not of the level)
+            band: band number, starting at 1
+        """
+        reader = self.reader(factor)
+        level = self.level_window(window, factor).clip(reader.width, reader.height)
+        return reader.read(level, band)
@@ -0,0 +1,116 @@
+# Spatial reference systems and cached coordinate transformations
+
+from threading import local
+from typing import Optional, Union
+import numpy as np
+from osgeo import osr
+
+SrsLike = Union[osr.SpatialReference, int, str]
+
+# CoordinateTransformation objects are not thread safe, each thread keeps
+# its own cache
+_local = local()
+
+
+def to_srs(srs: SrsLike) -> osr.SpatialReference:
+    """Spatial reference from an EPSG code, a WKT / "EPSG:xxxx" string or a SpatialReference
+
+    The axis order is always x, y (longitude, latitude for geographic systems).
+    """
+    if isinstance(srs, osr.SpatialReference):
+        out = srs.Clone()
+    else:
+        out = osr.SpatialReference()
+        if isinstance(srs, int):
+            out.ImportFromEPSG(srs)
+        elif srs.upper().startswith("EPSG:"):
+            out.ImportFromEPSG(int(srs.split(":")[1]))
+        else:
+            out.ImportFromWkt(srs)
+    out.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return out
+
+
+def srs_key(srs: SrsLike) -> str:
+    """Canonical key of a spatial reference: "EPSG:xxxx" when known, else the WKT"""
+    if isinstance(srs, int):
+        return f"EPSG:{srs}"
+    if isinstance(srs, str):
+        if srs.upper().startswith("EPSG:"):
+            return srs.upper()
+        srs = to_srs(srs)
+    if srs.GetAuthorityName(None) == "EPSG" and srs.GetAuthorityCode(None):
+        return f"EPSG:{srs.GetAuthorityCode(None)}"
+    return srs.ExportToWkt()
+
+
+def same_srs(a: Optional[osr.SpatialReference], b: Optional[osr.SpatialReference]) -> bool:
+    """Whether two spatial references are the same, None only equals None"""
+    if a is None or b is None:
+        return a is b
+    return bool(a.IsSame(b))
+
+
+def get_transform(src: SrsLike, dst: SrsLike) -> osr.CoordinateTransformation:
+    """Coordinate transformation between two systems, built once per thread"""
+    cache = getattr(_local, "transforms", None)
+    if cache is None:
+        cache = _local.transforms = {}
+    key = (srs_key(src), srs_key(dst))
+    transform = cache.get(key)
+    if transform is None:
+        transform = osr.CoordinateTransformation(to_srs(src), to_srs(dst))
+        cache[key] = transform
+    return transform
+
+
+def transform_points(points, src: SrsLike, dst: SrsLike) -> np.ndarray:
+    """Transform an (N, 2) or (N, 3) array of points in a single call
+
+    Points which can not be transformed are set to inf.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    shape = points.shape
+    points = points.reshape(-1, shape[-1])
+    if srs_key(src) == srs_key(dst) or points.shape[0] == 0:
+        return points.reshape(shape).copy()
+    out = np.asarray(get_transform(src, dst).TransformPoints(points), dtype=np.float64)
+    return out[:, : shape[-1]].reshape(shape)
+
+
+def densify_bounds(bounds, densify: int = 21) -> np.ndarray:
+    """(N, 4 * (densify - 1), 2) points along the edges of (N, 4) xmin, xmax, ymin, ymax boxes"""
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    t = np.linspace(0, 1, densify)[:-1]
+    xmin, xmax, ymin, ymax = (bounds[:, i, None] for i in range(4))
+    x = xmin + (xmax - xmin) * t
+    y = ymin + (ymax - ymin) * t
+    edges = [
+        (x, np.broadcast_to(ymin, x.shape)),
+        (np.broadcast_to(xmax, y.shape), y),
+        (xmax - (x - xmin), np.broadcast_to(ymax, x.shape)),
+        (np.broadcast_to(xmin, y.shape), ymax - (y - ymin)),
+    ]
+    xs = np.concatenate([e[0] for e in edges], axis=1)
+    ys = np.concatenate([e[1] for e in edges], axis=1)
+    return np.stack([xs, ys], axis=-1)
+
+
+def transform_bounds(bounds, src: SrsLike, dst: SrsLike, densify: int = 21) -> np.ndarray:
+    """Reproject (N, 4) xmin, xmax, ymin, ymax boxes
+
+    The edges of each box are densified so that the reprojected box
+    contains the curved image of the edges. All the points of all the boxes
+    are transformed in a single call.
+    """
+    points = densify_bounds(bounds, densify)
+    if points.shape[0] == 0:
+        return np.empty((0, 4))
+    out = transform_points(points.reshape(-1, 2), src, dst).reshape(points.shape)
+    valid = np.isfinite(out).all(axis=-1, keepdims=True)
+    mins = np.where(valid, out, np.inf).min(axis=1)
+    maxs = np.where(valid, out, -np.inf).max(axis=1)
+    result = np.stack([mins[:, 0], maxs[:, 0], mins[:, 1], maxs[:, 1]], axis=1)
+    # Boxes with no point transformed
+    result[~valid.any(axis=1)[:, 0]] = np.nan
+    return result
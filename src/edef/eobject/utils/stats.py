@@ -0,0 +1,220 @@
+# Statistics accumulated block by block over rasters larger than memory
+
+from typing import Dict, Iterable, List, Optional, Sequence
+import numpy as np
+
+# Scale factor of the median absolute deviation to the standard deviation
+NMAD_SCALE = 1.4826
+
+
+class RunningStats:
+    """Count, mean, variance, minimum and maximum updated by batches
+
+    Batches are combined with the parallel form of Welford's algorithm, so
+    partial statistics of tiles or threads can be merged. NaN are ignored.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+        batch = RunningStats()
+        batch.count = values.size
+        batch.mean = float(values.mean())
+        batch.m2 = float(np.square(values - batch.mean).sum())
+        batch.min = float(values.min())
+        batch.max = float(values.max())
+        self.merge(batch)
+
+    def merge(self, other: "RunningStats"):
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self.m2 / self.count)) if self.count else np.nan
+
+    def summary(self) -> Dict[str, float]:
+        empty = self.count == 0
+        return {
+            "count": self.count,
+            "mean": np.nan if empty else self.mean,
+            "std": self.std,
+            "min": np.nan if empty else self.min,
+            "max": np.nan if empty else self.max,
+        }
+
+
+class HistogramSketch:
+    """Fixed width histogram giving quantiles and NMAD in a single pass
+
+    Quantiles are exact up to the bin width. Values beyond +/- `limit` are
+    counted in the edge bins, so they keep their rank.
+
+    Arguments:
+        bin_width: width of the bins, in the unit of the values
+        limit: half range covered by the bins
+    """
+
+    def __init__(self, bin_width: float = 0.01, limit: float = 1000.0):
+        self.bin_width = bin_width
+        self.limit = limit
+        self.counts = np.zeros(int(np.ceil(2 * limit / bin_width)), dtype=np.int64)
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def update(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+        idx = np.floor((values + self.limit) / self.bin_width).astype(np.int64)
+        np.clip(idx, 0, self.counts.size - 1, out=idx)
+        self.counts += np.bincount(idx, minlength=self.counts.size)
+
+    def merge(self, other: "HistogramSketch"):
+        if other.bin_width != self.bin_width or other.limit != self.limit:
+            raise ValueError("Histograms with different bins can not be merged")
+        self.counts += other.counts
+
+    def quantiles(self, q: Sequence[float]) -> np.ndarray:
+        """Values at the quantiles `q` (in [0, 1]), linearly interpolated in the bins"""
+        return _weighted_quantiles(self._edges(), self.counts, q)
+
+    def median(self) -> float:
+        return float(self.quantiles([0.5])[0])
+
+    def nmad(self) -> float:
+        """Normalized median absolute deviation, 1.4826 * median(|x - median(x)|)"""
+        if self.count == 0:
+            return np.nan
+        centers = self._edges()[:-1] + self.bin_width / 2
+        deviations = np.abs(centers - self.median())
+        order = np.argsort(deviations, kind="stable")
+        counts = self.counts[order]
+        cdf = np.cumsum(counts)
+        i = int(np.searchsorted(cdf, cdf[-1] / 2))
+        return NMAD_SCALE * float(deviations[order][i])
+
+    def _edges(self) -> np.ndarray:
+        return -self.limit + np.arange(self.counts.size + 1) * self.bin_width
+
+
+def _weighted_quantiles(edges: np.ndarray, counts: np.ndarray, q: Sequence[float]) -> np.ndarray:
+    q = np.asarray(q, dtype=np.float64)
+    total = counts.sum()
+    if total == 0:
+        return np.full(q.shape, np.nan)
+    cdf = np.concatenate([[0], np.cumsum(counts)])
+    targets = q * total
+    # Bin i such as cdf[i] < target <= cdf[i + 1], the first filled bin for 0
+    i = np.where(
+        targets > 0,
+        np.searchsorted(cdf, targets, side="left") - 1,
+        np.searchsorted(cdf, targets, side="right") - 1,
+    )
+    i = np.clip(i, 0, counts.size - 1)
+    frac = (targets - cdf[i]) / np.maximum(counts[i], 1)
+    return edges[i] + np.clip(frac, 0, 1) * (edges[i + 1] - edges[i])
+
+
+class BinnedStats:
+    """Statistics of values grouped by bins of another variable (slope...)
+
+    Arguments:
+        edges: bin edges of the grouping variable
+        bin_width: width of the histogram bins of the values
+        limit: half range of the histograms of the values
+    """
+
+    def __init__(self, edges: Iterable[float], bin_width: float = 0.01, limit: float = 1000.0):
+        self.edges = np.asarray(list(edges), dtype=np.float64)
+        self.stats = [RunningStats() for _ in range(len(self.edges) - 1)]
+        self.sketches = [HistogramSketch(bin_width, limit) for _ in range(len(self.edges) - 1)]
+
+    def update(self, values: np.ndarray, keys: np.ndarray):
+        values, keys = np.ravel(values), np.ravel(keys)
+        valid = np.isfinite(values) & np.isfinite(keys)
+        values, keys = values[valid], keys[valid]
+        bins = np.digitize(keys, self.edges) - 1
+        for b in range(len(self.stats)):
+            selected = values[bins == b]
+            if selected.size:
+                self.stats[b].update(selected)
+                self.sketches[b].update(selected)
+
+    def merge(self, other: "BinnedStats"):
+        for a, b in zip(self.stats + self.sketches, other.stats + other.sketches):
+            a.merge(b)
+
+    def summary(self) -> List[Dict[str, float]]:
+        rows = []
+        for lo, hi, stats, sketch in zip(self.edges[:-1], self.edges[1:], self.stats, self.sketches):
+            rows.append(
+                {"min_key": lo, "max_key": hi}
+                | stats.summary()
+                | {"median": sketch.median(), "nmad": sketch.nmad()}
+            )
+        return rows
+
+
+class ErrorStats:
+    """Running statistics, quantiles and binned statistics of a signed error
+
+    Arguments:
+        bin_edges: edges of the bins of the grouping variable, none if None
+        bin_width: width of the histogram bins
+        limit: half range of the histograms
+    """
+
+    PERCENTILES = [1, 5, 10, 25, 50, 75, 90, 95, 99]
+
+    def __init__(
+        self,
+        bin_edges: Optional[Iterable[float]] = None,
+        bin_width: float = 0.01,
+        limit: float = 1000.0,
+    ):
+        self.stats = RunningStats()
+        self.sketch = HistogramSketch(bin_width, limit)
+        self.binned = None if bin_edges is None else BinnedStats(bin_edges, bin_width, limit)
+
+    def update(self, values: np.ndarray, keys: Optional[np.ndarray] = None):
+        self.stats.update(values)
+        self.sketch.update(values)
+        if self.binned is not None and keys is not None:
+            self.binned.update(values, keys)
+
+    def merge(self, other: "ErrorStats"):
+        self.stats.merge(other.stats)
+        self.sketch.merge(other.sketch)
+        if self.binned is not None:
+            self.binned.merge(other.binned)
+
+    def summary(self) -> dict:
+        percentiles = self.sketch.quantiles(np.array(self.PERCENTILES) / 100)
+        out = self.stats.summary() | {
+            "median": self.sketch.median(),
+            "nmad": self.sketch.nmad(),
+            "percentiles": dict(zip(self.PERCENTILES, percentiles.tolist())),
+        }
+        if self.binned is not None:
+            out["binned"] = self.binned.summary()
+        return out
@@ -0,0 +1,150 @@
+# Cache of processing steps keyed on their command and input files
+
+from glob import glob
+from hashlib import blake2b
+from os import makedirs, replace, stat
+from os.path import exists, isdir, join
+from threading import Lock
+from time import time
+from typing import Dict, List, Optional
+import json
+
+# Sampled hash parameters: number of chunks read and their size
+SAMPLES = 16
+SAMPLE_SIZE = 64 * 2**10
+
+_fingerprints = {}
+_fingerprints_lock = Lock()
+
+
+def fingerprint(path: str) -> str:
+    """Fast fingerprint of a file: size, modification time and sampled hash
+
+    The hash covers `SAMPLES` chunks of `SAMPLE_SIZE` bytes spread over the
+    file, so large rasters are not read entirely. Fingerprints are memoized
+    on (path, size, mtime).
+    """
+    st = stat(path)
+    memo_key = (path, st.st_size, st.st_mtime_ns)
+    with _fingerprints_lock:
+        if memo_key in _fingerprints:
+            return _fingerprints[memo_key]
+
+    h = blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        if st.st_size <= SAMPLES * SAMPLE_SIZE:
+            h.update(f.read())
+        else:
+            stride = (st.st_size - SAMPLE_SIZE) // (SAMPLES - 1)
+            for i in range(SAMPLES):
+                f.seek(i * stride)
+                h.update(f.read(SAMPLE_SIZE))
+    fp = f"{st.st_size}-{st.st_mtime_ns}-{h.hexdigest()}"
+    with _fingerprints_lock:
+        _fingerprints[memo_key] = fp
+    return fp
+
+
+def expand_paths(paths: List[str]) -> List[str]:
+    """Existing files of a list of files, folders and prefixes
+
+    A folder gives all its files, a path which does not exist is used as a
+    prefix (`prefix*`).
+    """
+    files = []
+    for p in paths:
+        if isdir(p):
+            files += sorted(glob(join(p, "**", "*"), recursive=True))
+        elif exists(p):
+            files.append(p)
+        else:
+            files += sorted(glob(p + "*"))
+    return sorted({f for f in files if not isdir(f)})
+
+
+class StepCache:
+    """Manifest of the steps already run and of the files they produced
+
+    A step is identified by its command and the fingerprints of its input
+    files. As the outputs of a step are the inputs of the next ones, a
+    changed input only invalidates the steps downstream of it.
+
+    Arguments:
+        folder: folder of the manifest
+    """
+
+    def __init__(self, folder: str):
+        makedirs(folder, exist_ok=True)
+        self.path = join(folder, "manifest.json")
+        self._lock = Lock()
+        self.entries: Dict[str, dict] = {}
+        if exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def key(self, cmd: List[str], inputs: List[str]) -> str:
+        files = expand_paths(inputs)
+        content = json.dumps({"cmd": cmd, "inputs": {f: fingerprint(f) for f in files}})
+        return blake2b(content.encode(), digest_size=16).hexdigest()
+
+    def lookup(self, key: str) -> Optional[dict]:
+        """Entry of a step, if all its outputs are still unchanged"""
+        entry = self.entries.get(key)
+        # A step without known output can not be checked, it is run again
+        if entry is None or not entry["outputs"]:
+            return None
+        for path, fp in entry["outputs"].items():
+            if not exists(path):
+                return None
+            st = stat(path)
+            if not fp.startswith(f"{st.st_size}-{st.st_mtime_ns}-"):
+                return None
+        return entry
+
+    def record(
+        self,
+        key: str,
+        cmd: List[str],
+        inputs: List[str],
+        outputs: List[str],
+        started: float,
+        duration: float,
+    ):
+        """Record a successful step and the output files created since `started`
+
+        Steps which produced no file under `outputs` are not recorded.
+        """
+        inputs = set(expand_paths(inputs))
+        files = [
+            f
+            for f in expand_paths(outputs)
+            if f not in inputs and stat(f).st_mtime >= started - 1
+        ]
+        if not files:
+            self.invalidate(key)
+            return
+        entry = {
+            "cmd": cmd,
+            "outputs": {f: fingerprint(f) for f in files},
+            "date": time(),
+            "duration": duration,
+        }
+        with self._lock:
+            self.entries[key] = entry
+            self._save()
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self.entries.pop(key, None)
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self.entries = {}
+            self._save()
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=1)
+        replace(tmp, self.path)
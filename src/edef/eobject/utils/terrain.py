@@ -0,0 +1,255 @@
+from typing import Callable, Dict, Iterable, Iterator, Tuple
+import numpy as np
+
+from edef.eobject.utils.gdal_utils import Window
+
+# Products available from the terrain engine
+# and the finite differences they are derived from
+PRODUCTS = {
+    "gradient_x": {"p"},
+    "gradient_y": {"q"},
+    "laplacian": {"r", "t"},
+    "hessian_xx": {"r"},
+    "hessian_xy": {"s"},
+    "hessian_yy": {"t"},
+    "slope": {"p", "q"},
+    "aspect": {"p", "q"},
+    "hillshade": {"p", "q"},
+    "curvature": {"p", "q", "r", "s", "t"},
+    "profile_curvature": {"p", "q", "r", "s", "t"},
+    "plan_curvature": {"p", "q", "r", "s", "t"},
+}
+
+# Halo needed around a tile by the 3x3 stencil
+HALO = 1
+
+
+def pad_edges(z: np.ndarray, top: bool, bottom: bool, left: bool, right: bool):
+    """Add a one pixel halo on the requested sides by linear extrapolation
+
+    With an extrapolated halo, central differences on the raster edges are
+    the one sided differences, as with `numpy.gradient`.
+    """
+    if not (top or bottom or left or right):
+        return z
+    pads = ((int(top), int(bottom)), (int(left), int(right)))
+    out = np.pad(z, pads, mode="edge")
+    if z.shape[0] > 1:
+        if top:
+            out[0] = 2 * out[1] - out[2]
+        if bottom:
+            out[-1] = 2 * out[-2] - out[-3]
+    if z.shape[1] > 1:
+        if left:
+            out[:, 0] = 2 * out[:, 1] - out[:, 2]
+        if right:
+            out[:, -1] = 2 * out[:, -2] - out[:, -3]
+    return out
+
+
+class TerrainEngine:
+    """Terrain derivatives from a single shared stencil pass
+
+    The first (p, q) and second (r, s, t) finite differences are computed once
+    per tile, only if one of the requested products needs them, and every
+    product is derived from them. x points east and y points north.
+
+    Output buffers are float32 and reused from one tile to the next: arrays
+    returned by `compute` are overwritten by the next call unless `reuse` is
+    False.
+
+    Arguments:
+        dx: pixel size along x, in the elevation unit
+        dy: pixel size along y, in the elevation unit
+        products: names of the products to compute, see `PRODUCTS`
+        azimuth: sun azimuth for the hillshade, in degrees from north
+        altitude: sun elevation for the hillshade, in degrees
+        reuse: reuse the output buffers between calls
+    """
+
+    def __init__(
+        self,
+        dx: float,
+        dy: float,
+        products: Iterable[str],
+        azimuth: float = 315.0,
+        altitude: float = 45.0,
+        reuse: bool = True,
+    ):
+        self.products = list(products)
+        for p in self.products:
+            if p not in PRODUCTS:
+                raise ValueError(f"Unknown terrain product {p}")
+        self.dx = abs(float(dx))
+        self.dy = abs(float(dy))
+        self.azimuth = azimuth
+        self.altitude = altitude
+        self.reuse = reuse
+        self.terms = set().union(*[PRODUCTS[p] for p in self.products])
+        self._buffers = {}
+
+    def _buffer(self, name: str, shape: Tuple[int, int]) -> np.ndarray:
+        buffer = self._buffers.get(name) if self.reuse else None
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.float32)
+            if self.reuse:
+                self._buffers[name] = buffer
+        return buffer
+
+    def differences(self, z: np.ndarray) -> Dict[str, np.ndarray]:
+        """Finite differences at the center of a tile with a one pixel halo"""
+        z = np.asarray(z, dtype=np.float32)
+        shape = (z.shape[0] - 2, z.shape[1] - 2)
+        c = z[1:-1, 1:-1]
+        n, s, w, e = z[:-2, 1:-1], z[2:, 1:-1], z[1:-1, :-2], z[1:-1, 2:]
+        d = {}
+        if "p" in self.terms:
+            d["p"] = np.subtract(e, w, out=self._buffer("p", shape))
+            d["p"] /= 2 * self.dx
+        if "q" in self.terms:
+            d["q"] = np.subtract(n, s, out=self._buffer("q", shape))
+            d["q"] /= 2 * self.dy
+        if "r" in self.terms:
+            d["r"] = np.add(e, w, out=self._buffer("r", shape))
+            d["r"] -= 2 * c
+            d["r"] /= self.dx**2
+        if "t" in self.terms:
+            d["t"] = np.add(n, s, out=self._buffer("t", shape))
+            d["t"] -= 2 * c
+            d["t"] /= self.dy**2
+        if "s" in self.terms:
+            d["s"] = np.subtract(z[:-2, 2:], z[:-2, :-2], out=self._buffer("s", shape))
+            d["s"] -= z[2:, 2:]
+            d["s"] += z[2:, :-2]
+            d["s"] /= 4 * self.dx * self.dy
+        return d
+
+    def compute(self, z: np.ndarray) -> Dict[str, np.ndarray]:
+        """All requested products of a tile with a one pixel halo
+
+        Arguments:
+            z: elevation tile, including the halo on every side
+        """
+        d = self.differences(z)
+        shape = (z.shape[0] - 2, z.shape[1] - 2)
+        out = {}
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if "p" in d and "q" in d:
+                grad2 = np.hypot(d["p"], d["q"], out=self._buffer("grad2", shape))
+                grad2 **= 2
+            for name in self.products:
+                buf = self._buffer(name, shape)
+                if name == "gradient_x":
+                    np.copyto(buf, d["p"])
+                elif name == "gradient_y":
+                    np.copyto(buf, d["q"])
+                elif name == "laplacian":
+                    np.add(d["r"], d["t"], out=buf)
+                elif name == "hessian_xx":
+                    np.copyto(buf, d["r"])
+                elif name == "hessian_xy":
+                    np.copyto(buf, d["s"])
+                elif name == "hessian_yy":
+                    np.copyto(buf, d["t"])
+                elif name == "slope":
+                    np.sqrt(grad2, out=buf)
+                    np.arctan(buf, out=buf)
+                    np.degrees(buf, out=buf)
+                elif name == "aspect":
+                    self._aspect(d, buf)
+                elif name == "hillshade":
+                    self._hillshade(d, grad2, buf)
+                else:
+                    self._curvature(name, d, grad2, buf)
+                out[name] = buf
+        return out
+
+    def _aspect(self, d, buf):
+        # Azimuth of the steepest descent, clockwise from north
+        np.arctan2(-d["p"], -d["q"], out=buf)
+        np.degrees(buf, out=buf)
+        buf %= 360
+        buf[(d["p"] == 0) & (d["q"] == 0)] = np.nan
+
+    def _hillshade(self, d, grad2, buf):
+        zenith = np.radians(90 - self.altitude)
+        azimuth = np.radians(self.azimuth)
+        # cos(Z)cos(S) + sin(Z)sin(S)cos(az - A), written with the gradient
+        np.multiply(d["p"], -np.sin(azimuth), out=buf)
+        buf -= d["q"] * np.cos(azimuth)
+        buf *= np.sin(zenith)
+        buf += np.cos(zenith)
+        buf /= np.sqrt(1 + grad2)
+        np.clip(buf, 0, 1, out=buf)
+
+    def _curvature(self, name, d, grad2, buf):
+        # Positive on convex shapes
+        p, q, r, s, t = d["p"], d["q"], d["r"], d["s"], d["t"]
+        if name == "curvature":
+            np.multiply(1 + q * q, r, out=buf)
+            buf -= 2 * p * q * s
+            buf += (1 + p * p) * t
+            buf /= -2 * (1 + grad2) ** 1.5
+        elif name == "profile_curvature":
+            np.multiply(p * p, r, out=buf)
+            buf += 2 * p * q * s
+            buf += q * q * t
+            buf /= -grad2 * (1 + grad2) ** 1.5
+        else:
+            np.multiply(q * q, r, out=buf)
+            buf -= 2 * p * q * s
+            buf += p * p * t
+            buf /= -(grad2**1.5)
+
+    def stack(self, z: np.ndarray) -> np.ndarray:
+        """Products of a tile stacked as a (products, lines, columns) array"""
+        products = self.compute(z)
+        return np.stack([products[p] for p in self.products])
+
+    def run(
+        self,
+        read: Callable[[Window], np.ndarray],
+        shape: Tuple[int, int],
+        tile: int = 1024,
+    ) -> Iterator[Tuple[Window, Dict[str, np.ndarray]]]:
+        """Compute the products tile by tile over a raster larger than memory
+
+        Each tile is read with its halo from the neighbouring tiles, so the
+        result is the same as on the whole array. With buffer reuse, the
+        yielded arrays are only valid until the next iteration.
+
+        Arguments:
+            read: function reading a pixel `Window` of the elevation
+            shape: raster shape (lines, columns)
+            tile: tile size in pixels
+        """
+        height, width = shape
+        for y in range(0, height, tile):
+            for x in range(0, width, tile):
+                window = Window(x, y, tile, tile).clip(width, height)
+                halo = Window(
+                    window.xoff - HALO,
+                    window.yoff - HALO,
+                    window.xsize + 2 * HALO,
+                    window.ysize + 2 * HALO,
+                ).clip(width, height)
+                z = pad_edges(
+                    read(halo),
+                    top=halo.yoff == window.yoff,
+                    bottom=halo.yoff + halo.ysize == window.yoff + window.ysize,
+                    left=halo.xoff == window.xoff,
+                    right=halo.xoff + halo.xsize == window.xoff + window.xsize,
+                )
+                yield window, self.compute(z)
+
+
+def stack_block(z: np.ndarray, engine: TerrainEngine, block_info=None) -> np.ndarray:
+    """Terrain products of a dask block overlapped with a one pixel halo
+
+    Blocks on the raster edges have no halo on the outer side, it is
+    extrapolated here.
+    """
+    i, j = block_info[0]["chunk-location"]
+    ni, nj = block_info[0]["num-chunks"]
+    z = pad_edges(z, top=i == 0, bottom=i == ni - 1, left=j == 0, right=j == nj - 1)
+    return engine.stack(z)
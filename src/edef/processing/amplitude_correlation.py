@@ -0,0 +1,228 @@
+# Image to image offset tracking by normalized cross-correlation
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional, Tuple
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft
+
+from edef.eobject.georaster import GeoRaster
+from edef.eobject.images import CorrelationImage, OrthoImage
+from edef.eobject.utils.gdal_utils import TiledWriter, Window
+
+
+def ncc_batch(templates: np.ndarray, searches: np.ndarray) -> np.ndarray:
+    """Normalized cross-correlation of many template / search window pairs
+
+    All pairs are correlated at once with batched FFTs.
+
+    Arguments:
+        templates: (N, w, w) reference windows
+        searches: (N, w + 2s, w + 2s) secondary windows
+
+    Returns:
+        (N, 2s + 1, 2s + 1) correlation surfaces, lag (s, s) is no offset
+    """
+    templates = templates.astype(np.float64)
+    searches = searches.astype(np.float64)
+    n, w, _ = templates.shape
+    size = searches.shape[-1]
+    lags = size - w + 1
+
+    centered = templates - templates.mean(axis=(1, 2), keepdims=True)
+    norm_t = np.sqrt((centered**2).sum(axis=(1, 2)))
+
+    shape = (size, size)
+    spectrum = np.conj(fft.rfft2(centered, s=shape, axes=(1, 2)))
+    spectrum *= fft.rfft2(searches, s=shape, axes=(1, 2))
+    num = fft.irfft2(spectrum, s=shape, axes=(1, 2))[:, :lags, :lags]
+
+    # Local sums of the search windows with integral images
+    def window_sum(a):
+        c = np.zeros((n, size + 1, size + 1))
+        c[:, 1:, 1:] = a.cumsum(1).cumsum(2)
+        return c[:, w:, w:] - c[:, :-w, w:] - c[:, w:, :-w] + c[:, :-w, :-w]
+
+    s1 = window_sum(searches)
+    s2 = window_sum(searches**2)
+    var_s = np.maximum(s2 - s1**2 / (w * w), 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ncc = num / (norm_t[:, None, None] * np.sqrt(var_s))
+    ncc[~np.isfinite(ncc)] = 0
+    return ncc
+
+
+def subpixel_peak(surfaces: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Peak position of correlation surfaces refined by parabola fitting
+
+    Returns:
+        line and column of the peaks (float) and their correlation values
+    """
+    n, h, w = surfaces.shape
+    flat = surfaces.reshape(n, -1).argmax(axis=1)
+    row, col = np.divmod(flat, w)
+    idx = np.arange(n)
+    peak = surfaces[idx, row, col]
+
+    def refine(center, before, after):
+        denom = before - 2 * center + after
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta = np.where(denom < 0, (before - after) / (2 * denom), 0.0)
+        return np.clip(delta, -0.5, 0.5)
+
+    inside_r = (row > 0) & (row < h - 1)
+    inside_c = (col > 0) & (col < w - 1)
+    r0, r1 = np.clip(row - 1, 0, h - 1), np.clip(row + 1, 0, h - 1)
+    c0, c1 = np.clip(col - 1, 0, w - 1), np.clip(col + 1, 0, w - 1)
+    dr = refine(peak, surfaces[idx, r0, col], surfaces[idx, r1, col])
+    dc = refine(peak, surfaces[idx, row, c0], surfaces[idx, row, c1])
+    sub_row = np.where(inside_r, row + dr, np.nan)
+    sub_col = np.where(inside_c, col + dc, np.nan)
+    return sub_row, sub_col, peak
+
+
+def grid_centers(size: int, window: int, search: int, step: int) -> np.ndarray:
+    """Centers of the correlation windows along one axis"""
+    margin = window // 2 + search
+    return np.arange(margin, size - (window - window // 2) - search + 1, step)
+
+
+def _correlate_chunk(
+    ref_path: str,
+    sec_path: str,
+    rows: np.ndarray,
+    cols: np.ndarray,
+    window: int,
+    search: int,
+    batch: int,
+    band: int,
+):
+    """Offsets of a block of grid lines, reading only the needed strips"""
+    half = window // 2
+    strip = Window(
+        0,
+        int(rows[0]) - half - search,
+        0,
+        int(rows[-1] - rows[0]) + window + 2 * search,
+    )
+    ref = GeoRaster.from_file(ref_path)
+    sec = GeoRaster.from_file(sec_path)
+    strip = strip._replace(xsize=ref.dim[0])
+    ref_strip = ref.array_view(strip, band).astype(np.float32)
+    sec_strip = sec.array_view(strip, band).astype(np.float32)
+
+    size = window + 2 * search
+    t_views = sliding_window_view(ref_strip, (window, window))
+    s_views = sliding_window_view(sec_strip, (size, size))
+    rr, cc = np.meshgrid(rows - strip.yoff, cols, indexing="ij")
+    rr, cc = rr.ravel(), cc.ravel()
+
+    dy = np.empty(rr.size, dtype=np.float32)
+    dx = np.empty(rr.size, dtype=np.float32)
+    snr = np.empty(rr.size, dtype=np.float32)
+    for start in range(0, rr.size, batch):
+        r = rr[start : start + batch]
+        c = cc[start : start + batch]
+        templates = t_views[r - half, c - half]
+        searches = s_views[r - half - search, c - half - search]
+        surfaces = ncc_batch(templates, searches)
+        sub_row, sub_col, peak = subpixel_peak(surfaces)
+        dy[start : start + batch] = sub_row - search
+        dx[start : start + batch] = sub_col - search
+        with np.errstate(divide="ignore", invalid="ignore"):
+            snr[start : start + batch] = peak / np.abs(surfaces).mean(axis=(1, 2))
+
+    shape = (rows.size, cols.size)
+    return dx.reshape(shape), dy.reshape(shape), snr.reshape(shape)
+
+
+def amplitude_correlation(
+    reference: OrthoImage,
+    secondary: OrthoImage,
+    output: str,
+    window: int = 32,
+    step: int = 16,
+    search: int = 8,
+    chunk_rows: int = 8,
+    batch: int = 4096,
+    band: int = 1,
+    workers: Optional[int] = None,
+) -> CorrelationImage:
+    """Offset tracking between two orthoimages on the same grid
+
+    The images are cut into a grid of windows, correlated with batched FFT
+    normalized cross-correlation and the peaks refined to sub-pixel
+    accuracy. Blocks of grid lines are processed in parallel, each worker
+    reading only the image strips it needs.
+
+    Arguments:
+        reference: reference orthoimage
+        secondary: secondary orthoimage, on the grid of the reference
+        output: path of the correlation GeoTiff (east, north, snr bands)
+        window: size of the correlation windows, in pixels
+        step: spacing of the grid, in pixels
+        search: maximum offset searched in each direction, in pixels
+        chunk_rows: number of grid lines per task
+        batch: number of windows correlated at once
+        band: band to correlate
+        workers: number of processes, 0 to run in the current process
+
+    Returns:
+        correlation image with east / north offsets in map units and SNR
+    """
+    ref, sec = reference.raster, secondary.raster
+    if ref.dim != sec.dim or ref.geotransform != sec.geotransform:
+        raise ValueError("The images must be on the same grid")
+
+    rows = grid_centers(ref.dim[1], window, search, step)
+    cols = grid_centers(ref.dim[0], window, search, step)
+    if rows.size == 0 or cols.size == 0:
+        raise ValueError("The images are too small for the correlation window")
+
+    x0, dx, _, y0, _, dy = ref.geotransform
+    # Windows cover [c - window // 2, c - window // 2 + window), output cells
+    # are centered on them (pixel edge c for even windows)
+    center = window / 2 - window // 2
+    geotransform = (
+        x0 + (cols[0] + center - step / 2) * dx,
+        step * dx,
+        0,
+        y0 + (rows[0] + center - step / 2) * dy,
+        0,
+        step * dy,
+    )
+    writer = TiledWriter(
+        output,
+        cols.size,
+        rows.size,
+        count=3,
+        geotransform=geotransform,
+        projection=ref.projection,
+        nodata=np.nan,
+        block_size=256,
+    )
+    chunks = [
+        (i, rows[i : i + chunk_rows]) for i in range(0, rows.size, chunk_rows)
+    ]
+    args = (ref.path, sec.path)
+    params = (cols, window, search, batch, band)
+
+    def store(i, result):
+        off_x, off_y, snr = result
+        win = Window(0, i, cols.size, off_x.shape[0])
+        writer.write(win, np.stack([off_x * dx, off_y * dy, snr]))
+
+    with writer:
+        if workers == 0:
+            for i, r in chunks:
+                store(i, _correlate_chunk(*args, r, *params))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(_correlate_chunk, *args, r, *params): i
+                    for i, r in chunks
+                }
+                for future in as_completed(futures):
+                    store(futures[future], future.result())
+
+    return CorrelationImage().from_file(output)
@@ -0,0 +1,359 @@
+# Rigid co-registration of DEMs and point clouds, in process
+
+from copy import copy
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+import numpy as np
+import dask.array as da
+from scipy.ndimage import map_coordinates
+from scipy.spatial import cKDTree
+
+from edef.eobject.georaster import GeoRaster
+from edef.eobject.utils.gdal_utils import Window
+from edef.eobject.utils.stats import NMAD_SCALE
+from edef.eobject.utils.terrain import TerrainEngine, pad_edges
+
+
+def rotation_matrix(angles: np.ndarray) -> np.ndarray:
+    """Rotation of a rotation vector (axis times angle, in radians)"""
+    angles = np.asarray(angles, dtype=np.float64)
+    theta = np.linalg.norm(angles)
+    if theta < 1e-15:
+        return np.eye(3)
+    k = angles / theta
+    K = np.array([[0, -k[2], k[1]], [k[2], 0, -k[0]], [-k[1], k[0], 0]])
+    return np.eye(3) + np.sin(theta) * K + (1 - np.cos(theta)) * K @ K
+
+
+def nmad(values: np.ndarray) -> float:
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return np.nan
+    return NMAD_SCALE * float(np.median(np.abs(values - np.median(values))))
+
+
+@dataclass
+class RigidTransform:
+    """Rotation around a center followed by a translation
+
+    p' = rotation @ (p - center) + center + translation, mapping the
+    coordinates of the aligned data onto the reference.
+    """
+
+    rotation: np.ndarray = field(default_factory=lambda: np.eye(3))
+    translation: np.ndarray = field(default_factory=lambda: np.zeros(3))
+    center: np.ndarray = field(default_factory=lambda: np.zeros(3))
+
+    @staticmethod
+    def shift(dx: float, dy: float, dz: float) -> "RigidTransform":
+        return RigidTransform(translation=np.array([dx, dy, dz], dtype=np.float64))
+
+    def apply(self, points: np.ndarray) -> np.ndarray:
+        """Transform (N, 3) points"""
+        points = np.asarray(points, dtype=np.float64)
+        return (points - self.center) @ self.rotation.T + self.center + self.translation
+
+    def inverse(self) -> "RigidTransform":
+        center = self.center + self.translation
+        return RigidTransform(self.rotation.T, self.center - center, center)
+
+    def then(self, other: "RigidTransform") -> "RigidTransform":
+        """This transform followed by `other`, with the center of this one"""
+        rotation = other.rotation @ self.rotation
+        translation = (
+            other.rotation @ (self.center + self.translation - other.center)
+            + other.center
+            + other.translation
+            - self.center
+        )
+        return RigidTransform(rotation, translation, self.center.copy())
+
+    def is_translation(self) -> bool:
+        return np.allclose(self.rotation, np.eye(3), atol=1e-12)
+
+    def apply_raster(self, dem: GeoRaster, chunks: Tuple[int, int] = (1024, 1024)) -> GeoRaster:
+        """Lazy transformed DEM on its own grid
+
+        Each chunk is resampled from the window of the DEM under it when it
+        is computed. Heights are found by fixed point iterations, exact for
+        translations.
+        """
+        width, height = dem.dim
+        data = da.map_blocks(
+            _transform_block,
+            dem,
+            self,
+            dtype=np.float64,
+            chunks=da.core.normalize_chunks(chunks, (height, width)),
+        )
+        return GeoRaster.from_array(data, dem)
+
+
+def _sample(dem: GeoRaster, cols: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Bilinear heights at fractional pixel coordinates (integers at pixel centers)"""
+    out = np.full(cols.shape, np.nan)
+    finite = np.isfinite(cols) & np.isfinite(rows)
+    if not finite.any():
+        return out
+    x0 = int(np.floor(cols[finite].min())) - 1
+    y0 = int(np.floor(rows[finite].min())) - 1
+    x1 = int(np.ceil(cols[finite].max())) + 2
+    y1 = int(np.ceil(rows[finite].max())) + 2
+    window = Window(x0, y0, x1 - x0, y1 - y0).clip(*dem.dim)
+    if window is None:
+        return out
+    z = dem.array_float(window)
+    coords = [np.where(finite, rows - window.yoff, -2), np.where(finite, cols - window.xoff, -2)]
+    map_coordinates(z, coords, output=out, order=1, mode="constant", cval=np.nan, prefilter=False)
+    return out
+
+
+def _transform_block(dem: GeoRaster, transform: RigidTransform, block_info=None) -> np.ndarray:
+    (r0, r1), (c0, c1) = block_info[None]["array-location"]
+    x0, dx, _, y0, _, dy = dem.geotransform
+    x, y = np.meshgrid(x0 + (np.arange(c0, c1) + 0.5) * dx, y0 + (np.arange(r0, r1) + 0.5) * dy)
+    target = np.stack([x.ravel(), y.ravel(), np.full(x.size, transform.center[2])], axis=1)
+    inverse = transform.inverse()
+    for _ in range(3 if transform.is_translation() else 4):
+        source = inverse.apply(target)
+        cols = (source[:, 0] - x0) / dx - 0.5
+        rows = (source[:, 1] - y0) / dy - 0.5
+        source[:, 2] = _sample(dem, cols, rows)
+        target[:, 2] = transform.apply(source)[:, 2]
+        if transform.is_translation():
+            break
+    return target[:, 2].reshape(x.shape)
+
+
+def _work_grid(reference: GeoRaster, step: int) -> GeoRaster:
+    x0, dx, _, y0, _, dy = reference.geotransform
+    width, height = reference.dim
+    return GeoRaster.from_grid(
+        (x0, dx * step, 0, y0, 0, dy * step),
+        max(1, width // step),
+        max(1, height // step),
+        reference.srs if reference.projection else None,
+    )
+
+
+def _shifted(dem: GeoRaster, dx: float, dy: float) -> GeoRaster:
+    """Same raster with its grid moved by (dx, dy), the pixels are not read"""
+    shifted = copy(dem)
+    x0, gx, rx, y0, ry, gy = dem.geotransform
+    shifted.geotransform = (x0 + dx, gx, rx, y0 + dy, ry, gy)
+    shifted.bbox = shifted.window_to_bbox(Window(0, 0, *dem.dim))
+    return shifted
+
+
+def nuth_kaab(
+    reference: GeoRaster,
+    dem: GeoRaster,
+    step: int = 1,
+    max_iterations: int = 10,
+    tolerance: float = 0.01,
+    slope_range: Tuple[float, float] = (3.0, 70.0),
+    outliers: float = 3.0,
+) -> Tuple[RigidTransform, Dict[str, float]]:
+    """Horizontal and vertical shift of a DEM onto a reference (Nuth & Kääb, 2011)
+
+    The height differences over slopes depend on the aspect as
+    dh / tan(slope) = a cos(b - aspect) + c, the shift of magnitude a and
+    direction b being solved by least squares. The DEM is shifted and
+    resampled again until the shift is below the tolerance. Only the pixels
+    of a grid decimated by `step` are read.
+
+    Arguments:
+        reference: reference DEM
+        dem: DEM to align
+        step: decimation of the reference grid used for the fit
+        max_iterations: maximum number of iterations
+        tolerance: stop when the horizontal shift of an iteration is smaller,
+            in map units
+        slope_range: slopes used by the fit, in degrees
+        outliers: differences further than `outliers` NMAD from the median are ignored
+
+    Returns:
+        translation of the DEM onto the reference, and statistics of the
+        differences before and after
+    """
+    grid = _work_grid(reference, step)
+    z_ref = reference.read_on_grid(grid)
+    engine = TerrainEngine(*grid.pixel_spacing(), ["slope", "aspect"], reuse=False)
+    terrain = engine.compute(pad_edges(z_ref, True, True, True, True))
+    tan_slope = np.tan(np.radians(terrain["slope"]))
+    aspect = np.radians(terrain["aspect"])
+    usable = (terrain["slope"] >= slope_range[0]) & (terrain["slope"] <= slope_range[1])
+
+    dx = dy = dz = 0.0
+    initial = reference_nmad = None
+    iterations = 0
+    for iterations in range(1, max_iterations + 1):
+        dh = z_ref - _shifted(dem, dx, dy).read_on_grid(grid)
+        dz = float(np.nanmedian(dh)) if np.isfinite(dh).any() else 0.0
+        if initial is None:
+            initial, reference_nmad = float(np.nanmedian(dh)), nmad(dh)
+        spread = nmad(dh)
+        valid = usable & np.isfinite(dh) & np.isfinite(aspect)
+        valid &= np.abs(dh - dz) <= outliers * max(spread, 1e-6)
+        if valid.sum() < 10:
+            break
+        # (dh - bias) / tan(slope) = A cos(aspect) + B sin(aspect) + C
+        # with A = a cos(b) and B = a sin(b)
+        psi = aspect[valid]
+        A = np.stack([np.cos(psi), np.sin(psi), np.ones(psi.size)], axis=1)
+        y = (dh[valid] - dz) / tan_slope[valid]
+        (a_cos, a_sin, _), *_ = np.linalg.lstsq(A, y, rcond=None)
+        dx, dy = dx + a_sin, dy + a_cos
+        if np.hypot(a_sin, a_cos) < tolerance:
+            break
+
+    dh = z_ref - _shifted(dem, dx, dy).read_on_grid(grid)
+    dz = float(np.nanmedian(dh)) if np.isfinite(dh).any() else 0.0
+    stats = {
+        "iterations": iterations,
+        "median_before": initial,
+        "nmad_before": reference_nmad,
+        "nmad_after": nmad(dh),
+    }
+    return RigidTransform.shift(dx, dy, dz), stats
+
+
+def dem_points(dem: GeoRaster, step: int = 1) -> np.ndarray:
+    """(N, 3) points at the centers of the valid pixels of a grid decimated by `step`"""
+    grid = _work_grid(dem, step)
+    z = dem.read_on_grid(grid)
+    x0, dx, _, y0, _, dy = grid.geotransform
+    x, y = np.meshgrid(
+        x0 + (np.arange(grid.dim[0]) + 0.5) * dx, y0 + (np.arange(grid.dim[1]) + 0.5) * dy
+    )
+    valid = np.isfinite(z)
+    return np.stack([x[valid], y[valid], z[valid]], axis=1)
+
+
+def normals(points: np.ndarray, tree: cKDTree, k: int = 10) -> np.ndarray:
+    """(N, 3) unit normals from the principal axes of the k nearest neighbours"""
+    _, idx = tree.query(points, k=min(k, tree.n))
+    neighbours = tree.data[idx]
+    centered = neighbours - neighbours.mean(axis=1, keepdims=True)
+    covariance = np.einsum("nki,nkj->nij", centered, centered)
+    _, vectors = np.linalg.eigh(covariance)
+    return vectors[:, :, 0]
+
+
+def icp(
+    reference: np.ndarray,
+    points: np.ndarray,
+    initial: Optional[RigidTransform] = None,
+    max_points: int = 200_000,
+    max_distance: Optional[float] = None,
+    max_iterations: int = 30,
+    tolerance: float = 1e-3,
+    seed: int = 0,
+) -> Tuple[RigidTransform, Dict[str, float]]:
+    """Point-to-plane ICP of points onto reference points
+
+    The points are subsampled, matched to their nearest reference point
+    with a KD-tree, and the small rotation and translation minimizing the
+    distances to the tangent planes of the reference are solved linearly
+    at each iteration.
+
+    Arguments:
+        reference: (N, 3) reference points
+        points: (M, 3) points to align
+        initial: starting transform, the identity if None
+        max_points: number of points used, sampled at random
+        max_distance: matches further apart are rejected, three times the
+            median distance if None
+        max_iterations: maximum number of iterations
+        tolerance: stop when the points move less, in map units
+        seed: seed of the subsampling
+
+    Returns:
+        transform of the points onto the reference, and the distances
+        to the reference planes before and after
+    """
+    rng = np.random.default_rng(seed)
+    reference = np.asarray(reference, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) > max_points:
+        points = points[rng.choice(len(points), max_points, replace=False)]
+    center = points.mean(axis=0)
+    # Centered coordinates keep the linear system well conditioned
+    tree = cKDTree(reference - center)
+    transform = RigidTransform(center=center)
+    if initial is not None:
+        transform = transform.then(initial)
+    current = transform.apply(points) - center
+    # Normals of the reference points, computed when first matched
+    reference_normals = np.full(tree.data.shape, np.nan)
+
+    def distances(p):
+        dist, idx = tree.query(p)
+        missing = np.unique(idx[np.isnan(reference_normals[idx, 0])])
+        if missing.size:
+            reference_normals[missing] = normals(tree.data[missing], tree)
+        n = reference_normals[idx]
+        return np.einsum("ij,ij->i", p - tree.data[idx], n), dist, idx, n
+
+    before, *_ = distances(current)
+    iterations = 0
+    for iterations in range(1, max_iterations + 1):
+        residual, dist, idx, n = distances(current)
+        limit = max_distance if max_distance is not None else 3 * np.median(dist)
+        keep = dist <= max(limit, 1e-9)
+        if keep.sum() < 6:
+            break
+        p, n, r = current[keep], n[keep], residual[keep]
+        A = np.concatenate([np.cross(p, n), n], axis=1)
+        (rx, ry, rz, tx, ty, tz), *_ = np.linalg.lstsq(A, -r, rcond=None)
+        step = RigidTransform(rotation_matrix([rx, ry, rz]), np.array([tx, ty, tz]), center)
+        transform = transform.then(step)
+        moved = transform.apply(points) - center
+        change = np.max(np.linalg.norm(moved - current, axis=1))
+        current = moved
+        if change < tolerance:
+            break
+
+    after, *_ = distances(current)
+    stats = {
+        "iterations": iterations,
+        "nmad_before": nmad(before),
+        "nmad_after": nmad(after),
+        "median_before": float(np.median(before)),
+        "median_after": float(np.median(after)),
+    }
+    return transform, stats
+
+
+def coregister(
+    reference: GeoRaster,
+    dem: GeoRaster,
+    method: str = "nuth_kaab",
+    step: int = 1,
+    nuth_kaab_opts: Optional[dict] = None,
+    icp_opts: Optional[dict] = None,
+) -> Tuple[RigidTransform, Dict[str, float]]:
+    """Align a DEM onto a reference DEM
+
+    In-process alternative to `asp.pc_align` for DEM to DEM cases.
+
+    Arguments:
+        reference: reference DEM
+        dem: DEM to align
+        method: "nuth_kaab", "icp", or "nuth_kaab+icp" to refine the shift
+            of Nuth & Kääb with a rotation
+        step: decimation of the grids read
+        nuth_kaab_opts: options of `nuth_kaab`
+        icp_opts: options of `icp`
+    """
+    if method not in ["nuth_kaab", "icp", "nuth_kaab+icp"]:
+        raise ValueError(f"Unknown co-registration method {method}")
+    transform, stats = None, {}
+    if method.startswith("nuth_kaab"):
+        transform, stats = nuth_kaab(reference, dem, step, **(nuth_kaab_opts or {}))
+        if method == "nuth_kaab":
+            return transform, stats
+    transform, icp_stats = icp(
+        dem_points(reference, step), dem_points(dem, step), transform, **(icp_opts or {})
+    )
+    return transform, stats | {f"icp_{k}": v for k, v in icp_stats.items()}
@@ -0,0 +1,112 @@
+# DEM differencing and error statistics computed block by block
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from threading import Lock, local
+from typing import Iterable, Optional, Union
+import numpy as np
+
+from edef.eobject.georaster import GeoRaster
+from edef.eobject.utils.gdal_utils import TiledWriter, Window
+from edef.eobject.utils.stats import ErrorStats
+from edef.eobject.utils.terrain import HALO, TerrainEngine, pad_edges
+
+# Slope bins of the error statistics, in degrees
+SLOPE_EDGES = [0, 5, 10, 20, 30, 40, 50, 90]
+
+
+def dem_difference(
+    dem1: Union[str, GeoRaster],
+    dem2: Union[str, GeoRaster],
+    output: Optional[str] = None,
+    tile: int = 1024,
+    slope_edges: Optional[Iterable[float]] = SLOPE_EDGES,
+    bin_width: float = 0.01,
+    limit: float = 1000.0,
+    workers: int = 4,
+    **writer_opts,
+) -> ErrorStats:
+    """Difference dem1 - dem2 on the grid of dem1, with its statistics
+
+    In-process equivalent of `asp.geodiff`: the second DEM is resampled on
+    the fly onto the grid of the first one, tile by tile, and the statistics
+    (mean, std, NMAD, percentiles, by slope of dem1) are accumulated in the
+    same pass. Tiles are processed by a pool of threads.
+
+    Arguments:
+        dem1: reference DEM, path or raster
+        dem2: DEM subtracted, path or raster
+        output: difference GeoTiff, not written if None
+        tile: tile size in pixels, rounded to the blocks of the output
+        slope_edges: slope bins of the statistics in degrees, none if None
+        bin_width: precision of the percentiles and NMAD
+        limit: differences beyond +/- limit are counted at the limit for
+            the percentiles and NMAD
+        workers: number of threads
+        writer_opts: options of `TiledWriter` (compress, block_size, cog...)
+
+    Returns:
+        statistics of the difference, see `ErrorStats.summary`
+    """
+    ref = dem1 if isinstance(dem1, GeoRaster) else GeoRaster.from_file(dem1)
+    width, height = ref.dim
+    writer = None
+    if output is not None:
+        writer_opts.setdefault("nodata", np.nan)
+        writer = TiledWriter(
+            output,
+            width,
+            height,
+            geotransform=ref.geotransform,
+            projection=ref.projection or ref.srs.ExportToWkt(),
+            **writer_opts,
+        )
+        tile = -(-tile // writer.block_size) * writer.block_size
+
+    # Rasters, slope engine and statistics of each thread
+    states, states_lock = [], Lock()
+    thread = local()
+
+    def state():
+        if not hasattr(thread, "stats"):
+            thread.ref = dem1 if isinstance(dem1, GeoRaster) else GeoRaster.from_file(dem1)
+            thread.sec = dem2 if isinstance(dem2, GeoRaster) else GeoRaster.from_file(dem2)
+            thread.engine = TerrainEngine(*thread.ref.pixel_spacing(), ["slope"])
+            thread.stats = ErrorStats(slope_edges, bin_width, limit)
+            with states_lock:
+                states.append(thread.stats)
+        return thread
+
+    def process(window: Window):
+        t = state()
+        halo = Window(
+            window.xoff - HALO, window.yoff - HALO, window.xsize + 2 * HALO, window.ysize + 2 * HALO
+        ).clip(width, height)
+        z = t.ref.array_float(halo)
+        diff = z[window.slices(halo)] - t.sec.read_on_grid(t.ref, window)
+        slope = None
+        if slope_edges is not None:
+            z = pad_edges(
+                z,
+                top=halo.yoff == window.yoff,
+                bottom=halo.yoff + halo.ysize == window.yoff + window.ysize,
+                left=halo.xoff == window.xoff,
+                right=halo.xoff + halo.xsize == window.xoff + window.xsize,
+            )
+            slope = t.engine.compute(z)["slope"]
+        t.stats.update(diff, slope)
+        if writer is not None:
+            writer.write(window, diff.astype(writer.dtype))
+
+    windows = [
+        Window(x, y, tile, tile).clip(width, height)
+        for y in range(0, height, tile)
+        for x in range(0, width, tile)
+    ]
+    with writer or nullcontext(), ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(process, windows))
+
+    stats = ErrorStats(slope_edges, bin_width, limit)
+    for s in states:
+        stats.merge(s)
+    return stats
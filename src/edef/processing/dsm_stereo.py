@@ -0,0 +1,334 @@
+# DSM generation from Pleiades stereo acquisitions with ASP
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import combinations
+from os import cpu_count, makedirs
+from os.path import join
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+
+from osgeo import gdal
+
+from edef.eobject.sats.pleiades import Pleiades
+from edef.eobject.utils import asp
+
+
+class Stage:
+    """Step of a pipeline
+
+    Attributes:
+        name: unique name of the stage
+        func: function run by the stage
+        args: positional arguments of `func`
+        kwargs: keyword arguments of `func`
+        deps: names of the stages that must be completed before
+        cpus: number of cores reserved while running
+        memory: memory reserved while running, in GB
+        status: "pending", "running", "done", "failed" or "skipped"
+        duration: wall time of the run, in seconds
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        args: tuple = (),
+        kwargs: Optional[dict] = None,
+        deps: Optional[List[str]] = None,
+        cpus: int = 1,
+        memory: float = 0.0,
+    ):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.deps = list(deps or [])
+        self.cpus = cpus
+        self.memory = memory
+        self.status = "pending"
+        self.duration = None
+        self.error = None
+        self.result = None
+
+    def __call__(self):
+        start = perf_counter()
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        finally:
+            self.duration = perf_counter() - start
+        return self.result
+
+
+class Pipeline:
+    """Dependency graph of stages run concurrently under a resource budget
+
+    A stage starts as soon as all its dependencies are done and its cores
+    and memory fit in what is left of the budget. A stage asking for more
+    than the whole budget runs alone. When a stage fails, the stages
+    depending on it are skipped and the others go on.
+
+    Arguments:
+        max_cpus: number of cores shared by the running stages
+        max_memory: memory shared by the running stages, in GB, unlimited if None
+    """
+
+    def __init__(self, max_cpus: Optional[int] = None, max_memory: Optional[float] = None):
+        self.max_cpus = max_cpus or cpu_count()
+        self.max_memory = max_memory
+        self.stages: Dict[str, Stage] = {}
+        self.wall_time = None
+
+    def add(
+        self,
+        name: str,
+        func: Callable,
+        *args,
+        deps: Optional[List[str]] = None,
+        cpus: int = 1,
+        memory: float = 0.0,
+        **kwargs,
+    ) -> Stage:
+        """Add a stage, its dependencies must already be in the pipeline"""
+        if name in self.stages:
+            raise ValueError(f"Stage {name} already exists")
+        for d in deps or []:
+            if d not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {d}")
+        stage = Stage(name, func, args, kwargs, deps, cpus, memory)
+        self.stages[name] = stage
+        return stage
+
+    def _fits(self, stage: Stage, cpus: int, memory: float, running: int) -> bool:
+        if running == 0:
+            return True
+        if stage.cpus > cpus:
+            return False
+        return self.max_memory is None or stage.memory <= memory
+
+    def run(self) -> Dict[str, float]:
+        """Run all the stages
+
+        Returns:
+            wall time of each stage, in seconds
+
+        Raises:
+            RuntimeError if a stage failed, after running all the others
+        """
+        start = perf_counter()
+        cpus, memory = self.max_cpus, self.max_memory or 0.0
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=len(self.stages) or 1) as pool:
+            while True:
+                for stage in self.stages.values():
+                    if stage.status != "pending":
+                        continue
+                    deps = [self.stages[d].status for d in stage.deps]
+                    if any(s in ["failed", "skipped"] for s in deps):
+                        stage.status = "skipped"
+                        continue
+                    if any(s != "done" for s in deps):
+                        continue
+                    if not self._fits(stage, cpus, memory, len(running)):
+                        continue
+                    stage.status = "running"
+                    cpus -= stage.cpus
+                    memory -= stage.memory
+                    running[pool.submit(stage)] = stage
+
+                if not running:
+                    break
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    stage = running.pop(future)
+                    cpus += stage.cpus
+                    memory += stage.memory
+                    if future.exception() is None:
+                        stage.status = "done"
+                    else:
+                        stage.status = "failed"
+                        stage.error = future.exception()
+
+        self.wall_time = perf_counter() - start
+        failed = [s.name for s in self.stages.values() if s.status == "failed"]
+        if failed:
+            raise RuntimeError(f"Pipeline stages failed: {', '.join(failed)}")
+        return self.timings()
+
+    def timings(self) -> Dict[str, float]:
+        return {n: s.duration for n, s in self.stages.items() if s.duration is not None}
+
+    def report(self) -> str:
+        """Status and wall time of each stage"""
+        lines = [f"{'stage':<32} {'status':<8} {'time (s)':>10}"]
+        for stage in self.stages.values():
+            duration = "" if stage.duration is None else f"{stage.duration:.1f}"
+            lines.append(f"{stage.name:<32} {stage.status:<8} {duration:>10}")
+        if self.wall_time is not None:
+            lines.append(f"{'total':<32} {'':<8} {self.wall_time:>10.1f}")
+        return "\n".join(lines)
+
+
+# Default resources of each ASP step: (cores, memory in GB)
+STAGE_RESOURCES = {
+    "bundle_adjust": (4, 4.0),
+    "mapproject": (4, 4.0),
+    "parallel_stereo": (8, 16.0),
+    "point2dem": (4, 8.0),
+    "pc_align": (4, 8.0),
+    "geodiff": (1, 2.0),
+}
+
+
+class DsmStereo(Pipeline):
+    """DSM generation from a Pleiades bistereo or tristereo acquisition
+
+    Stages:
+        * bundle_adjust of all the views
+        * mapproject of each view on the input DEM
+        * parallel_stereo of each pair of views (one for bistereo, three for
+          tristereo) on the mapprojected images
+        * point2dem of each pair
+        * pc_align and geodiff of each DSM against a reference DEM, if given
+
+    Arguments:
+        acquisition: Pleiades stereo acquisition
+        dem: DEM used to mapproject the images
+        output_folder: folder of all the ASP outputs
+        reference_dem: DEM to align and compare the DSMs to
+        resolution: resolution of the mapprojected images and DSMs
+        max_displacement: maximum displacement for pc_align
+        resources: cores and memory of each ASP step, see `STAGE_RESOURCES`
+        max_cpus: number of cores of the pipeline
+        max_memory: memory of the pipeline, in GB
+        stereo_opts: additional parallel_stereo options
+    """
+
+    def __init__(
+        self,
+        acquisition: Pleiades,
+        dem: str,
+        output_folder: str,
+        reference_dem: Optional[str] = None,
+        resolution: Optional[float] = None,
+        max_displacement: float = 50.0,
+        resources: Optional[Dict[str, tuple]] = None,
+        max_cpus: Optional[int] = None,
+        max_memory: Optional[float] = None,
+        stereo_opts: Optional[dict] = None,
+    ):
+        super().__init__(max_cpus, max_memory)
+        if acquisition.acquisiton_type == "mono":
+            raise ValueError("A stereo acquisition is needed to compute a DSM")
+        self.acquisition = acquisition
+        self.dem = dem
+        self.output_folder = output_folder
+        self.reference_dem = reference_dem
+        self.resolution = resolution
+        self.max_displacement = max_displacement
+        self.resources = STAGE_RESOURCES | (resources or {})
+        self.stereo_opts = stereo_opts or {}
+        makedirs(output_folder, exist_ok=True)
+        self.build()
+
+    def _add_asp(self, name: str, tool: str, *args, deps=None, **opts):
+        cpus, memory = self.resources[tool]
+        func = getattr(asp, tool)
+        opts = asp.thread_opts(tool, cpus) | opts
+        if tool == "mapproject":
+            # mapproject takes its options as a dict
+            args, opts = args + (opts,), {}
+        return self.add(name, func, *args, deps=deps, cpus=cpus, memory=memory, **opts)
+
+    def _views(self) -> List[str]:
+        """Single image per view, multi tiles products are merged in a VRT"""
+        images = []
+        for i, tiles in enumerate(self.acquisition.image_paths()):
+            if len(tiles) == 1:
+                images.append(tiles[0])
+            else:
+                vrt = join(self.output_folder, f"view{i}.vrt")
+                gdal.BuildVRT(vrt, tiles)
+                images.append(vrt)
+        return images
+
+    def build(self):
+        images = self._views()
+        cameras = self.acquisition.dim_paths()
+        out = self.output_folder
+        ba_prefix = join(out, "ba", "run")
+
+        self._add_asp(
+            "bundle_adjust", "bundle_adjust", images, cameras, None, ba_prefix, t="pleiades"
+        )
+
+        mapped = []
+        for i, (img, cam) in enumerate(zip(images, cameras)):
+            mapped.append(join(out, f"view{i}_map.tif"))
+            opts = {"bundle_adjust_prefix": ba_prefix, "t": "pleiades"}
+            if self.resolution:
+                opts["tr"] = self.resolution
+            self._add_asp(
+                f"mapproject_{i}",
+                "mapproject",
+                self.dem,
+                img,
+                cam,
+                mapped[i],
+                deps=["bundle_adjust"],
+                **opts,
+            )
+
+        for i, j in combinations(range(len(images)), 2):
+            pair = f"{i}{j}"
+            prefix = join(out, f"stereo_{pair}", "run")
+            self._add_asp(
+                f"parallel_stereo_{pair}",
+                "parallel_stereo",
+                [mapped[i], mapped[j]],
+                [cameras[i], cameras[j]],
+                prefix,
+                self.dem,
+                deps=[f"mapproject_{i}", f"mapproject_{j}"],
+                bundle_adjust_prefix=ba_prefix,
+                t="pleiades",
+                **self.stereo_opts,
+            )
+            dem_opts = {"tr": self.resolution} if self.resolution else {}
+            self._add_asp(
+                f"point2dem_{pair}",
+                "point2dem",
+                prefix + "-PC.tif",
+                deps=[f"parallel_stereo_{pair}"],
+                **dem_opts,
+            )
+            if self.reference_dem is None:
+                continue
+            align_prefix = join(out, f"align_{pair}", "run")
+            self._add_asp(
+                f"pc_align_{pair}",
+                "pc_align",
+                self.reference_dem,
+                prefix + "-PC.tif",
+                align_prefix,
+                self.max_displacement,
+                deps=[f"point2dem_{pair}"],
+                save_transformed_source_points=True,
+            )
+            aligned = align_prefix + "-trans_source"
+            self._add_asp(
+                f"point2dem_aligned_{pair}",
+                "point2dem",
+                aligned + ".tif",
+                aligned,
+                deps=[f"pc_align_{pair}"],
+                **dem_opts,
+            )
+            self._add_asp(
+                f"geodiff_{pair}",
+                "geodiff",
+                aligned + "-DEM.tif",
+                self.reference_dem,
+                join(out, f"diff_{pair}"),
+                deps=[f"point2dem_aligned_{pair}"],
+            )
@@ -0,0 +1,279 @@
+# Mosaicking and alignment of rasters on a common grid, tile by tile
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from threading import local
+from typing import List, Optional, Tuple, Union
+import warnings
+import numpy as np
+import dask.array as da
+
+from edef.eobject.boundary import Bbox, BboxArray
+from edef.eobject.georaster import GeoRaster
+from edef.eobject.spatial_index import SpatialIndex
+from edef.eobject.utils.gdal_utils import TiledWriter, Window
+from edef.eobject.utils.srs_utils import SrsLike, same_srs, to_srs
+
+METHODS = ["first", "last", "mean", "median", "feather"]
+
+
+def _open(raster: Union[str, GeoRaster]) -> GeoRaster:
+    return raster if isinstance(raster, GeoRaster) else GeoRaster.from_file(raster)
+
+
+def _footprint(raster: GeoRaster, srs) -> Bbox:
+    """Footprint in `srs`, a raster without system is assumed to be in it"""
+    if srs is None or not raster.srs.ExportToWkt():
+        return raster.bbox
+    return raster.footprint(srs)
+
+
+def common_grid(
+    rasters: List[Union[str, GeoRaster]],
+    resolution: Optional[Union[float, Tuple[float, float]]] = None,
+    bbox: Optional[Bbox] = None,
+    srs: Optional[SrsLike] = None,
+    extent: str = "union",
+) -> GeoRaster:
+    """Grid covering rasters, pixels aligned on multiples of the resolution
+
+    Arguments:
+        rasters: input rasters
+        resolution: pixel size (x, y), default to the pixel size of the first raster
+        bbox: extent of the grid, computed from the rasters if None
+        srs: system of the grid, default to the one of the first raster
+        extent: "union" or "intersection" of the rasters when no bbox is given
+    """
+    rasters = [_open(r) for r in rasters]
+    first = rasters[0]
+    if srs is None and first.srs.ExportToWkt():
+        srs = first.srs
+    srs = to_srs(srs) if srs is not None else None
+
+    footprints = BboxArray.from_bboxs([_footprint(r, srs) for r in rasters])
+    if bbox is None:
+        bbox = footprints.total_union() if extent == "union" else footprints.total_intersection()
+        if bbox is None:
+            raise ValueError("The rasters do not overlap")
+    elif bbox.srs is not None and srs is not None and not same_srs(bbox.srs, srs):
+        bbox = bbox.reproject(srs)
+
+    if resolution is None:
+        f = footprints[0]
+        resolution = (f.x_amp() / first.dim[0], f.y_amp() / first.dim[1])
+    rx, ry = (resolution, resolution) if np.isscalar(resolution) else resolution
+    xmin, xmax = np.floor(bbox.xmin / rx) * rx, np.ceil(bbox.xmax / rx) * rx
+    ymin, ymax = np.floor(bbox.ymin / ry) * ry, np.ceil(bbox.ymax / ry) * ry
+    width, height = int(round((xmax - xmin) / rx)), int(round((ymax - ymin) / ry))
+    return GeoRaster.from_grid((xmin, rx, 0, ymax, 0, -ry), width, height, srs)
+
+
+class Mosaic:
+    """Mosaic of many rasters written tile by tile
+
+    Output tiles are processed in parallel. For each tile, only the inputs
+    whose footprint overlaps it are read, on the window under the tile, and
+    resampled onto the output grid. The memory used depends on the tile size
+    and not on the number of inputs (but for "median", which stacks the
+    inputs overlapping a tile).
+
+    Blending methods:
+        * first: value of the first input covering the pixel
+        * last: value of the last input covering the pixel
+        * mean: mean of the inputs
+        * median: median of the inputs
+        * feather: mean weighted by the distance to the edge of each input,
+          in input pixels, saturating at `feather` pixels
+
+    Arguments:
+        rasters: input rasters, paths or rasters
+        method: blending method
+        grid: output grid, see `common_grid`, computed from the inputs if None
+        order: resampling, 0 for nearest neighbour, 1 for bilinear
+        feather: width of the feathering, in input pixels, unlimited if None
+        tile: output tile size, in pixels
+        workers: number of threads
+        max_open: number of inputs kept open by each thread
+        grid_opts: options of `common_grid` when `grid` is None
+    """
+
+    def __init__(
+        self,
+        rasters: List[Union[str, GeoRaster]],
+        method: str = "first",
+        grid: Optional[GeoRaster] = None,
+        order: int = 1,
+        feather: Optional[float] = None,
+        tile: int = 1024,
+        workers: int = 4,
+        max_open: int = 64,
+        **grid_opts,
+    ):
+        if method not in METHODS:
+            raise ValueError(f"Unknown blending method {method}, use one of {METHODS}")
+        if not rasters:
+            raise ValueError("No raster to mosaic")
+        self.rasters = list(rasters)
+        self.method = method
+        self.grid = grid if grid is not None else common_grid(self.rasters, **grid_opts)
+        self.order = order
+        self.feather = feather
+        self.tile = tile
+        self.workers = workers
+        self.max_open = max_open
+        self._thread = local()
+
+        srs = self.grid.srs if self.grid.srs.ExportToWkt() else None
+        footprints = BboxArray.from_bboxs([_footprint(_open(r), srs) for r in self.rasters])
+        self.index = SpatialIndex.build(footprints, [str(i) for i in range(len(self.rasters))])
+
+    def _input(self, i: int) -> GeoRaster:
+        """Input raster, opened once per thread and kept in a LRU"""
+        raster = self.rasters[i]
+        if isinstance(raster, GeoRaster):
+            return raster
+        opened = getattr(self._thread, "opened", None)
+        if opened is None:
+            opened = self._thread.opened = OrderedDict()
+        if i in opened:
+            opened.move_to_end(i)
+        else:
+            opened[i] = GeoRaster.from_file(raster)
+            if len(opened) > self.max_open:
+                opened.popitem(last=False)
+        return opened[i]
+
+    def _weights(self, raster: GeoRaster, window: Window) -> np.ndarray:
+        """Distance to the edge of the input, in input pixels"""
+        cols, rows = raster.grid_pixels(self.grid, window)
+        width, height = raster.dim
+        d = np.minimum(
+            np.minimum(cols + 0.5, width - 0.5 - cols), np.minimum(rows + 0.5, height - 0.5 - rows)
+        )
+        if self.feather is not None:
+            d = np.minimum(d, self.feather)
+        return np.clip(d, 1e-3, None)
+
+    def compute_tile(self, window: Window) -> np.ndarray:
+        """Blended values of an output window, NaN where no input covers it"""
+        ids = sorted(int(i) for i in self.index.intersects(self.grid.window_to_bbox(window)))
+        if self.method == "last":
+            ids = ids[::-1]
+        out = np.full(window.shape, np.nan)
+        if self.method in ["first", "last"]:
+            for i in ids:
+                missing = np.isnan(out)
+                if not missing.any():
+                    break
+                values = self._input(i).read_on_grid(self.grid, window, order=self.order)
+                out[missing] = values[missing]
+            return out
+
+        if self.method == "median":
+            stack = [self._input(i).read_on_grid(self.grid, window, order=self.order) for i in ids]
+            if stack:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", RuntimeWarning)
+                    out = np.nanmedian(np.stack(stack), axis=0)
+            return out
+
+        total, weights = np.zeros(window.shape), np.zeros(window.shape)
+        for i in ids:
+            raster = self._input(i)
+            values = raster.read_on_grid(self.grid, window, order=self.order)
+            valid = ~np.isnan(values)
+            w = self._weights(raster, window) if self.method == "feather" else 1.0
+            w = np.where(valid, w, 0.0)
+            total += np.where(valid, values, 0.0) * w
+            weights += w
+        np.divide(total, weights, out=out, where=weights > 0)
+        return out
+
+    def run(self, output: Optional[str] = None, **writer_opts) -> GeoRaster:
+        """Compute the mosaic
+
+        Arguments:
+            output: output GeoTiff, the mosaic is kept in memory if None
+            writer_opts: options of `TiledWriter` (compress, block_size, cog...)
+        """
+        width, height = self.grid.dim
+        tile, array, writer = self.tile, None, None
+        if output is None:
+            array = np.full((height, width), np.nan, dtype=np.float32)
+        else:
+            writer_opts.setdefault("nodata", np.nan)
+            writer = TiledWriter(
+                output,
+                width,
+                height,
+                geotransform=self.grid.geotransform,
+                projection=self.grid.projection or "",
+                **writer_opts,
+            )
+            tile = -(-tile // writer.block_size) * writer.block_size
+
+        def process(window: Window):
+            values = self.compute_tile(window)
+            if writer is not None:
+                writer.write(window, values.astype(writer.dtype))
+            else:
+                array[window.slices()] = values
+
+        windows = [
+            Window(x, y, tile, tile).clip(width, height)
+            for y in range(0, height, tile)
+            for x in range(0, width, tile)
+        ]
+        with writer or nullcontext(), ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(process, windows))
+
+        if output is not None:
+            return GeoRaster.from_file(output)
+        return GeoRaster.from_grid(
+            self.grid.geotransform, width, height, self.grid.srs if self.grid.projection else None, array
+        )
+
+
+def _aligned_block(raster: GeoRaster, grid: GeoRaster, order: int, block_info=None) -> np.ndarray:
+    (y0, y1), (x0, x1) = block_info[None]["array-location"]
+    return raster.read_on_grid(grid, Window(x0, y0, x1 - x0, y1 - y0), order=order)
+
+
+def align(
+    rasters: List[Union[str, GeoRaster]],
+    grid: Optional[GeoRaster] = None,
+    order: int = 1,
+    chunks: Tuple[int, int] = (1024, 1024),
+    **grid_opts,
+) -> List[GeoRaster]:
+    """Lazy rasters resampled on a common grid
+
+    Each chunk of the aligned rasters is read from the window of the input
+    under it when it is computed.
+
+    Arguments:
+        rasters: input rasters
+        grid: target grid, see `common_grid`, intersection of the inputs if None
+        order: resampling, 0 for nearest neighbour, 1 for bilinear
+        chunks: chunk size of the dask arrays
+        grid_opts: options of `common_grid` when `grid` is None
+    """
+    rasters = [_open(r) for r in rasters]
+    if grid is None:
+        grid_opts.setdefault("extent", "intersection")
+        grid = common_grid(rasters, **grid_opts)
+    width, height = grid.dim
+    srs = grid.srs if grid.projection else None
+    aligned = []
+    for r in rasters:
+        data = da.map_blocks(
+            _aligned_block,
+            r,
+            grid,
+            order,
+            dtype=np.float64,
+            chunks=da.core.normalize_chunks(chunks, (height, width)),
+        )
+        aligned.append(GeoRaster.from_grid(grid.geotransform, width, height, srs, data))
+    return aligned
@@ -0,0 +1,205 @@
+# Gridding of ASP point clouds into DEMs, without point2dem
+
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import numpy as np
+
+from edef.eobject.georaster import GeoRaster
+from edef.eobject.point_cloud import PointCloud
+from edef.eobject.utils.gdal_utils import TiledWriter, Window
+from edef.eobject.utils.srs_utils import SrsLike, to_srs
+
+STATISTICS = ["mean", "median", "count", "std", "min", "max"]
+
+
+def grid_cells(
+    z: np.ndarray, cells: np.ndarray, size: int, statistics: List[str]
+) -> Dict[str, np.ndarray]:
+    """Statistics of the values falling in each cell
+
+    Arguments:
+        z: (N,) values
+        cells: (N,) flat index of the cell of each value
+        size: number of cells
+        statistics: names among `STATISTICS`
+
+    Returns:
+        (size,) arrays, NaN (0 for "count") on empty cells
+    """
+    count = np.bincount(cells, minlength=size)
+    filled = count > 0
+    out = {}
+    mean = np.full(size, np.nan)
+    if {"mean", "std"} & set(statistics):
+        np.divide(np.bincount(cells, z, minlength=size), count, out=mean, where=filled)
+    if "std" in statistics:
+        m2 = np.bincount(cells, (z - mean[cells]) ** 2, minlength=size)
+        out["std"] = np.full(size, np.nan)
+        np.sqrt(m2 / np.maximum(count, 1), out=out["std"], where=filled)
+    if {"median", "min", "max"} & set(statistics):
+        # Values sorted by cell then value, each cell is a contiguous run
+        zs = z[np.lexsort((z, cells))]
+        start = np.cumsum(count) - count
+        n = count[filled]
+        for name, first, second in [
+            ("min", 0, 0),
+            ("max", n - 1, n - 1),
+            ("median", (n - 1) // 2, n // 2),
+        ]:
+            if name in statistics:
+                out[name] = np.full(size, np.nan)
+                s = start[filled]
+                out[name][filled] = (zs[s + first] + zs[s + second]) / 2
+    out["mean"] = mean
+    out["count"] = count
+    return {s: out[s] for s in statistics}
+
+
+def point_cloud_dem(
+    clouds: Union[str, List[str]],
+    prefix: str,
+    resolution: float,
+    srs: SrsLike,
+    statistics: Iterable[str] = ("mean",),
+    grid: Optional[GeoRaster] = None,
+    tile: int = 1024,
+    workers: int = 4,
+    tmp_dir: Optional[str] = None,
+    **writer_opts,
+) -> Dict[str, GeoRaster]:
+    """Grid one or several point clouds into DEMs, in process
+
+    In-process equivalent of `asp.pc_merge` + `asp.point2dem`. The clouds
+    are read tile by tile, converted to `srs` in vectorized batches, and the
+    points are spilled to temporary files, one per output tile. The output
+    tiles are then reduced independently, in parallel: the memory used
+    depends on the number of points of a tile, not of the clouds, and the
+    median is exact.
+
+    Arguments:
+        clouds: -PC.tif files
+        prefix: outputs are written to `<prefix>-<statistic>.tif`
+        resolution: pixel size, in units of `srs`
+        srs: system of the DEMs
+        statistics: values of the pixels, among "mean", "median", "count",
+            "std", "min" and "max" of the heights of their points
+        grid: output grid, the extent of the points snapped to the
+            resolution if None (`resolution` and `srs` are then ignored)
+        tile: output tile size in pixels
+        workers: number of threads
+        tmp_dir: folder of the temporary files, the system one if None
+        writer_opts: options of `TiledWriter` (compress, block_size...)
+
+    Returns:
+        GeoRaster of each statistic
+    """
+    statistics = list(statistics)
+    for s in statistics:
+        if s not in STATISTICS:
+            raise ValueError(f"Unknown statistic {s}, use one of {STATISTICS}")
+    if isinstance(clouds, str):
+        clouds = [clouds]
+    clouds = [PointCloud(c) for c in clouds]
+    if grid is not None:
+        if grid.geotransform[2] or grid.geotransform[4]:
+            raise ValueError("Rotated grids are not supported")
+        srs = grid.srs
+        # Pixels may not be square: columns from the x size, lines from the y size
+        xres, yres = grid.geotransform[1], -grid.geotransform[5]
+        x0, y0 = grid.geotransform[0], grid.geotransform[3]
+    else:
+        srs = to_srs(srs)
+        xres = yres = resolution
+        x0 = y0 = 0.0
+    xspan, yspan = tile * xres, tile * yres
+    spill = mkdtemp(prefix="pc_dem_", dir=tmp_dir)
+
+    try:
+        # Points spilled by output tile, (column, line) of the tile from (x0, y0)
+        locks, locks_lock = {}, Lock()
+        bounds, bounds_lock = [np.inf, -np.inf, np.inf, -np.inf], Lock()
+
+        def spill_tile(task: Tuple[PointCloud, Window]):
+            cloud, window = task
+            points = cloud.transform(cloud.read(window)[0], srs)
+            if len(points) == 0:
+                return
+            with bounds_lock:
+                bounds[0] = min(bounds[0], points[:, 0].min())
+                bounds[1] = max(bounds[1], points[:, 0].max())
+                bounds[2] = min(bounds[2], points[:, 1].min())
+                bounds[3] = max(bounds[3], points[:, 1].max())
+            tx = np.floor((points[:, 0] - x0) / xspan).astype(np.int64)
+            ty = np.floor((y0 - points[:, 1]) / yspan).astype(np.int64)
+            keys = np.stack([tx, ty], axis=1)
+            order = np.lexsort((ty, tx))
+            keys, points = keys[order], points[order]
+            splits = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+            for part, key in zip(np.split(points, splits), keys[np.r_[0, splits]]):
+                key = tuple(key)
+                with locks_lock:
+                    lock = locks.setdefault(key, Lock())
+                with lock, open(join(spill, f"{key[0]}_{key[1]}.bin"), "ab") as f:
+                    f.write(np.ascontiguousarray(part).tobytes())
+
+        tasks = [(c, w) for c in clouds for w in c.reader.iter_windows(tile, tile)]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(spill_tile, tasks))
+        if not locks:
+            raise ValueError("The point clouds have no valid point")
+
+        if grid is None:
+            xmin = np.floor(bounds[0] / resolution) * resolution
+            ymax = np.ceil(bounds[3] / resolution) * resolution
+            width = int(np.floor((bounds[1] - xmin) / resolution)) + 1
+            height = int(np.floor((ymax - bounds[2]) / resolution)) + 1
+            grid = GeoRaster.from_grid(
+                (xmin, resolution, 0, ymax, 0, -resolution), width, height, srs
+            )
+        width, height = grid.dim
+        gx0, _, _, gy0, _, _ = grid.geotransform
+        col0, row0 = int(round((gx0 - x0) / xres)), int(round((y0 - gy0) / yres))
+
+        writer_opts.setdefault("nodata", np.nan)
+        writers = {}
+        for s in statistics:
+            opts = dict(writer_opts)
+            if s == "count":
+                opts.update(dtype=np.uint32, nodata=None)
+            writers[s] = TiledWriter(
+                f"{prefix}-{s}.tif",
+                width,
+                height,
+                geotransform=grid.geotransform,
+                projection=grid.projection or "",
+                **opts,
+            )
+
+        def reduce_tile(key: Tuple[int, int]):
+            points = np.fromfile(join(spill, f"{key[0]}_{key[1]}.bin")).reshape(-1, 3)
+            # Window of the spill tile in the output grid
+            window = Window(key[0] * tile - col0, key[1] * tile - row0, tile, tile)
+            clipped = window.clip(width, height)
+            if clipped is None:
+                return
+            cols = np.floor((points[:, 0] - gx0) / xres).astype(np.int64) - clipped.xoff
+            rows = np.floor((gy0 - points[:, 1]) / yres).astype(np.int64) - clipped.yoff
+            inside = (cols >= 0) & (cols < clipped.xsize) & (rows >= 0) & (rows < clipped.ysize)
+            cells = rows[inside] * clipped.xsize + cols[inside]
+            values = grid_cells(points[inside, 2], cells, clipped.xsize * clipped.ysize, statistics)
+            for s, v in values.items():
+                writers[s].write(clipped, v.reshape(clipped.shape).astype(writers[s].dtype))
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(reduce_tile, list(locks)))
+        finally:
+            for writer in writers.values():
+                writer.close()
+    finally:
+        rmtree(spill, ignore_errors=True)
+    return {s: GeoRaster.from_file(f"{prefix}-{s}.tif") for s in statistics}